@@ -10,39 +10,78 @@ folder_text = {
 }
 
 output_file = 'contigs.fasta'
+output_file2 = 'contigs500.fasta'
+output_file3 = 'contigs500_COV.fasta'
 
-# Open the output file for writing
-with open(output_file, 'w') as outfile:
-    # Process each directory and its corresponding file
-    for folder, text in folder_text.items():
-        # Path to the FASTA file in the folder
-        fasta_path = os.path.join(folder, 'contigs.fasta')
-        
-        # Check if the FASTA file exists
-        if os.path.exists(fasta_path):
+MIN_LENGTH = 500
+MIN_COVERAGE = 3
+LINE_WIDTH = 60
+
+
+# Function to parse coverage from the FASTA header (as in covfilter.py)
+def get_coverage(header):
+    try:
+        parts = header.split("cov_")
+        cov_value = float(parts[1].split("_")[0])  # Assumes format "cov_<value>_"
+        return cov_value
+    except (IndexError, ValueError):
+        return 0  # Return 0 if coverage parsing fails
+
+
+def write_filtered(header, seq_lines, out500, out_cov):
+    """
+    Writes one contig to contigs500.fasta and contigs500_COV.fasta if it
+    passes the length and coverage cutoffs, wrapped at 60 characters as
+    Bio.SeqIO writes it.
+    """
+    if header is None:
+        return
+    sequence = "".join(seq_lines).replace(" ", "")
+    if len(sequence) < MIN_LENGTH:
+        return
+    lines = [header + "\n"]
+    lines.extend(sequence[i:i+LINE_WIDTH] + "\n" for i in range(0, len(sequence), LINE_WIDTH))
+    record = "".join(lines)
+    out500.write(record)
+    if get_coverage(header[1:]) >= MIN_COVERAGE:
+        out_cov.write(record)
+
+
+def collect(folders=folder_text):
+    """
+    Reads each workN/contigs.fasta once and writes contigs.fasta (all
+    contigs, headers tagged with the assembly), contigs500.fasta (length
+    >= 500) and contigs500_COV.fasta (length >= 500 and coverage >= 3) in
+    the same pass. Only the lines of the current contig are kept in memory.
+    """
+    # contigs500_COV.fasta is opened first so it is closed last and is never
+    # older than contigs500.fasta (rotablast2.sh checks this)
+    with open(output_file3, 'w') as out_cov, open(output_file2, 'w') as out500, open(output_file, 'w') as outfile:
+        for folder, text in folders.items():
+            fasta_path = os.path.join(folder, 'contigs.fasta')
+
+            if not os.path.exists(fasta_path):
+                print(f"File not found: {fasta_path}")
+                continue
+
+            header = None
+            seq_lines = []
             with open(fasta_path, 'r') as infile:
-                # Process each line in the file
                 for line in infile:
                     line = line.strip()  # Remove trailing newline characters
                     if line.startswith('>'):  # Header line
-                        # Write the header line with appended text to the output file
-                        outfile.write(line + '' + text + '\n')
+                        write_filtered(header, seq_lines, out500, out_cov)
+                        header = line + text
+                        seq_lines = []
+                        outfile.write(header + '\n')
                     elif line:  # Sequence line, check if not empty
-                        # Write the sequence line to the output file
                         outfile.write(line + '\n')
-        else:
-            print(f"File not found: {fasta_path}")
-
-print(f"Processed FASTA sequences written to {output_file}")
+                        if header is not None:
+                            seq_lines.append(line)
+            write_filtered(header, seq_lines, out500, out_cov)
 
-from Bio import SeqIO
+    print(f"Processed FASTA sequences written to {output_file}")
 
-# Input and output file names
-input_file = "contigs.fasta"
-output_file2 = "contigs500.fasta"
 
-# Filter sequences and write to output file
-with open(output_file2, "w") as output_handle:
-    for record in SeqIO.parse(input_file, "fasta"):
-        if len(record.seq) >= 500:
-            SeqIO.write(record, output_handle, "fasta")
+if __name__ == "__main__":
+    collect()
@@ -1,129 +1,215 @@
+"""
+Extracts rotavirus genes annotated by VIGOR4 (vigor4.gff3) from contigs.fasta.
+
+For a gene, output_<gene>.fasta holds the gene sequences within its length
+thresholds (full annotations only, unless there are none), longest first,
+and output_<gene>.ORF the F(ull)/P(artial) ORF status of each.
+
+Usage:
+    python3 ExtractGeneFromGff3.py VP7
+        one gene in the current folder
+    python3 ExtractGeneFromGff3.py --all [--workers N] [folder ...]
+        all genes of the thresholds table in one pass: vigor4.gff3 is read
+        once and indexed by gene name, and each contig is read once for all
+        its genes; with folders (default the current one) each folder is
+        done in a pool of N processes
+"""
+import argparse
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+
 from Bio import SeqIO
+from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 
-def extract_sequences(name, thresholds, orf_lengths):
-    try:
-        # Set the thresholds for the current gene, or use default values if not specified
-        lower_threshold, upper_threshold = thresholds.get(name, (100, 10000))  # Default thresholds
-        orf_length = orf_lengths.get(name, 0)  # Expected ORF length for the gene
+from fastaindex import open_fasta
+
+# Define thresholds for each gene here with lower and upper bounds
+thresholds = {
+    "VP7": (500, 1308),
+    "VP4": (1163, 3100),
+    "VP6": (596, 1588),
+    "VP1": (1632, 4352),
+    "VP2": (1319, 3588),
+    "VP3": (1253, 3340),
+    "NSP1": (740, 1988),
+    "NSP2": (500, 1268),
+    "NSP3": (500, 1256),
+    "NSP4": (500, 736),
+    "NSP5": (500, 800)
+    # Add more gene names and their thresholds as needed
+}
+
+# Define expected ORF lengths for each gene
+orf_lengths = {
+    "VP1": 3264,
+    "VP2": 2637,
+    "VP3": 2505,
+    "VP4": 2325,
+    "NSP1": 1479,
+    "VP6": 1191,
+    "NSP3": 939,
+    "NSP2": 951,
+    "VP7": 978,
+    "NSP4": 525,
+    "NSP5": 600
+}
+
+
+def read_features(gff_path, names):
+    """
+    Reads the GFF file once; returns {gene name: [columns of its lines]} in
+    file order. A line belongs to every gene whose "Name=<gene>" is in its
+    attributes, the same test as for a single gene.
+    """
+    features = {name: [] for name in names}
+    with open(gff_path) as gff_file:
+        for line in gff_file:
+            columns = line.strip().split("\t")
+            if len(columns) < 9:
+                continue
+            for name in names:
+                if "Name=" + name in columns[8]:
+                    features[name].append(columns)
+    return features
 
-        with open("vigor4.gff3") as gff_file, open("contigs.fasta") as fasta_file:
-            sequences = SeqIO.parse(fasta_file, "fasta")
-            fasta_dict = {seq.id: seq for seq in sequences}
 
-            seq_diffs = []
-            orf_statuses = []
-            has_full_entries = False  # Track if we encounter any full (non-partial) sequences
+class ContigCache:
+    """Contigs of a FASTA file, each read from it once."""
 
-            for line in gff_file:
-                columns = line.strip().split("\t")
-                if len(columns) < 9:
-                    continue
+    def __init__(self, fasta):
+        self.fasta = fasta
+        self.sequences = {}
 
-                if "Name=" + name in columns[8]:
-                    # Check if the entry is marked as "Partial"
-                    is_partial = "Partial" in columns[8]
-                    if not is_partial:
-                        has_full_entries = True  # Found a full (non-partial) entry
+    def __contains__(self, seqid):
+        return seqid in self.fasta
 
-            # Reset file reading position
-            gff_file.seek(0)
+    def fetch(self, seqid, start, end):
+        if seqid not in self.sequences:
+            self.sequences[seqid] = self.fasta.fetch(seqid)
+        return self.sequences[seqid][start:end]
 
-            for line in gff_file:
-                columns = line.strip().split("\t")
-                if len(columns) < 9:
-                    continue
+    def header(self, seqid):
+        return self.fasta.header(seqid)
 
-                if "Name=" + name in columns[8]:
-                    seqid = columns[0]
-                    start_pos = int(columns[3]) - 1  # Convert to 0-based index
-                    end_pos = int(columns[4])
-                    strand = columns[6]
-                    is_partial = "Partial" in columns[8]
-
-                    # Include sequence only if it is full, or if there are no full entries
-                    if not has_full_entries or not is_partial:
-                        if seqid in fasta_dict:
-                            full_sequence = fasta_dict[seqid]
-                            gene_sequence = full_sequence.seq[start_pos:end_pos]  # Slice to get gene sequence
-
-                            if strand == "-":
-                                gene_sequence = gene_sequence.reverse_complement()
-
-                            new_seq_record = SeqRecord(gene_sequence,
-                                                       id=full_sequence.id,
-                                                       description=full_sequence.description.replace(seqid + " ", "", 1))
-
-                            gene_length = len(gene_sequence)
-                            
-                            # Filter based on thresholds
-                            if lower_threshold <= gene_length <= upper_threshold:
-                                # Add the sequence to the list for final output
-                                seq_diffs.append(new_seq_record)
-
-                                # Determine if the gene is Full or Partial
-                                if orf_length - 3 <= gene_length <= orf_length + 3:
-                                    orf_statuses.append("F")  # Full
-                                else:
-                                    orf_statuses.append("P")  # Partial
-                        else:
-                            print(f"Sequence ID {seqid} not found in FASTA file")
-
-            # Sort sequences by length in descending order
-            seq_diffs.sort(key=lambda x: len(x.seq), reverse=True)
-
-            # Save all sequences in a single file
-            output_file = f"output_{name}.fasta"
-            with open(output_file, "w") as out_file:
-                SeqIO.write(seq_diffs, out_file, "fasta")
-
-            # Save the ORF status in a separate file
-            orf_output_file = f"output_{name}.ORF"
-            with open(orf_output_file, "w") as orf_file:
-                for status in orf_statuses:
-                    orf_file.write(f"{status}\n")
+
+def write_gene(name, features, fasta, thresholds, orf_lengths, folder="."):
+    """Writes output_<name>.fasta and output_<name>.ORF from the GFF lines of a gene."""
+    # Set the thresholds for the current gene, or use default values if not specified
+    lower_threshold, upper_threshold = thresholds.get(name, (100, 10000))  # Default thresholds
+    orf_length = orf_lengths.get(name, 0)  # Expected ORF length for the gene
+
+    seq_diffs = []
+    orf_statuses = []
+    # Track if we encounter any full (non-partial) sequences
+    has_full_entries = any("Partial" not in columns[8] for columns in features)
+
+    for columns in features:
+        seqid = columns[0]
+        start_pos = int(columns[3]) - 1  # Convert to 0-based index
+        end_pos = int(columns[4])
+        strand = columns[6]
+        is_partial = "Partial" in columns[8]
+
+        # Include sequence only if it is full, or if there are no full entries
+        if not has_full_entries or not is_partial:
+            if seqid in fasta:
+                gene_sequence = Seq(fasta.fetch(seqid, start_pos, end_pos))  # Slice to get gene sequence
+                description = fasta.header(seqid)[1:]
+
+                if strand == "-":
+                    gene_sequence = gene_sequence.reverse_complement()
+
+                new_seq_record = SeqRecord(gene_sequence,
+                                           id=seqid,
+                                           description=description.replace(seqid + " ", "", 1))
+
+                gene_length = len(gene_sequence)
+
+                # Filter based on thresholds
+                if lower_threshold <= gene_length <= upper_threshold:
+                    # Add the sequence to the list for final output
+                    seq_diffs.append(new_seq_record)
+
+                    # Determine if the gene is Full or Partial
+                    if orf_length - 3 <= gene_length <= orf_length + 3:
+                        orf_statuses.append("F")  # Full
+                    else:
+                        orf_statuses.append("P")  # Partial
+            else:
+                print(f"Sequence ID {seqid} not found in FASTA file")
+
+    # Sort sequences by length in descending order
+    seq_diffs.sort(key=lambda x: len(x.seq), reverse=True)
+
+    # Save all sequences in a single file
+    output_file = os.path.join(folder, f"output_{name}.fasta")
+    with open(output_file, "w") as out_file:
+        SeqIO.write(seq_diffs, out_file, "fasta")
+
+    # Save the ORF status in a separate file
+    orf_output_file = os.path.join(folder, f"output_{name}.ORF")
+    with open(orf_output_file, "w") as orf_file:
+        for status in orf_statuses:
+            orf_file.write(f"{status}\n")
+
+
+def extract_sequences(name, thresholds, orf_lengths):
+    try:
+        features = read_features("vigor4.gff3", [name])
+        # contigs.fasta is read through its index (contigs.fasta.fai), so only the
+        # gene ranges are read instead of parsing every contig
+        with open_fasta("contigs.fasta") as fasta:
+            write_gene(name, features[name], fasta, thresholds, orf_lengths)
 
     except FileNotFoundError:
         print("One of the files was not found. Please check the file paths.")
     except Exception as e:
         print(f"An error occurred: {e}")
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        name = sys.argv[1]
-        
-        # Define thresholds for each gene here with lower and upper bounds
-        thresholds = {
-            "VP7": (500, 1308),
-            "VP4": (1163, 3100),
-            "VP6": (596, 1588),
-            "VP1": (1632, 4352),
-            "VP2": (1319, 3588),
-            "VP3": (1253, 3340),
-            "NSP1": (740, 1988),
-            "NSP2": (500, 1268),
-            "NSP3": (500, 1256),
-            "NSP4": (500, 736),
-            "NSP5": (500, 800)
-            # Add more gene names and their thresholds as needed
-        }
-        
-        # Define expected ORF lengths for each gene
-        orf_lengths = {
-            "VP1": 3264,
-            "VP2": 2637,
-            "VP3": 2505,
-            "VP4": 2325,
-            "NSP1": 1479,
-            "VP6": 1191,
-            "NSP3": 939,
-            "NSP2": 951,
-            "VP7": 978,
-            "NSP4": 525,
-            "NSP5": 600
-        }
-        
-        extract_sequences(name, thresholds, orf_lengths)
+
+def extract_all(folder=".", thresholds=thresholds, orf_lengths=orf_lengths):
+    """Writes the output files of all genes of a folder; returns True on success."""
+    names = list(thresholds)
+    try:
+        features = read_features(os.path.join(folder, "vigor4.gff3"), names)
+        with open_fasta(os.path.join(folder, "contigs.fasta")) as fasta:
+            contigs = ContigCache(fasta)
+            for name in names:
+                write_gene(name, features[name], contigs, thresholds, orf_lengths, folder)
+        return True
+
+    except FileNotFoundError:
+        print(f"One of the files was not found in {folder}. Please check the file paths.")
+    except Exception as e:
+        print(f"An error occurred in {folder}: {e}")
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract genes annotated in vigor4.gff3 from contigs.fasta.")
+    parser.add_argument('--all', action='store_true', help="All genes of the thresholds table in one pass")
+    parser.add_argument('--workers', type=int, default=1, help="Folders done at once with --all (default 1)")
+    parser.add_argument('targets', nargs='*',
+                        help="Gene name, or with --all the sample folders (default: current folder)")
+    args = parser.parse_args()
+
+    if not args.all:
+        if not args.targets:
+            print("Please provide the gene name parameter.")
+            return 0
+        extract_sequences(args.targets[0], thresholds, orf_lengths)
+        return 0
+
+    folders = args.targets or ["."]
+    if args.workers > 1 and len(folders) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(extract_all, folders))
     else:
-        print("Please provide the gene name parameter.")
\ No newline at end of file
+        results = [extract_all(folder) for folder in folders]
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
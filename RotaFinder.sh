@@ -5,154 +5,259 @@ conda activate rotafinder
 
 SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
 LOG_FILE="$SCRIPT_DIR/log.txt"
+export LOG_FILE
+# The host comparison of all samples is run at once after the samples
+export ROTAFINDER_POOL_HOST=1
+export ROTAFINDER_RUN_ID="$(date +%Y%m%d%H%M%S)-$$"
+export ROTAFINDER_RUN_DIR="$(pwd)"
+
+# step NAME [--sample NAME] [--in FILE] [--out FILE] -- command: runs a step and
+# records its time and resources (telemetry.py)
+step() {
+  if [[ -z "$ROTAFINDER_TELEMETRY" ]]; then
+    while [[ "$1" != "--" ]]; do shift; done
+    shift
+    "$@"
+  else
+    python3 "$SCRIPT_DIR/telemetry.py" run --step "$@"
+  fi
+}
+
+# Optional parallel mode:
+#   --threads N         total CPU threads to use, runs several samples at once
+#   --memory GB         total memory to use (with --threads)
+#   --sample-memory GB  memory needed per sample (with --threads, default 16)
+#   --cache DIR         step cache, reruns skip steps whose inputs, tool version
+#                       and parameters are unchanged
+#   --batch-blast       BLAST all samples against rotadb in one multithreaded
+#                       blastn call after the assemblies (batchblast.py)
+#   --prescreen         only send contigs sharing a 28-base BLAST seed word with
+#                       rotadb to blastn (prescreen.py)
+#   --dedup             BLAST contigs with the same sequence (on either strand)
+#                       once and expand the hits to every contig (dedup.py)
+#   --fast              genotype each sample from its reads first (fastgenotype.py)
+#                       and only assemble samples without a clear G/P call
+#   --read-budget N     cap the trimmed read pairs of the work3 and work6
+#                       assemblies at N (subsample.py)
+#   --scratch DIR       run each sample in a node-local folder under DIR and copy
+#                       only the results back (scratch.py)
+#   --intermediate-dir DIR
+#                       write the intermediate reads (trimmed, deduplicated,
+#                       normalized) to local scratch or tmpfs instead of the
+#                       sample folder, uncompressed unless set otherwise
+#   --intermediate-compression gzip|fast|none
+#                       compression of the intermediate reads (sampledag.py)
+#   --adaptive          run the assemblies cheapest first and stop once every gene
+#                       is typed (adaptive.py)
+#   --watch             keep watching the current folder and process each sample
+#                       folder as soon as its reads are complete (watch.py)
+#   --blast-worker      keep rotadb and hostdb loaded in one worker process for the
+#                       run and merge the BLAST queries of parallel samples (blastworker.py)
+#   --results-db FILE   each sample adds its results to FILE when done, and the
+#                       run tables are made from it (resultsdb.py export, also
+#                       during the run)
+#   --telemetry FILE    record the time and resources of every step in FILE
+#                       (telemetry.py summary)
+#   --distributed       share the sample folders with the other workers started in
+#                       this folder, e.g. on other nodes (shard.py); the last one
+#                       writes blast_rotavar4.csv and the Labware report
+THREADS=""
+FAST=""
+BLAST_WORKER=""
+WATCH=""
+DISTRIBUTED=""
+MEMORY=""
+SAMPLE_MEMORY=""
+while [[ $# -gt 0 ]]; do
+  case "$1" in
+    --threads) THREADS="$2"; shift 2 ;;
+    --memory) MEMORY="$2"; shift 2 ;;
+    --sample-memory) SAMPLE_MEMORY="$2"; shift 2 ;;
+    --cache) mkdir -p "$2"; export ROTAFINDER_CACHE="$( cd "$2" && pwd )"; shift 2 ;;
+    --batch-blast) export ROTAFINDER_BATCH_BLAST=1; shift ;;
+    --prescreen) export ROTAFINDER_PRESCREEN=1; shift ;;
+    --dedup) export ROTAFINDER_DEDUP=1; shift ;;
+    --fast) FAST=1; shift ;;
+    --read-budget) export ROTAFINDER_READ_BUDGET="$2"; shift 2 ;;
+    --scratch) mkdir -p "$2"; export ROTAFINDER_SCRATCH="$( cd "$2" && pwd )"; shift 2 ;;
+    --intermediate-dir) mkdir -p "$2"; export ROTAFINDER_INTERMEDIATE_DIR="$( cd "$2" && pwd )"; shift 2 ;;
+    --intermediate-compression) export ROTAFINDER_INTERMEDIATE_COMPRESSION="$2"; shift 2 ;;
+    --adaptive) export ROTAFINDER_ADAPTIVE=1; shift ;;
+    --blast-worker) BLAST_WORKER=1; shift ;;
+    --watch) WATCH=1; shift ;;
+    --results-db) mkdir -p "$(dirname "$2")"; export ROTAFINDER_RESULTS_DB="$( cd "$(dirname "$2")" && pwd )/$(basename "$2")"; shift 2 ;;
+    --telemetry) mkdir -p "$(dirname "$2")"; export ROTAFINDER_TELEMETRY="$( cd "$(dirname "$2")" && pwd )/$(basename "$2")"; shift 2 ;;
+    --distributed) DISTRIBUTED=1; export ROTAFINDER_DISTRIBUTED=1; shift ;;
+    *) echo "Unknown option: $1"; exit 1 ;;
+  esac
+done
 
 START_TIME=$(date +%s)
 START_DATE=$(date +"%Y-%m-%d %H:%M:%S")
 PWD=$(pwd)
 echo "$START_DATE - Script started in $PWD" >> $LOG_FILE
 
-for dir in */ ; do
-  cd "$dir" || continue
-  folder_name=$(basename "$dir")
-
-  echo "$START_DATE - Processing folder: $folder_name" >> $LOG_FILE 
+if [[ -n "$BLAST_WORKER" ]]; then
+  # The samples send their BLAST queries to the worker (see blastcache.py) and
+  # run blastn themselves if it is not up
+  export ROTAFINDER_BLAST_WORKER="${TMPDIR:-/tmp}/rotafinder-blast-$$.sock"
+  python3 "$SCRIPT_DIR/blastworker.py" serve --socket "$ROTAFINDER_BLAST_WORKER" --threads "${THREADS:-$(nproc)}" --log "$LOG_FILE" &
+  BLAST_WORKER_PID=$!
+  trap 'kill $BLAST_WORKER_PID 2>/dev/null; wait $BLAST_WORKER_PID 2>/dev/null' EXIT
+  while [[ ! -S "$ROTAFINDER_BLAST_WORKER" ]] && kill -0 $BLAST_WORKER_PID 2>/dev/null; do
+    sleep 1
+  done
+fi
 
-  # Run Trimmomatic
-  if ! trimmomatic PE *_R1_001.fastq.gz *_R2_001.fastq.gz R1_paired.fastq.gz R1_unpaired.fastq.gz R2_paired.fastq.gz R2_unpaired.fastq.gz ILLUMINACLIP:"$SCRIPT_DIR/adapters.fa":2:30:10:1 SLIDINGWINDOW:3:15 LEADING:3 TRAILING:3 MINLEN:36; then
-    echo "Trimmomatic failed in $folder_name, skipping folder." >> $LOG_FILE
-    cd ..
-    continue
+if [[ -n "$WATCH" ]]; then
+  # Samples are processed as they arrive until the watcher is stopped
+  WATCH_OPTS="--threads ${THREADS:-$(nproc)}"
+  if [[ -n "$MEMORY" ]]; then
+    WATCH_OPTS="$WATCH_OPTS --memory $MEMORY"
   fi
-
-  # Check if Trimmomatic output files are empty
-  if [[ ! -s R1_paired.fastq.gz || ! -s R2_paired.fastq.gz ]]; then
-    echo "Trimmomatic output files are empty in $folder_name, skipping folder." >> $LOG_FILE
-    cd ..
-    continue
+  if [[ -n "$SAMPLE_MEMORY" ]]; then
+    WATCH_OPTS="$WATCH_OPTS --sample-memory $SAMPLE_MEMORY"
   fi
+  python3 "$SCRIPT_DIR/watch.py" . $WATCH_OPTS --log "$LOG_FILE"
+  exit $?
+fi
 
-  # Run Clumpify (deduplicate)
-  if ! clumpify.sh in1=R1_paired.fastq.gz in2=R2_paired.fastq.gz out1=deduped_R1.fastq.gz out2=deduped_R2.fastq.gz dedupe; then
-    echo "Clumpify failed in $folder_name, skipping folder." >> $LOG_FILE
-    cd ..
-    continue
-  fi
+if [[ -n "$DISTRIBUTED" && -n "$FAST" ]]; then
+  echo "--fast is not supported with --distributed"
+  exit 1
+fi
 
-  # Run BBnorm (target 100)
-  if ! bbnorm.sh in1=R1_paired.fastq.gz in2=R2_paired.fastq.gz out1=R1bbnorm.fastq.gz out2=R2bbnorm.fastq.gz target=100 min=5; then
-    echo "BBnorm (target=100) failed in $folder_name, skipping folder." >> $LOG_FILE
-    cd ..
-    continue
-  fi
+SAMPLE_DIRS=(*/)
+if [[ -n "$FAST" ]]; then
+  # Assembly-free genotyping of every sample; samples with an ambiguous or
+  # missing G/P call are queued for the full pipeline
+  SAMPLE_DIRS=()
+  for dir in */ ; do
+    if ! step fastgenotype --sample "$(basename "$dir")" -- python3 "$SCRIPT_DIR/fastgenotype.py" "$dir" --log "$LOG_FILE"; then
+      SAMPLE_DIRS+=("$dir")
+    fi
+  done
 
-  # Check if BBnorm output files are empty
-  if [[ ! -s R1bbnorm.fastq.gz || ! -s R2bbnorm.fastq.gz ]]; then
-    echo "BBnorm (target=100) output files are empty in $folder_name, skipping running rnaviralspades.py work1." >> $LOG_FILE
-  else
-    # Run RNAviralSPAdes (Work1)
-    if ! rnaviralspades.py -t 12 -1 R1bbnorm.fastq.gz -2 R2bbnorm.fastq.gz -o work1; then
-      echo "rnaviralspades.py (work1) failed in $folder_name" >> $LOG_FILE
+  fast_file="blast_rotafast.csv"
+  first_file=true
+  for dir in */; do
+    file_path="${dir}fast_genotyping.csv"
+    if [[ -f "$file_path" ]]; then
+      if $first_file; then
+        cat "$file_path" > "$fast_file"
+        first_file=false
+      else
+        tail -n +2 "$file_path" >> "$fast_file"
+      fi
     fi
-  fi
+  done
+  echo "$(date +"%Y-%m-%d %H:%M:%S") - Fast genotyping done, ${#SAMPLE_DIRS[@]} samples queued for assembly" >> $LOG_FILE
+fi
 
-  # Run BBnorm (target 500)
-  if ! bbnorm.sh in1=R1_paired.fastq.gz in2=R2_paired.fastq.gz out1=R1bbnorm2.fastq.gz out2=R2bbnorm2.fastq.gz target=500 min=5; then
-    echo "BBnorm (target=500) failed in $folder_name, skipping folder." >> $LOG_FILE
-    cd ..
-    continue
+if [[ -n "$DISTRIBUTED" ]]; then
+  # Claim and run samples until all are done; only the worker that gets the
+  # aggregation goes on with the steps after the samples
+  SHARD_OPTS="--threads ${THREADS:-$(nproc)}"
+  if [[ -n "$MEMORY" ]]; then
+    SHARD_OPTS="$SHARD_OPTS --memory $MEMORY"
   fi
-
-  # Check if BBnorm output files are empty
-  if [[ ! -s R1bbnorm2.fastq.gz || ! -s R2bbnorm2.fastq.gz ]]; then
-    echo "BBnorm (target=500) output files are empty in $folder_name, skipping running rnaviralspades.py work2." >> $LOG_FILE
-  else
-    # Run RNAviralSPAdes (Work2)
-    if ! rnaviralspades.py -t 12 -1 R1bbnorm2.fastq.gz -2 R2bbnorm2.fastq.gz -o work2; then
-      echo "rnaviralspades.py (work2) failed in $folder_name" >> $LOG_FILE
-    fi
+  if [[ -n "$SAMPLE_MEMORY" ]]; then
+    SHARD_OPTS="$SHARD_OPTS --sample-memory $SAMPLE_MEMORY"
   fi
-
-  # Check if paired files from Trimmomatic are empty before running remaining analysis
-  if [[ -s R1_paired.fastq.gz && -s R2_paired.fastq.gz ]]; then
-    if ! rnaviralspades.py -t 12 -1 R1_paired.fastq.gz -2 R2_paired.fastq.gz -o work3; then
-      echo "rnaviralspades.py (work3) failed in $folder_name" >> $LOG_FILE
-    fi
-    
-    if ! spades.py -t 12 --isolate --cov-cutoff auto -1 R1_paired.fastq.gz -2 R2_paired.fastq.gz -o work6; then
-      echo "SPAdes (work6) failed in $folder_name" >> $LOG_FILE
-    fi
-  else
-    echo "Paired files are empty in $folder_name, skipping rnaviralspades.py work3 and SPAdes work6." >> $LOG_FILE
+  # results.sqlite cannot be shared between nodes: the samples do not add
+  # their results, the aggregating worker adds them all at the export
+  ROTAFINDER_RESULTS_DB= python3 "$SCRIPT_DIR/shard.py" worker $SHARD_OPTS --log "$LOG_FILE" "${SAMPLE_DIRS[@]}"
+  SHARD_STATUS=$?
+  # 3 is shard.py NOT_AGGREGATOR; any other failure is the worker's own
+  if [[ $SHARD_STATUS -eq 3 ]]; then
+    echo "$(date +"%Y-%m-%d %H:%M:%S") - Script ended in $PWD - aggregation left to another worker" >> $LOG_FILE
+    exit 0
+  elif [[ $SHARD_STATUS -ne 0 ]]; then
+    echo "$(date +"%Y-%m-%d %H:%M:%S") - shard.py worker failed in $PWD with status $SHARD_STATUS" >> $LOG_FILE
+    exit $SHARD_STATUS
   fi
-
-  # Check if clumpify output files are empty
-  if [[ ! -s deduped_R1.fastq.gz || ! -s deduped_R2.fastq.gz ]]; then
-    echo "Clumpify output files are empty in $folder_name, skipping running rnaviralspades.py work7." >> $LOG_FILE
-  else
-    # Run RNAviralSPAdes (Work7)
-    if ! rnaviralspades.py -t 12 -1 deduped_R1.fastq.gz -2 deduped_R2.fastq.gz -o work7; then
-      echo "rnaviralspades.py (work7) failed in $folder_name" >> $LOG_FILE
-    fi
+elif [[ -n "$THREADS" && ${#SAMPLE_DIRS[@]} -gt 0 ]]; then
+  # Run several samples at once within the thread/memory budget
+  SCHEDULER_OPTS="--threads $THREADS"
+  if [[ -n "$MEMORY" ]]; then
+    SCHEDULER_OPTS="$SCHEDULER_OPTS --memory $MEMORY"
   fi
-
-  # Run CollectFasta.py
-  if ! python3 "$SCRIPT_DIR/CollectFasta.py"; then
-    echo "CollectFasta.py failed in $folder_name" >> $LOG_FILE
-    cd ..
-    continue
+  if [[ -n "$SAMPLE_MEMORY" ]]; then
+    SCHEDULER_OPTS="$SCHEDULER_OPTS --sample-memory $SAMPLE_MEMORY"
   fi
+  step scheduler --sample run -- python3 "$SCRIPT_DIR/scheduler.py" $SCHEDULER_OPTS --log "$LOG_FILE" "${SAMPLE_DIRS[@]}"
+else
+  for dir in "${SAMPLE_DIRS[@]}" ; do
+    step sample --sample "$(basename "$dir")" -- bash "$SCRIPT_DIR/RotaFinderSample.sh" "$dir"
+  done
+fi
 
-  # Run Vigor4 using Docker
-  #set -e
-  #if ! docker run -u "$(id -u)":"$(id -g)" -v "$(pwd)":/working_dir -w /working_dir -m 64g --cpus="8" vigor4 bash -c "/home/vigor4/vigor4/bin/vigor4 -i contigs500.fasta -o vigor4 -d rtva"; then
-  #  echo "Vigor4 failed in $folder_name" >> $LOG_FILE
-  #  cd ..
-  #  exit
-  #fi
-  #set +e
-
-  # Run additional scripts
-  #if ! bash "$SCRIPT_DIR/rotavarblast_sub.sh"; then
-  #  echo "rotavarblast_sub.sh failed in $folder_name" >> $LOG_FILE
-  #  cd ..
-  #  continue
-  #fi
-  
-  if ! bash "$SCRIPT_DIR/rotablast2.sh"; then
-    echo "rotablast.sh failed in $folder_name" >> $LOG_FILE
-  fi
+if [[ -n "$ROTAFINDER_BATCH_BLAST" ]]; then
+  # One rotadb BLAST for all samples, then the post-BLAST steps of each sample
+  step batchblast --sample run -- python3 "$SCRIPT_DIR/batchblast.py" --threads "${THREADS:-$(nproc)}" --log "$LOG_FILE" */
+  for dir in */ ; do
+    if [[ -f "${dir}contigs500_COV.fasta" ]]; then
+      if ! (cd "$dir" && bash "$SCRIPT_DIR/rotablast2.sh" post); then
+        echo "rotablast.sh failed in $(basename "$dir")" >> $LOG_FILE
+      fi
+    fi
+  done
+fi
 
-  cd ..
-done
+# Host comparison of the selected ORFs of all samples in one blastn call;
+# ORFs seen in earlier runs are taken from the BLAST cache
+step hostblast --sample run -- python3 "$SCRIPT_DIR/hostblast.py" --threads "${THREADS:-$(nproc)}" --log "$LOG_FILE" */
 
 output_file="blast_rotavar4.csv"
-first_file=true
-
-for dir in */; do
-  file_path="${dir}blast_rota_genotyping4_updated.csv"
-  if [[ -f "$file_path" ]]; then
-    if $first_file; then
-      cat "$file_path" > "$output_file"
-      first_file=false
-    else
-      tail -n +2 "$file_path" >> "$output_file"
+
+if [[ -n "$ROTAFINDER_RESULTS_DB" ]] && step export --sample run --out "$output_file" -- \
+    python3 "$SCRIPT_DIR/resultsdb.py" export --output "$output_file" */; then
+  :
+else
+  first_file=true
+  for dir in */; do
+    file_path="${dir}blast_rota_genotyping4_updated.csv"
+    if [[ -f "$file_path" ]]; then
+      if $first_file; then
+        cat "$file_path" > "$output_file"
+        first_file=false
+      else
+        tail -n +2 "$file_path" >> "$output_file"
+      fi
     fi
-  fi
-done
+  done
+fi
 
+if [[ -n "$ROTAFINDER_ADAPTIVE" ]]; then
+  # Assemblies run and skipped per sample, to compare CPU hours between runs
+  first_file=true
+  for dir in */; do
+    file_path="${dir}adaptive_assemblies.csv"
+    if [[ -f "$file_path" ]]; then
+      if $first_file; then
+        cat "$file_path" > adaptive_assemblies.csv
+        first_file=false
+      else
+        tail -n +2 "$file_path" >> adaptive_assemblies.csv
+      fi
+    fi
+  done
+fi
 
 # Run CollectFasta.py
-if ! python3 "$SCRIPT_DIR/labware.py"; then
+if ! step labware --sample run --in blast_rotavar4.csv -- python3 "$SCRIPT_DIR/labware.py"; then
   echo "labware.py failed in $folder_name" >> $LOG_FILE
   cd ..
   continue
 fi
 
-
+if [[ -n "$DISTRIBUTED" ]]; then
+  python3 "$SCRIPT_DIR/shard.py" finish
+fi
 
 END_TIME=$(date +%s)
 ELAPSED_TIME=$(($END_TIME - $START_TIME))
-FOLDER_COUNT=$(find . -maxdepth 1 -type d | wc -l)
+FOLDER_COUNT=$(find . -maxdepth 1 -type d -not -name ".?*" | wc -l)
 END_DATE=$(date +"%Y-%m-%d %H:%M:%S")
 
 echo "$END_DATE - Script ended in $PWD - Time spent: $ELAPSED_TIME seconds - Folders processed: $(($FOLDER_COUNT - 1))" >> $LOG_FILE
@@ -0,0 +1,35 @@
+#!/bin/bash
+
+# Runs the RotaFinder steps for a single sample folder.
+# Usage: bash RotaFinderSample.sh <sample folder>
+#
+# The steps are run as a dependency graph by sampledag.py, so independent
+# normalizations and assemblies run at the same time within the thread budget.
+#
+# Optional environment:
+#   THREADS         thread budget of the sample (default 12)
+#   SPADES_THREADS  threads of each SPAdes run (default 12, capped at THREADS)
+#   MEMORY_GB       memory budget of the sample in GB, shared by concurrent SPAdes runs
+#   LOG_FILE        log file for status messages (default log.txt next to this script)
+
+source ~/miniconda3/etc/profile.d/conda.sh
+conda activate rotafinder
+
+SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
+LOG_FILE="${LOG_FILE:-$SCRIPT_DIR/log.txt}"
+THREADS="${THREADS:-12}"
+SPADES_THREADS="${SPADES_THREADS:-12}"
+
+DAG_OPTS="--threads $THREADS --spades-threads $SPADES_THREADS"
+if [[ -n "$MEMORY_GB" ]]; then
+  DAG_OPTS="$DAG_OPTS --memory $MEMORY_GB"
+fi
+
+dir="$1"
+cd "$dir" || exit 1
+folder_name=$(basename "$dir")
+
+START_DATE=$(date +"%Y-%m-%d %H:%M:%S")
+echo "$START_DATE - Processing folder: $folder_name" >> $LOG_FILE
+
+python3 "$SCRIPT_DIR/sampledag.py" $DAG_OPTS --log "$LOG_FILE"
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Adaptive assembly escalation for sampledag.py.
+
+Instead of running all five assemblies, the assemblies are run in tiers,
+cheapest first (ASSEMBLY_TIERS). After each tier the contigs of the
+assemblies run so far are collected (CollectFasta.collect), searched
+against rotadb through the BLAST cache (blastcache.py, same options as
+rotablast2.sh, so the final rotadb BLAST takes them from the cache) and
+evaluated and counted as in postblast.py. A gene counts as typed when
+genotype4.py would call a single genotype for it and that genotype has at
+least one full-length, high-coverage hit. The next tier is only started
+while a gene of gene_order is still X, "?" or partial-only.
+
+The assemblies that were run and skipped, their CPU hours (run time times
+threads) and the genes still open at the last check are written to
+adaptive_assemblies.csv in the sample folder.
+"""
+import csv
+import os
+
+import blastcache
+import CollectFasta
+from batchblast import BLAST_ARGS, BLAST_DB
+from postblast import call_genotype, evaluate_hits, gene_order, summarize
+
+# Set by RotaFinder.sh --adaptive
+ADAPTIVE_ENV = 'ROTAFINDER_ADAPTIVE'
+
+# Assemblies in the order they are tried: BBnorm 100x reads first, then the
+# Clumpify and BBnorm 500x reads, then all trimmed reads
+ASSEMBLY_TIERS = [['work1'], ['work7', 'work2'], ['work3', 'work6']]
+
+RECORD_FILE = "adaptive_assemblies.csv"
+RECORD_HEADER = ['Folder Name', 'Assemblies Run', 'Assemblies Skipped', 'Assembly CPU Hours', 'Open Genes']
+
+
+def enabled():
+    return bool(os.environ.get(ADAPTIVE_ENV))
+
+
+def open_genes(assemblies, threads=1, db=BLAST_DB, cache_path=None):
+    """
+    Collects the contigs of the given assemblies and returns the genes of
+    gene_order that are not typed yet (all of them if the BLAST fails).
+    """
+    CollectFasta.collect({work: CollectFasta.folder_text[work] for work in assemblies})
+    queries = blastcache.read_queries(CollectFasta.output_file3)
+    if not queries:
+        return list(gene_order)
+
+    cache = blastcache.open_cache(cache_path or blastcache.default_cache_path())
+    try:
+        lines, _ = blastcache.blast_queries(queries, db, BLAST_ARGS, threads, cache)
+    finally:
+        if cache:
+            cache.close()
+    if lines is None:
+        return list(gene_order)
+
+    hits = [line.split('\t') for query_lines in lines for line in query_lines]
+    genotype_counts = summarize(evaluate_hits(hits))
+    genotype_string, _ = call_genotype(genotype_counts)
+    calls = genotype_string.split('-') if genotype_string else []
+
+    untyped = []
+    for i, gene in enumerate(gene_order):
+        call = calls[i] if i < len(calls) else f"{gene}X"
+        if call.endswith('X') or call.endswith('?'):
+            untyped.append(gene)
+            continue
+        counts = genotype_counts.get(gene + ''.join(char for char in call if char.isdigit()))
+        if not counts or counts['high_cov_full'] == 0:
+            untyped.append(gene)
+    return untyped
+
+
+def cpu_hours(timings, assemblies):
+    """CPU hours of the assemblies from the {step: (seconds, threads)} of sampledag.run_graph."""
+    return sum(seconds * threads for name, (seconds, threads) in timings.items() if name in assemblies) / 3600
+
+
+def write_record(folder_name, run, skipped, hours, untyped, path=RECORD_FILE):
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(RECORD_HEADER)
+        writer.writerow([folder_name, ' '.join(run), ' '.join(skipped), f"{hours:.2f}",
+                         ' '.join(untyped) if untyped else 'None'])
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Runs the rotadb BLAST of all sample folders in one blastn call.
+
+The queries of all samples (contigs500_COV.fasta,
+contigs500_COV_prescreen.fasta with --prescreen or
+contigs500_COV_unique.fasta with --dedup) are looked up in the BLAST
+cache (blastcache.py) and the contigs not seen before are sent to one
+multithreaded blastn call, so program start-up and database loading happen
+once for the run and contigs shared by samples are searched once. The hits
+are written back to blast_rota2.txt of each folder with the original contig
+IDs (blast_rota2_unique.txt with --dedup, expanded by rotablast2.sh post).
+E-values are computed per query, so the files hold the same hits as a
+blastn run per folder.
+
+Usage (from the run folder, after the samples are assembled):
+    python3 batchblast.py --threads 32 sample1/ sample2/ ...
+"""
+import argparse
+import os
+import sys
+
+import blastcache
+import dedup
+from prescreen import query_name
+from scheduler import log_message
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BLAST_OUTPUT = "blast_rota2.txt"
+BLAST_DB = os.path.join(SCRIPT_DIR, '241130_rotadb')
+BLAST_ARGS = [
+    '-outfmt', "6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore sstrand slen",
+    '-max_target_seqs', '1', '-strand', 'both',
+]
+
+
+def run_batch(folders, threads, db=BLAST_DB, cache_path=None, log_file=None):
+    """Writes blast_rota2.txt in every folder with a query file; returns 0 on success."""
+    query = dedup.UNIQUE_FASTA if dedup.enabled() else query_name()
+    output = dedup.UNIQUE_OUTPUT if dedup.enabled() else BLAST_OUTPUT
+    queries = []
+    ranges = []
+    for folder in folders:
+        path = os.path.join(folder, query)
+        if not os.path.isfile(path):
+            continue
+        start = len(queries)
+        queries.extend(blastcache.read_queries(path))
+        # An empty query file gets an empty hit file, as a blastn run per
+        # folder gives
+        ranges.append((folder, start, len(queries)))
+    if not ranges:
+        return 0
+
+    cache = blastcache.open_cache(cache_path or blastcache.default_cache_path())
+    try:
+        lines, stats = blastcache.blast_queries(queries, db, BLAST_ARGS, threads, cache)
+    finally:
+        if cache:
+            cache.close()
+    if lines is None:
+        log_message(log_file, "Batch BLAST failed")
+        return 1
+
+    for folder, start, end in ranges:
+        blastcache.write_lines(os.path.join(folder, output), lines[start:end])
+
+    log_message(log_file, f"Batch BLAST of {stats['queries']} contigs in {len(ranges)} folders: "
+                          f"{stats['distinct'] - stats['searched']} of {stats['distinct']} distinct "
+                          f"sequences from cache, {stats['searched']} sent to BLAST with {threads} threads")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BLAST all sample folders against rotadb in one blastn call.")
+    parser.add_argument('folders', nargs='+', help="Sample folders")
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help="blastn threads (default: all CPUs)")
+    parser.add_argument('--db', default=BLAST_DB, help="BLAST database (default 241130_rotadb)")
+    parser.add_argument('--blast-cache', default=None, help="BLAST cache file (see blastcache.py)")
+    parser.add_argument('--log', default=None, help="Log file")
+    args = parser.parse_args()
+
+    log_file = os.path.abspath(args.log) if args.log else None
+    return run_batch(args.folders, args.threads, os.path.abspath(args.db), args.blast_cache, log_file)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
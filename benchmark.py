@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Synthetic benchmark of the post-assembly stages.
+
+Builds a sample folder per scale without any patient data: workN/contigs.fasta
+files as SPAdes writes them (NODE_<n>_length_<l>_cov_<c> headers, 60-base
+lines) and the blastn tabular output of contigs500_COV.fasta against rotadb
+(blast_rota2.txt, the columns of rotablast2.sh). A share of the contigs are
+segments of 241130_rotadb references, whole or partial, on either strand,
+with substitutions down to a chosen identity and short flanks; their hits
+are computed from the mutations. The rest is random host-like background
+without hits. Contig lengths and coverages span the length and coverage
+cutoffs so the filters have work to do.
+
+The stages are then run one after the other in the folder, each as its own
+process like in rotablast2.sh, and timed with wait4() for wall time, CPU
+time and peak RSS:
+
+    collect           CollectFasta.py
+    covfilter         covfilter.py
+    evaluate          evaluate3.py
+    summarize         summarize3.py
+    genotype          genotype4.py
+    update            update_blast_data.py
+    selected_contigs  selected_contigs.py
+    selected_ORFs     selected_ORFs.py
+    postblast         postblast.py (checked against the files of the stages above)
+
+The generator is seeded, so a scale always gives the same folder, and
+the stages run with a fixed PYTHONHASHSEED, so their output is the same
+from run to run (selected_contigs.fasta and selected_ORFs.fasta follow the
+set order of the genotypes otherwise). The
+SHA-256 of every output file can be saved as a reference (--save-reference)
+and later runs, e.g. after a speedup, are checked against it (--reference).
+
+Usage:
+    python3 benchmark.py [--scales 1 10 100] [--contigs 100] [--seed 1] [--dir benchmark]
+                         [--reference benchmark_reference.json [--save-reference]] [--keep]
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from CollectFasta import MIN_COVERAGE, MIN_LENGTH, folder_text
+from postblast import gene_order
+from rotadb import ROTADB, BlastDb
+from telemetry import make_record
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Contigs per assembly folder at scale 1
+CONTIGS = 100
+SCALES = [1, 10, 100]
+SEED = 1
+
+ROTA_FRACTION = 0.3
+PARTIAL_FRACTION = 0.3
+IDENTITIES = [100, 99, 97, 93, 88, 82, 76]
+MAX_FLANK = 30
+# Background contig lengths and coverages, drawn log-uniformly
+BACKGROUND_LENGTH = (200, 5000)
+COVERAGE = (1, 5000)
+GC = 0.45
+LINE_WIDTH = 60
+
+BLAST_OUTPUT = 'blast_rota2.txt'
+RESULTS_FILE = 'benchmark.csv'
+
+POSTBLAST_OUTPUTS = [
+    'blast_rota2.csv', 'blast_rota_results2.csv', 'blast_rota_genotyping4.csv',
+    'blast_rota_genotyping4_updated.csv', 'selected_contigs.fasta', 'selected_ORFs.fasta',
+]
+
+# Stage name, script, input files, output files
+STAGES = [
+    ('collect', 'CollectFasta.py', [f'{folder}/contigs.fasta' for folder in folder_text],
+     ['contigs.fasta', 'contigs500.fasta', 'contigs500_COV.fasta']),
+    ('covfilter', 'covfilter.py', ['contigs500.fasta'], ['contigs500_COV.fasta']),
+    ('evaluate', 'evaluate3.py', [BLAST_OUTPUT], ['blast_rota2.csv']),
+    ('summarize', 'summarize3.py', ['blast_rota2.csv'], ['blast_rota_results2.csv']),
+    ('genotype', 'genotype4.py', ['blast_rota_results2.csv'], ['blast_rota_genotyping4.csv']),
+    ('update', 'update_blast_data.py', ['blast_rota2.csv', 'blast_rota_genotyping4.csv'],
+     ['blast_rota_genotyping4_updated.csv']),
+    ('selected_contigs', 'selected_contigs.py', ['blast_rota2.csv', 'contigs500_COV.fasta'],
+     ['selected_contigs.fasta']),
+    ('selected_ORFs', 'selected_ORFs.py', ['blast_rota2.csv', 'contigs500_COV.fasta'],
+     ['selected_ORFs.fasta']),
+    ('postblast', 'postblast.py', [BLAST_OUTPUT, 'contigs500_COV.fasta'], POSTBLAST_OUTPUTS),
+]
+
+RESULT_COLUMNS = ['scale', 'contigs', 'stage', 'wall_seconds', 'cpu_seconds', 'peak_rss_mb',
+                  'input_bytes', 'output_bytes', 'exit_status', 'matches_reference']
+
+# The selection scripts write the genotypes in set order, which follows the
+# string hashes of the process; a fixed hash seed makes the files comparable
+STAGE_ENV = {**os.environ, 'PYTHONHASHSEED': '0'}
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def load_references(db_path):
+    """The rotadb references of the genes in the report: (sseqid, 2-bit codes)."""
+    db = BlastDb(db_path)
+    references = []
+    for oid in range(len(db)):
+        sseqid = db.defline(oid).split()[0]
+        if sseqid[:1] in gene_order and '|' in sseqid:
+            references.append((sseqid, db.codes(oid)))
+    return references
+
+
+def log_uniform(rng, low, high):
+    return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+
+
+def background(rng, length):
+    probabilities = [(1 - GC) / 2, GC / 2, GC / 2, (1 - GC) / 2]
+    return rng.choice(4, size=length, p=probabilities).astype(np.uint8)
+
+
+def mutate(rng, codes, identity):
+    """Substitutes bases at a rate of 100 - identity percent; returns (codes, mismatches)."""
+    codes = codes.copy()
+    changed = rng.random(len(codes)) < (100 - identity) / 100
+    codes[changed] = (codes[changed] + rng.integers(1, 4, size=int(changed.sum()))) % 4
+    return codes, int(changed.sum())
+
+
+def rota_contig(rng, references, identities):
+    """A contig from a rotadb segment and its blastn hit (without qseqid)."""
+    sseqid, reference = references[rng.integers(len(references))]
+    slen = len(reference)
+    start, end = 0, slen
+    if rng.random() < PARTIAL_FRACTION and slen > 300:
+        length = int(rng.integers(300, slen))
+        start = int(rng.integers(0, slen - length + 1))
+        end = start + length
+    segment, mismatches = mutate(rng, reference[start:end], identities[rng.integers(len(identities))])
+    left = background(rng, int(rng.integers(0, MAX_FLANK + 1)))
+    right = background(rng, int(rng.integers(0, MAX_FLANK + 1)))
+    codes = np.concatenate([left, segment, right])
+
+    length = end - start
+    if rng.random() < 0.5:
+        qstart, qend, sstart, send, strand = len(left) + 1, len(left) + length, start + 1, end, 'plus'
+    else:
+        codes = 3 - codes[::-1]
+        qstart, qend, sstart, send, strand = len(right) + 1, len(right) + length, end, start + 1, 'minus'
+    matches = length - mismatches
+    hit = [sseqid, f"{100 * matches / length:.3f}", length, mismatches, 0, qstart, qend, sstart, send,
+           '0.0', round(1.85 * matches - 2.5 * mismatches), strand, slen]
+    return codes, hit
+
+
+def write_contig(f, header, codes):
+    sequence = BASES[codes].tobytes().decode('ascii')
+    f.write(header + '\n')
+    for i in range(0, len(sequence), LINE_WIDTH):
+        f.write(sequence[i:i + LINE_WIDTH] + '\n')
+
+
+def generate(directory, references, contigs, seed, identities=IDENTITIES):
+    """Writes the workN/contigs.fasta files and blast_rota2.txt of a synthetic sample."""
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(directory, BLAST_OUTPUT), 'w') as blast:
+        for folder, text in folder_text.items():
+            os.makedirs(os.path.join(directory, folder), exist_ok=True)
+            with open(os.path.join(directory, folder, 'contigs.fasta'), 'w') as f:
+                for node in range(1, contigs + 1):
+                    hit = None
+                    if rng.random() < ROTA_FRACTION:
+                        codes, hit = rota_contig(rng, references, identities)
+                    else:
+                        codes = background(rng, int(log_uniform(rng, *BACKGROUND_LENGTH)))
+                    coverage = log_uniform(rng, *COVERAGE)
+                    header = f">NODE_{node}_length_{len(codes)}_cov_{coverage:.6f}"
+                    write_contig(f, header, codes)
+                    # Only contigs500_COV.fasta is BLASTed, with the assembly tag CollectFasta.py adds
+                    if hit and len(codes) >= MIN_LENGTH and coverage >= MIN_COVERAGE:
+                        blast.write('\t'.join(str(value) for value in [header[1:] + text] + hit) + '\n')
+
+
+def paths(directory, names):
+    return [os.path.join(directory, name) for name in names]
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def run_stage(directory, label, name, script, inputs, outputs):
+    """Runs one stage in the folder; returns its record (see telemetry.make_record)."""
+    start = time.time()
+    with open(os.path.join(directory, f'{name}.out'), 'w') as log:
+        proc = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, script)], cwd=directory,
+                                env=STAGE_ENV, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(proc.pid, 0)
+    return make_record(label, name, start, time.time(), rusage, os.waitstatus_to_exitcode(status),
+                       paths(directory, inputs), paths(directory, outputs))
+
+
+def run_scale(base, references, scale, contigs, seed, reference):
+    """Generates and runs one scale; returns (result rows, output hashes, mismatches)."""
+    label = f'{scale}x'
+    directory = os.path.join(base, label)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    # The scale is part of the seed, so every scale is its own sample
+    generate(directory, references, contigs * scale, [seed, scale])
+
+    rows = []
+    hashes = {}
+    mismatches = []
+    legacy = {}
+    for name, script, inputs, outputs in STAGES:
+        record = run_stage(directory, label, name, script, inputs, outputs)
+        matches = True
+        for output in outputs:
+            key = f'{name}:{output}'
+            hashes[key] = sha256(os.path.join(directory, output))
+            expected = reference.get(key) if reference else None
+            if name == 'postblast':
+                # postblast.py writes the same files as the separate scripts
+                expected = legacy.get(output) if expected is None else expected
+                if hashes[key] != legacy.get(output):
+                    mismatches.append(f"{label} postblast: {output} differs from the separate scripts")
+                    matches = False
+            else:
+                legacy[output] = hashes[key]
+            if expected is not None and hashes[key] != expected:
+                mismatches.append(f"{label} {name}: {output} differs from the reference")
+                matches = False
+        if record['exit_status'] != 0:
+            mismatches.append(f"{label} {name}: exit status {record['exit_status']} (see {name}.out)")
+        rows.append({
+            'scale': label, 'contigs': contigs * scale * len(folder_text), 'stage': name,
+            **{column: record[column] for column in RESULT_COLUMNS[3:9]},
+            'matches_reference': 'yes' if matches else 'no',
+        })
+    return rows, hashes, mismatches
+
+
+def print_table(rows):
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in RESULT_COLUMNS}
+    print('  '.join(column.ljust(widths[column]) for column in RESULT_COLUMNS))
+    for row in rows:
+        print('  '.join(str(row[column]).ljust(widths[column]) for column in RESULT_COLUMNS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the post-assembly stages on synthetic samples.")
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES,
+                        help=f"Contig volumes to run (default {' '.join(map(str, SCALES))})")
+    parser.add_argument('--contigs', type=int, default=CONTIGS,
+                        help=f"Contigs per assembly folder at scale 1 (default {CONTIGS})")
+    parser.add_argument('--seed', type=int, default=SEED, help=f"Random seed (default {SEED})")
+    parser.add_argument('--db', default=ROTADB, help="BLAST database (default 241130_rotadb)")
+    parser.add_argument('--dir', default='benchmark', help="Folder for the synthetic samples (default benchmark)")
+    parser.add_argument('--reference', default=None, help="JSON file with the output hashes of a reference run")
+    parser.add_argument('--save-reference', action='store_true', help="Write the output hashes to --reference")
+    parser.add_argument('--keep', action='store_true', help="Keep the synthetic sample folders")
+    args = parser.parse_args()
+    if args.save_reference and not args.reference:
+        parser.error("--save-reference needs --reference")
+
+    reference = {}
+    if args.reference and not args.save_reference:
+        with open(args.reference, 'r') as f:
+            reference = json.load(f)
+        if reference.get('seed') != args.seed or reference.get('contigs') != args.contigs:
+            parser.error(f"{args.reference} was made with --seed {reference.get('seed')} "
+                         f"--contigs {reference.get('contigs')}")
+
+    references = load_references(args.db)
+    os.makedirs(args.dir, exist_ok=True)
+    rows = []
+    hashes = {}
+    mismatches = []
+    for scale in args.scales:
+        scale_rows, hashes[f'{scale}x'], scale_mismatches = run_scale(
+            args.dir, references, scale, args.contigs, args.seed, reference.get('hashes', {}).get(f'{scale}x'))
+        rows.extend(scale_rows)
+        mismatches.extend(scale_mismatches)
+        if not args.keep:
+            shutil.rmtree(os.path.join(args.dir, f'{scale}x'), ignore_errors=True)
+
+    with open(os.path.join(args.dir, RESULTS_FILE), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print_table(rows)
+
+    if args.save_reference:
+        # Scales not run this time are kept from an old file of the same settings
+        saved = {}
+        if os.path.exists(args.reference):
+            with open(args.reference, 'r') as f:
+                old = json.load(f)
+            if old.get('seed') == args.seed and old.get('contigs') == args.contigs:
+                saved = old.get('hashes', {})
+        saved.update(hashes)
+        with open(args.reference, 'w') as f:
+            json.dump({'seed': args.seed, 'contigs': args.contigs, 'hashes': saved}, f, indent=1, sort_keys=True)
+        print(f"Reference output hashes written to {args.reference}")
+
+    for mismatch in mismatches:
+        print(mismatch)
+    if args.reference and not args.save_reference:
+        missing = [f'{scale}x' for scale in args.scales if f'{scale}x' not in reference.get('hashes', {})]
+        if missing:
+            print(f"No reference for {', '.join(missing)}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
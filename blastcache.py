@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Persistent cache of blastn results per query sequence.
+
+BLAST results of a query only depend on its sequence, the database and the
+search options, so the tabular hit lines (without the qseqid column) are
+stored in an SQLite file keyed by
+
+    (database version, blastn options and version, sha256 of the sequence)
+
+Queries whose sequence was searched before are answered from the cache;
+only the others are written to a temporary query file and sent to one
+blastn call, or to the BLAST worker ($ROTAFINDER_BLAST_WORKER, see
+blastworker.py) when one is running. Identical sequences are searched
+once. The qseqid of each query is put back into its hit lines, so the
+output is the same as from a blastn run on the original query file.
+
+The database version is the database name and a hash of its .nin (or .nal)
+file, which holds the title, date and size of the database, so a rebuilt
+database gets new entries. The number of sequences answered from the cache
+and sent to blastn is counted per database version.
+
+Command line use:
+    python3 blastcache.py run --db 241130_rotadb --query contigs500_COV.fasta \
+        --out blast_rota2.txt -- -outfmt "6 ..." -max_target_seqs 1 -strand both
+    python3 blastcache.py stats [--db 241130_rotadb ...]
+    python3 blastcache.py evict --db 241130_rotadb   # remove results of older builds
+
+Cache file: --blast-cache, $ROTAFINDER_BLAST_CACHE, blastcache.sqlite in the
+step cache folder ($ROTAFINDER_CACHE) or else blastcache.sqlite next to the
+scripts. With RotaFinder.sh --distributed the default file is one per node
+(blastcache-<node>.sqlite, see shard.py) with the rollback journal instead
+of WAL.
+"""
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import shard
+import stepcache
+from scheduler import log_message
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CACHE_FILE_ENV = 'ROTAFINDER_BLAST_CACHE'
+CACHE_FILE_NAME = 'blastcache.sqlite'
+
+# Socket of a running BLAST worker (blastworker.py, RotaFinder.sh --blast-worker)
+WORKER_ENV = 'ROTAFINDER_BLAST_WORKER'
+# Seconds to wait for the worker's answer before running blastn here
+WORKER_TIMEOUT = 3600
+
+# Number of keys per SELECT ... IN (...) query
+LOOKUP_CHUNK = 500
+
+
+def default_cache_path():
+    if os.environ.get(CACHE_FILE_ENV):
+        return os.environ[CACHE_FILE_ENV]
+    # One file per node with --distributed
+    if stepcache.default_cache_dir():
+        return shard.node_path(os.path.join(stepcache.default_cache_dir(), CACHE_FILE_NAME))
+    return shard.node_path(os.path.join(SCRIPT_DIR, CACHE_FILE_NAME))
+
+
+def sequence_hash(sequence):
+    # blastn treats lower case bases like upper case ones (no -lcase_masking)
+    return hashlib.sha256(sequence.upper().encode()).hexdigest()
+
+
+def db_version(db_prefix):
+    """Returns '<database name>:<hash of its index file>'."""
+    for extension in ('.nin', '.nal'):
+        path = db_prefix + extension
+        if os.path.exists(path):
+            return f"{os.path.basename(db_prefix)}:{stepcache.file_hash(path)[:16]}"
+    raise FileNotFoundError(f"BLAST database not found: {db_prefix}")
+
+
+def search_params(blast_args):
+    """Options and blastn version that results depend on (threads are left out)."""
+    return json.dumps({
+        'args': stepcache.key_params(blast_args),
+        'blastn': stepcache.tool_version(['blastn', '-version']),
+    }, sort_keys=True)
+
+
+class BlastCache:
+    """SQLite file with the hit lines of searched sequences."""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Several samples may use the cache at once
+        self.conn = sqlite3.connect(path, timeout=600)
+        self.conn.execute(f'PRAGMA journal_mode={shard.sqlite_journal_mode()}')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            ' db TEXT NOT NULL, params TEXT NOT NULL, seq_hash TEXT NOT NULL,'
+            ' hits TEXT NOT NULL, created REAL NOT NULL,'
+            ' PRIMARY KEY (db, params, seq_hash))'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS usage ('
+            ' db TEXT PRIMARY KEY, hits INTEGER NOT NULL, misses INTEGER NOT NULL)'
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, db, params, hashes):
+        """
+        Returns {seq_hash: hit lines} for the hashes found in the cache; a
+        cache that cannot be read finds nothing, so the sample still runs.
+        """
+        hashes = list(hashes)
+        found = {}
+        try:
+            for i in range(0, len(hashes), LOOKUP_CHUNK):
+                chunk = hashes[i:i + LOOKUP_CHUNK]
+                rows = self.conn.execute(
+                    f"SELECT seq_hash, hits FROM results WHERE db = ? AND params = ? "
+                    f"AND seq_hash IN ({','.join('?' * len(chunk))})",
+                    [db, params] + chunk)
+                for seq_hash, hits in rows:
+                    found[seq_hash] = hits.split('\n') if hits else []
+        except sqlite3.Error as e:
+            print(f"Warning: cannot read BLAST cache {self.path} ({e}); searching every sequence.")
+            return {}
+        return found
+
+    def put(self, db, params, results):
+        """Stores {seq_hash: hit lines}; results that cannot be stored are only lost for later runs."""
+        now = time.time()
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO results (db, params, seq_hash, hits, created) VALUES (?, ?, ?, ?, ?)',
+                    [(db, params, seq_hash, '\n'.join(hits), now) for seq_hash, hits in results.items()])
+        except sqlite3.Error as e:
+            print(f"Warning: cannot write BLAST cache {self.path} ({e}).")
+
+    def record_usage(self, db, hits, misses):
+        try:
+            with self.conn:
+                self.conn.execute('INSERT OR IGNORE INTO usage (db, hits, misses) VALUES (?, 0, 0)', (db,))
+                self.conn.execute('UPDATE usage SET hits = hits + ?, misses = misses + ? WHERE db = ?',
+                                  (hits, misses, db))
+        except sqlite3.Error as e:
+            print(f"Warning: cannot write BLAST cache {self.path} ({e}).")
+
+    def stats(self):
+        """Returns [(db version, stored sequences, hits, misses)]."""
+        entries = dict(self.conn.execute('SELECT db, COUNT(*) FROM results GROUP BY db'))
+        usage = {db: (hits, misses) for db, hits, misses in self.conn.execute('SELECT db, hits, misses FROM usage')}
+        return [(db, entries.get(db, 0)) + usage.get(db, (0, 0)) for db in sorted(set(entries) | set(usage))]
+
+    def evict(self, current_versions):
+        """
+        Removes the results of other versions of the given databases.
+        current_versions is a list of db_version() strings; returns
+        {removed version: number of sequences}.
+        """
+        names = {version.split(':')[0] for version in current_versions}
+        removed = {}
+        for db, count in self.conn.execute('SELECT db, COUNT(*) FROM results GROUP BY db').fetchall():
+            if db.split(':')[0] in names and db not in current_versions:
+                removed[db] = count
+        with self.conn:
+            for db in removed:
+                self.conn.execute('DELETE FROM results WHERE db = ?', (db,))
+                self.conn.execute('DELETE FROM usage WHERE db = ?', (db,))
+        return removed
+
+
+def open_cache(path):
+    """Opens the cache, or returns None (with a warning) if it cannot be used."""
+    try:
+        return BlastCache(path)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: cannot open BLAST cache {path} ({e}); running without it.")
+        return None
+
+
+def read_queries(path):
+    """Returns [(qseqid, sequence)] of a FASTA file; qseqid is the first word of the header."""
+    queries = []
+    qseqid = None
+    seq_lines = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if qseqid is not None:
+                    queries.append((qseqid, ''.join(seq_lines)))
+                words = line[1:].split()
+                qseqid = words[0] if words else ''
+                seq_lines = []
+            elif qseqid is not None:
+                seq_lines.append(line)
+    if qseqid is not None:
+        queries.append((qseqid, ''.join(seq_lines)))
+    return queries
+
+
+def search(sequences, db, blast_args, threads=1):
+    """
+    Runs one blastn call for {seq_hash: sequence}; returns {seq_hash: hit
+    lines without the qseqid column}, or None if blastn fails.
+    """
+    hashes = list(sequences)
+    with tempfile.TemporaryDirectory(prefix='blastcache') as tmp_dir:
+        query_path = os.path.join(tmp_dir, 'query.fasta')
+        output_path = os.path.join(tmp_dir, 'hits.txt')
+        with open(query_path, 'w') as f:
+            for i, seq_hash in enumerate(hashes):
+                f.write(f">q{i}\n{sequences[seq_hash]}\n")
+        cmd = ['blastn', '-query', query_path, '-db', db, '-out', output_path] + \
+            list(blast_args) + ['-num_threads', str(threads)]
+        if subprocess.call(cmd) != 0 or not os.path.exists(output_path):
+            return None
+
+        searched = {seq_hash: [] for seq_hash in hashes}
+        with open(output_path, 'r') as f:
+            for line in f:
+                query_id, _, rest = line.rstrip('\n').partition('\t')
+                searched[hashes[int(query_id[1:])]].append(rest)
+    return searched
+
+
+def worker_search(socket_path, sequences, db, blast_args):
+    """
+    Sends {seq_hash: sequence} to the BLAST worker (blastworker.py) and
+    returns its answer as search() does. Raises OSError or ValueError if the
+    worker cannot be reached, does not answer within WORKER_TIMEOUT seconds
+    or its blastn failed.
+    """
+    request = {'db': db, 'args': list(blast_args), 'sequences': sequences}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(WORKER_TIMEOUT)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as f:
+            response = json.loads(f.read())
+    if response.get('error'):
+        raise ValueError(response['error'])
+    return response['hits']
+
+
+def blast_queries(queries, db, blast_args, threads=1, cache=None):
+    """
+    Returns (lines, stats) for a list of (qseqid, sequence): the tabular hit
+    lines of each query in query order (qseqid first, without newline), and
+    the numbers of queries, distinct sequences and sequences sent to blastn.
+    lines is None if blastn fails.
+    """
+    version = db_version(db)
+    params = search_params(blast_args)
+    hashes = [sequence_hash(sequence) for _, sequence in queries]
+    results = cache.get(version, params, set(hashes)) if cache else {}
+
+    missing = {}
+    for (_, sequence), seq_hash in zip(queries, hashes):
+        if seq_hash not in results and seq_hash not in missing:
+            missing[seq_hash] = sequence
+    stats = {'queries': len(queries), 'distinct': len(set(hashes)), 'searched': len(missing)}
+    if cache:
+        cache.record_usage(version, stats['distinct'] - stats['searched'], stats['searched'])
+
+    if missing:
+        searched = None
+        worker = os.environ.get(WORKER_ENV)
+        if worker:
+            try:
+                searched = worker_search(worker, missing, db, blast_args)
+            except (OSError, ValueError) as e:
+                print(f"Warning: BLAST worker at {worker} not available ({e}); running blastn.")
+                worker = None
+        if not worker:
+            searched = search(missing, db, blast_args, threads)
+        if searched is None:
+            return None, stats
+        if cache:
+            cache.put(version, params, searched)
+        results.update(searched)
+
+    lines = []
+    for (qseqid, _), seq_hash in zip(queries, hashes):
+        lines.append([f"{qseqid}\t{rest}" for rest in results[seq_hash]])
+    return lines, stats
+
+
+def write_lines(path, lines):
+    """Writes the hit lines of blast_queries() as a blastn tabular output file."""
+    with open(path, 'w') as out:
+        for query_lines in lines:
+            for line in query_lines:
+                out.write(line + '\n')
+
+
+def run_command(args, blast_args):
+    cache = open_cache(args.cache)
+    try:
+        lines, stats = blast_queries(read_queries(args.query), os.path.abspath(args.db), blast_args,
+                                     args.threads, cache)
+    finally:
+        if cache:
+            cache.close()
+    if lines is None:
+        return 1
+    write_lines(args.out, lines)
+    folder_name = os.path.basename(os.getcwd())
+    log_message(args.log, f"{os.path.basename(args.db)} BLAST of {stats['queries']} sequences in {folder_name}: "
+                          f"{stats['distinct'] - stats['searched']} of {stats['distinct']} distinct sequences "
+                          f"from cache, {stats['searched']} sent to BLAST")
+    return 0
+
+
+def stats_command(args):
+    current = {db_version(os.path.abspath(db)) for db in args.db}
+    with BlastCache(args.cache) as cache:
+        rows = cache.stats()
+    print("Database version\tSequences\tHits\tMisses\tHit rate")
+    for db, entries, hits, misses in rows:
+        rate = f"{100 * hits / (hits + misses):.1f}%" if hits + misses else "-"
+        stale = " (stale)" if current and db.split(':')[0] in {v.split(':')[0] for v in current} and db not in current else ""
+        print(f"{db}{stale}\t{entries}\t{hits}\t{misses}\t{rate}")
+    return 0
+
+
+def evict_command(args):
+    current = [db_version(os.path.abspath(db)) for db in args.db]
+    with BlastCache(args.cache) as cache:
+        removed = cache.evict(current)
+        cache.conn.execute('VACUUM')
+    for db, count in removed.items():
+        print(f"Removed {count} sequences of {db}")
+    if not removed:
+        print("No results of older database versions found")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="blastn with a per-sequence result cache.")
+    parser.add_argument('--cache', default=default_cache_path(), help="Cache file (default: see blastcache.py)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Run blastn for a query file through the cache")
+    run_parser.add_argument('--db', required=True, help="BLAST database")
+    run_parser.add_argument('--query', required=True, help="Query FASTA file")
+    run_parser.add_argument('--out', required=True, help="Tabular output file")
+    run_parser.add_argument('--threads', type=int, default=1, help="blastn threads (default 1)")
+    run_parser.add_argument('--log', default=None, help="Log file for the cache hit rate")
+    run_parser.add_argument('blast_args', nargs=argparse.REMAINDER, help="blastn options, after --")
+
+    stats_parser = subparsers.add_parser('stats', help="Show stored sequences and hit rates per database version")
+    stats_parser.add_argument('--db', action='append', default=[], help="Current database, to mark older versions")
+
+    evict_parser = subparsers.add_parser('evict', help="Remove the results of older versions of databases")
+    evict_parser.add_argument('--db', action='append', required=True, help="Current database (repeatable)")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        blast_args = args.blast_args[1:] if args.blast_args[:1] == ['--'] else args.blast_args
+        return run_command(args, blast_args)
+    if args.command == 'stats':
+        return stats_command(args)
+    return evict_command(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
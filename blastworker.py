@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Resident BLAST worker shared by the samples of a run.
+
+blastn has no server mode: every call starts a new process that opens and
+memory-maps its database. What the worker keeps across samples is
+everything around that:
+
+- the files of 241130_rotadb and hostdb/hostdatabase250421 are mapped once
+  and kept in the page cache (touched at start, refreshed with
+  MADV_WILLNEED), so no blastn call waits for the database to be read;
+- requests from samples running at the same time are merged: the
+  sequences of all requests for the same database and options that arrive
+  while a blastn call runs (or within --window seconds) go to the next
+  single multithreaded blastn call, so process start and database open are
+  paid per batch instead of per sample, and a sequence asked for by
+  several samples is searched once.
+
+Samples talk to it through blastcache.py, which sends the sequences not in
+the BLAST cache to the Unix socket in $ROTAFINDER_BLAST_WORKER (one JSON
+request per connection) and gets the hit lines back; the 14-column
+tabular output files are the same as without the worker. When the variable
+is not set, the worker cannot be reached, does not answer within
+blastcache.WORKER_TIMEOUT or its blastn fails, blastcache.py runs blastn
+itself. RotaFinder.sh --blast-worker starts and stops the worker.
+
+Usage:
+    python3 blastworker.py serve --socket PATH [--db PREFIX ...] [--threads N] [--window 0.2] [--log log.txt]
+    python3 blastworker.py status --socket PATH
+"""
+import argparse
+import glob
+import json
+import mmap
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import blastcache
+import hostblast
+from rotadb import ROTADB
+from scheduler import log_message
+
+DATABASES = [ROTADB, hostblast.HOST_DB]
+
+# Seconds to wait for more requests before a blastn call starts
+WINDOW = 0.2
+# Seconds between page cache refreshes of the database files
+REFRESH_SECONDS = 300
+# Seconds to wait for the answer to `status`
+STATUS_TIMEOUT = 10
+
+
+class DatabaseFiles:
+    """Memory maps of the files of BLAST databases, kept in the page cache."""
+
+    def __init__(self, prefixes):
+        self.maps = []
+        for prefix in prefixes:
+            for path in sorted(glob.glob(prefix + '.*')):
+                if not os.path.isfile(path) or os.path.getsize(path) == 0:
+                    continue
+                with open(path, 'rb') as f:
+                    self.maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        for data in self.maps:
+            # Reads every page once
+            for i in range(0, len(data), mmap.PAGESIZE):
+                data[i]
+        self.bytes = sum(len(data) for data in self.maps)
+
+    def refresh(self):
+        for data in self.maps:
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_WILLNEED)
+
+
+class Batcher:
+    """Merges the requests for one database and option set into shared blastn calls."""
+
+    def __init__(self, db, blast_args, threads, window):
+        self.db = db
+        self.blast_args = blast_args
+        self.threads = threads
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.waiting = []
+        self.running = False
+        self.batches = 0
+
+    def search(self, sequences):
+        """Returns {seq_hash: hit lines} for {seq_hash: sequence}, or None if blastn fails."""
+        request = {'hashes': list(sequences), 'done': threading.Event(), 'hits': None}
+        with self.lock:
+            self.pending.update(sequences)
+            self.waiting.append(request)
+            start = not self.running
+            self.running = True
+        if start:
+            threading.Thread(target=self._run, daemon=True).start()
+        request['done'].wait()
+        return request['hits']
+
+    def _run(self):
+        idle = False
+        try:
+            while True:
+                time.sleep(self.window)
+                with self.lock:
+                    pending, waiting = self.pending, self.waiting
+                    self.pending, self.waiting = {}, []
+                    if not waiting:
+                        self.running = False
+                        idle = True
+                        return
+                try:
+                    searched = blastcache.search(pending, self.db, self.blast_args, self.threads)
+                    hits = [{seq_hash: searched[seq_hash] for seq_hash in request['hashes']}
+                            for request in waiting] if searched is not None else [None] * len(waiting)
+                except Exception as e:
+                    # The samples run blastn themselves instead
+                    print(f"blastn against {os.path.basename(self.db)} failed ({e})")
+                    hits = [None] * len(waiting)
+                self.batches += 1
+                for request, request_hits in zip(waiting, hits):
+                    request['hits'] = request_hits
+                    request['done'].set()
+        finally:
+            # Never leave a batcher marked running without a thread, or every
+            # later search() would wait forever
+            if not idle:
+                with self.lock:
+                    self.running = False
+                    waiting, self.waiting, self.pending = self.waiting, [], {}
+                for request in waiting:
+                    request['done'].set()
+
+
+class Worker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, threads, window):
+        self.threads = threads
+        self.window = window
+        self.batchers = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.sequences = 0
+        super().__init__(socket_path, RequestHandler)
+
+    def batcher(self, db, blast_args):
+        key = (db, tuple(blast_args))
+        with self.lock:
+            if key not in self.batchers:
+                self.batchers[key] = Batcher(db, blast_args, self.threads, self.window)
+            return self.batchers[key]
+
+    def status(self):
+        return {
+            'requests': self.requests,
+            'sequences': self.sequences,
+            'batches': sum(batcher.batches for batcher in self.batchers.values()),
+        }
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.read())
+        except ValueError as e:
+            self.reply({'error': f"bad request ({e})"})
+            return
+        if request.get('status'):
+            self.reply(self.server.status())
+            return
+
+        sequences = request.get('sequences', {})
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.sequences += len(sequences)
+        hits = self.server.batcher(request['db'], request['args']).search(sequences) if sequences else {}
+        if hits is None:
+            self.reply({'error': f"blastn failed against {os.path.basename(request['db'])}"})
+        else:
+            self.reply({'hits': hits})
+
+    def reply(self, response):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+def serve(args):
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    start = time.time()
+    databases = DatabaseFiles(args.db)
+    worker = Worker(args.socket, args.threads, args.window)
+    log_message(args.log, f"BLAST worker ready at {args.socket}: "
+                          f"{', '.join(os.path.basename(db) for db in args.db)} "
+                          f"({databases.bytes / 1e6:.0f} MB) loaded in {time.time() - start:.1f} s")
+
+    def refresh():
+        while True:
+            time.sleep(REFRESH_SECONDS)
+            databases.refresh()
+    threading.Thread(target=refresh, daemon=True).start()
+    # RotaFinder.sh stops the worker with kill
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        worker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        status = worker.status()
+        worker.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        log_message(args.log, f"BLAST worker stopped: {status['requests']} requests with "
+                              f"{status['sequences']} sequences in {status['batches']} blastn calls")
+    return 0
+
+
+def status(args):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(STATUS_TIMEOUT)
+            sock.connect(args.socket)
+            sock.sendall(json.dumps({'status': True}).encode() + b'\n')
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile('rb') as f:
+                response = json.loads(f.read())
+    except (OSError, ValueError) as e:
+        print(f"No BLAST worker at {args.socket} ({e})")
+        return 1
+    print(f"{response['requests']} requests with {response['sequences']} sequences "
+          f"in {response['batches']} blastn calls")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident BLAST worker shared by the samples of a run.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help="Run the worker until it is stopped")
+    status_parser = subparsers.add_parser('status', help="Show the requests served so far")
+    for subparser in (serve_parser, status_parser):
+        subparser.add_argument('--socket', default=os.environ.get(blastcache.WORKER_ENV),
+                               help=f"Unix socket (default ${blastcache.WORKER_ENV})")
+    serve_parser.add_argument('--db', action='append', default=None,
+                              help="BLAST database to keep loaded (repeatable, default rotadb and hostdb)")
+    serve_parser.add_argument('--threads', type=int, default=os.cpu_count(), help="blastn threads (default all)")
+    serve_parser.add_argument('--window', type=float, default=WINDOW,
+                              help=f"Seconds to wait for more requests before a blastn call (default {WINDOW})")
+    serve_parser.add_argument('--log', default=None, help="Log file")
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error(f"no socket given (--socket or ${blastcache.WORKER_ENV})")
+
+    if args.command == 'serve':
+        args.db = [os.path.abspath(db) for db in (args.db or DATABASES)]
+        return serve(args)
+    return status(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
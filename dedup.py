@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Collapses duplicate contigs before the rotadb BLAST.
+
+The five assemblies are made from the same reads, so contigs500_COV.fasta
+holds many contigs with the same sequence, on the same or the opposite
+strand. `collapse` keeps one representative per sequence (the first
+contig, in either orientation) in contigs500_COV_unique.fasta, which is sent
+to blastn, and writes contigs500_COV_dedup.tsv with one line per original
+contig:
+
+    qseqid  representative  strand (+ same sequence, - reverse complement)  coverage
+
+so it is known which assembler contigs (and their cov_ values) each
+representative stands for. `expand` turns the hits of the representatives
+back into the hits of every original contig, in the original order, with
+the qseqid of the contig. For reverse-complement duplicates the hit of the
+representative is mirrored: the query coordinates are counted from the
+other end, sstart/send are swapped and the strand is flipped. The
+evaluation, summary counts (which use the coverage of each contig) and
+contig/ORF selection are then the same as without deduplication.
+
+Usage:
+    python3 dedup.py collapse [input fasta] [unique fasta] [map tsv]
+    python3 dedup.py expand [unique hits] [map tsv] [output hits]
+"""
+import argparse
+import os
+import sys
+
+from postblast import QEND, QSTART, SSTRAND, get_coverage
+from scheduler import log_message
+
+UNIQUE_FASTA = "contigs500_COV_unique.fasta"
+DEDUP_MAP = "contigs500_COV_dedup.tsv"
+UNIQUE_OUTPUT = "blast_rota2_unique.txt"
+
+# Set by RotaFinder.sh --dedup
+DEDUP_ENV = 'ROTAFINDER_DEDUP'
+
+# blastn tabular columns (see rotablast2.sh)
+SSTART, SEND = 8, 9
+
+COMPLEMENT = str.maketrans('ACGTacgtNnRYKMSWBDHVrykmswbdhv', 'TGCAtgcaNnYRMKSWVHDByrmkswvhdb')
+
+
+def enabled():
+    return bool(os.environ.get(DEDUP_ENV))
+
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def read_records(path):
+    """Yields (qseqid, lines, sequence) per record; lines are the record's lines as read."""
+    qseqid = None
+    lines = []
+    seq_lines = []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                if qseqid is not None:
+                    yield qseqid, lines, ''.join(seq_lines)
+                words = line[1:].split()
+                qseqid = words[0] if words else ''
+                lines = [line]
+                seq_lines = []
+            elif qseqid is not None:
+                lines.append(line)
+                seq_lines.append(line.strip())
+    if qseqid is not None:
+        yield qseqid, lines, ''.join(seq_lines)
+
+
+def collapse(input_fasta, unique_fasta=UNIQUE_FASTA, map_path=DEDUP_MAP):
+    """Writes the unique contigs and the contig map; returns (unique, total)."""
+    representatives = {}  # upper case sequence -> representative qseqid
+    total = 0
+    with open(unique_fasta, 'w') as out, open(map_path, 'w') as map_file:
+        map_file.write("qseqid\trepresentative\tstrand\tcoverage\n")
+        for qseqid, lines, sequence in read_records(input_fasta):
+            total += 1
+            key = sequence.upper()
+            if key in representatives:
+                representative, strand = representatives[key], '+'
+            else:
+                reverse = reverse_complement(key)
+                if reverse in representatives:
+                    representative, strand = representatives[reverse], '-'
+                else:
+                    representatives[key] = qseqid
+                    representative, strand = qseqid, '+'
+                    out.writelines(lines)
+            map_file.write(f"{qseqid}\t{representative}\t{strand}\t{get_coverage(qseqid)}\n")
+    return len(representatives), total
+
+
+def mirror_hit(fields, length):
+    """Returns the hit fields of the reverse complement of the query."""
+    fields = list(fields)
+    qstart, qend = int(fields[QSTART]), int(fields[QEND])
+    fields[QSTART] = str(length - qend + 1)
+    fields[QEND] = str(length - qstart + 1)
+    fields[SSTART], fields[SEND] = fields[SEND], fields[SSTART]
+    if len(fields) > SSTRAND:
+        fields[SSTRAND] = 'minus' if fields[SSTRAND] == 'plus' else 'plus'
+    return fields
+
+
+def expand(unique_hits, map_path=DEDUP_MAP, output=None, unique_fasta=UNIQUE_FASTA):
+    """Writes the hits of all original contigs; returns the number of hit lines."""
+    hits = {}
+    with open(unique_hits, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            hits.setdefault(fields[0], []).append(fields)
+
+    # Lengths of the representatives, to mirror hits of reverse complements
+    lengths = {qseqid: len(sequence) for qseqid, _, sequence in read_records(unique_fasta)}
+
+    count = 0
+    with open(map_path, 'r') as map_file, open(output, 'w') as out:
+        map_file.readline()
+        for line in map_file:
+            qseqid, representative, strand, _ = line.rstrip('\n').split('\t')
+            for fields in hits.get(representative, []):
+                if strand == '-':
+                    fields = mirror_hit(fields, lengths[representative])
+                out.write('\t'.join([qseqid] + fields[1:]) + '\n')
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collapse duplicate contigs before BLAST and expand the hits after.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    collapse_parser = subparsers.add_parser('collapse', help="Write the unique contigs and the contig map")
+    collapse_parser.add_argument('input', nargs='?', default="contigs500_COV.fasta")
+    collapse_parser.add_argument('unique', nargs='?', default=UNIQUE_FASTA)
+    collapse_parser.add_argument('map', nargs='?', default=DEDUP_MAP)
+    collapse_parser.add_argument('--log', default=None, help="Log file")
+
+    expand_parser = subparsers.add_parser('expand', help="Write the hits of all original contigs")
+    expand_parser.add_argument('hits', nargs='?', default=UNIQUE_OUTPUT)
+    expand_parser.add_argument('map', nargs='?', default=DEDUP_MAP)
+    expand_parser.add_argument('output', nargs='?', default="blast_rota2.txt")
+    expand_parser.add_argument('--unique', default=UNIQUE_FASTA, help="FASTA file of the representatives")
+    args = parser.parse_args()
+
+    if args.command == 'collapse':
+        unique, total = collapse(args.input, args.unique, args.map)
+        log_message(args.log, f"Dedup: {total} contigs collapsed to {unique} unique sequences "
+                              f"in {os.path.basename(os.getcwd())}")
+    else:
+        expand(args.hits, args.map, args.output, args.unique)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+faidx-style index and memory-mapped reader for FASTA files.
+
+The index is stored next to the FASTA file as <file>.fai in the samtools
+faidx format (name, length, offset, line bases, line width), and is rebuilt
+when it is missing or older than the FASTA file. Records are read from a
+read-only memory map, so only the bytes of the requested sequence or range
+are touched and memory stays flat on large assemblies.
+
+Names and sequences follow the readers in selected_contigs.py and
+selected_ORFs.py: the name is the first word of the header, the sequence is
+the joined sequence lines, and when a name occurs twice the last record
+wins. Files whose sequence lines are not evenly wrapped cannot be indexed;
+open_fasta() then reads the file into memory instead.
+
+Usage:
+    python3 fastaindex.py contigs500_COV.fasta   # build/refresh the index
+"""
+import mmap
+import os
+import sys
+import tempfile
+
+
+def index_path(fasta_path):
+    return fasta_path + '.fai'
+
+
+def build_index(fasta_path):
+    """
+    Scans a FASTA file and returns {name: (length, offset, linebases, linewidth)}.
+    Raises ValueError if the sequence lines of a record are not evenly wrapped.
+    """
+    entries = {}
+    name = None
+    offset = length = linebases = linewidth = 0
+    short_line = False  # a shorter (last) line or blank line was seen
+
+    def finish():
+        if name is not None:
+            entries.pop(name, None)
+            entries[name] = (length, offset, linebases, linewidth)
+
+    position = 0
+    with open(fasta_path, 'rb') as f:
+        for line in f:
+            line_start = position
+            position += len(line)
+            stripped = line.strip()
+            if stripped.startswith(b'>'):
+                finish()
+                name = stripped.split()[0][1:].decode()
+                offset = position
+                length = linebases = linewidth = 0
+                short_line = False
+                continue
+            if name is None:
+                continue
+
+            bases = len(stripped)
+            if bases == 0:
+                short_line = True
+                continue
+            if short_line or line.rstrip(b'\r\n') != stripped:
+                raise ValueError(f"{fasta_path}: sequence '{name}' is not evenly wrapped")
+            if linebases == 0:
+                linebases = bases
+                linewidth = len(line)
+                if line_start != offset:
+                    raise ValueError(f"{fasta_path}: sequence '{name}' is not evenly wrapped")
+            elif bases > linebases or (bases == linebases and len(line) != linewidth):
+                raise ValueError(f"{fasta_path}: sequence '{name}' is not evenly wrapped")
+            elif bases < linebases:
+                short_line = True
+            length += bases
+    finish()
+    return entries
+
+
+def write_index(fasta_path, entries):
+    path = index_path(fasta_path)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        for name, (length, offset, linebases, linewidth) in entries.items():
+            f.write(f"{name}\t{length}\t{offset}\t{linebases}\t{linewidth}\n")
+    os.replace(tmp_path, path)
+
+
+def read_index(fasta_path):
+    entries = {}
+    with open(index_path(fasta_path), 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            entries[fields[0]] = tuple(int(value) for value in fields[1:5])
+    return entries
+
+
+def load_index(fasta_path):
+    """Returns the index of a FASTA file, building or refreshing the .fai file if needed."""
+    path = index_path(fasta_path)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(fasta_path):
+        return read_index(fasta_path)
+    entries = build_index(fasta_path)
+    try:
+        write_index(fasta_path, entries)
+    except OSError:
+        pass  # read-only folder, use the index without storing it
+    return entries
+
+
+class FastaIndex:
+    """Memory-mapped access to the records of an indexed FASTA file."""
+
+    def __init__(self, fasta_path):
+        self.path = fasta_path
+        self.entries = load_index(fasta_path)
+        self.file = open(fasta_path, 'rb')
+        if os.path.getsize(fasta_path) > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = b''
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def names(self):
+        return list(self.entries)
+
+    def length(self, name):
+        return self.entries[name][0]
+
+    def header(self, name):
+        """Returns the stripped header line of a record, including '>'."""
+        offset = self.entries[name][1]
+        start = self.map.rfind(b'\n', 0, offset - 1) + 1
+        return self.map[start:offset].strip().decode()
+
+    def _position(self, name, base):
+        length, offset, linebases, linewidth = self.entries[name]
+        return offset + (base // linebases) * linewidth + base % linebases
+
+    def fetch(self, name, start=None, end=None):
+        """
+        Returns sequence[start:end] of a record with Python slice semantics
+        (0-based, end exclusive, negative values count from the end).
+        """
+        length = self.entries[name][0]
+        start, end, _ = slice(start, end).indices(length)
+        if start >= end:
+            return ''
+        first = self._position(name, start)
+        last = self._position(name, end - 1) + 1
+        data = self.map[first:last]
+        return data.replace(b'\n', b'').replace(b'\r', b'').decode()
+
+    def get(self, name):
+        """Returns (header line, sequence) of a record."""
+        return self.header(name), self.fetch(name)
+
+
+class InMemoryFasta:
+    """Same interface as FastaIndex, for files that cannot be indexed."""
+
+    def __init__(self, fasta_path):
+        self.path = fasta_path
+        self.records = {}
+        with open(fasta_path, 'r') as f:
+            header = None
+            seq_lines = []
+            for line in f:
+                line = line.strip()
+                if line.startswith(">"):
+                    if header:
+                        self.records[header.split()[0][1:]] = (header, "".join(seq_lines))
+                    header = line
+                    seq_lines = []
+                else:
+                    seq_lines.append(line)
+            if header:
+                self.records[header.split()[0][1:]] = (header, "".join(seq_lines))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def names(self):
+        return list(self.records)
+
+    def length(self, name):
+        return len(self.records[name][1])
+
+    def header(self, name):
+        return self.records[name][0]
+
+    def fetch(self, name, start=None, end=None):
+        return self.records[name][1][start:end]
+
+    def get(self, name):
+        return self.records[name]
+
+
+def open_fasta(fasta_path):
+    """Opens a FASTA file through its index, or in memory if it cannot be indexed."""
+    try:
+        return FastaIndex(fasta_path)
+    except ValueError as e:
+        print(f"Warning: {e}; reading {fasta_path} into memory.")
+        return InMemoryFasta(fasta_path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            entries = load_index(path)
+            print(f"Indexed {len(entries)} sequences in {path}")
+    else:
+        print("Please provide one or more FASTA files.")
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""
+Assembly-free genotyping of a sample folder from its reads.
+
+The trimmed reads (R1_paired.fastq.gz/R2_paired.fastq.gz, or the raw
+*_R1_001.fastq.gz/*_R2_001.fastq.gz when Trimmomatic has not run) are
+streamed in batches through a k-mer index of 241130_rotadb (k=21, canonical
+codes of both strands, see prescreen.py):
+
+  - k-mers found in the references of a single genotype are votes: a read
+    goes to the genotype most of its voting k-mers belong to (reads with a
+    tie or fewer than MIN_READ_KMERS votes are not counted),
+  - all read k-mers are matched against every reference to estimate how
+    much of it the sample covers. The covered length is the number of
+    reference bases within seen k-mers, gaps shorter than 2k (left by one
+    or two nearby mismatches) included. The identity is estimated from the
+    share of reference k-mers seen within the covered part only
+    (containment ** (1 / k), as Mash does), so parts without reads at low
+    depth do not lower it.
+
+Every genotype with at least --min-reads reads is then evaluated with the
+base_thresholds/min_lengths of evaluate3.py (postblast.evaluate_hit), using
+the reference it shares the most k-mers with as the hit. Per gene the
+accepted genotype with the most reads is called; if the runner-up has at
+least --ambiguity times as many reads the gene is reported as "?", as
+genotype4.py does for ties.
+
+Writes in the sample folder:
+    fast_results.csv      reads, reference, estimated identity and covered
+                          length and evaluation per genotype
+    fast_genotyping.csv   Folder Name, Genotype, Extra Information (as in
+                          blast_rota_genotyping4.csv) and Support, the
+                          number of reads behind each call
+
+Exits with status 0 when G and P are called without "?", otherwise 1, so
+RotaFinder.sh --fast queues only the other samples for the full pipeline.
+
+`--check-depth` checks the estimates on simulated reads instead: reads of
+a G and a P reference mutated to 97% identity are subsampled to
+CHECK_DEPTHS, and the calls must hold and the identity stay near 97 down
+to the lowest depth.
+
+Usage:
+    python3 fastgenotype.py [folder] [--db 241130_rotadb] [--max-reads N] [--log log.txt]
+    python3 fastgenotype.py --check-depth [--db 241130_rotadb]
+"""
+import argparse
+import csv
+import glob
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from postblast import BLAST_COLUMNS, LENGTH, PIDENT, SLEN, SSEQID, evaluate_hit, gene_order, genotype_sort_key
+from prescreen import ENCODING, canonical_kmers
+from rotadb import ROTADB, BlastDb
+from scheduler import log_message
+
+# Shorter than the BLAST word so reads of strains some percent away from
+# the nearest reference still share k-mers with it
+KMER_SIZE = 21
+
+TRIMMED_READS = ['R1_paired.fastq.gz', 'R2_paired.fastq.gz']
+RAW_READS = ['*_R1_001.fastq.gz', '*_R2_001.fastq.gz']
+
+# Bases classified per numpy batch
+BATCH_BASES = 20_000_000
+
+# Voting k-mers a read needs to be counted for a genotype
+MIN_READ_KMERS = 2
+
+MIN_READS = 10
+AMBIGUITY = 0.5
+
+RESULTS_FILE = "fast_results.csv"
+GENOTYPING_FILE = "fast_genotyping.csv"
+
+# Simulated sample of --check-depth
+CHECK_DEPTHS = [30, 10, 5, 3]
+CHECK_IDENTITY = 97
+CHECK_READ_LENGTH = 150
+CHECK_ERROR_RATE = 0.005
+CHECK_SEED = 1
+
+RESULTS_HEADER = ['Genotype', 'Reads', 'Reference', 'Identity', 'Covered Length', 'Reference Length', 'Evaluation']
+GENOTYPING_HEADER = ['Folder Name', 'Genotype', 'Extra Information', 'Support']
+
+
+class ReferenceIndex:
+    """K-mers of all rotadb references and the ones that tell genotypes apart."""
+
+    def __init__(self, db_prefix=ROTADB, k=KMER_SIZE):
+        self.k = k
+        db = BlastDb(db_prefix)
+        self.names = [defline.split()[0] if defline.split() else '' for defline in db.deflines()]
+        self.lengths = np.array([db.length(oid) for oid in range(len(db))], dtype=np.int64)
+        self.genotypes = sorted({name.split('|')[0] for name in self.names if name},
+                                key=genotype_sort_key)
+        genotype_ids = {genotype: i for i, genotype in enumerate(self.genotypes)}
+        self.genotype_of = np.array([genotype_ids.get(name.split('|')[0], -1) for name in self.names],
+                                    dtype=np.int64)
+
+        codes = []
+        refs = []
+        positions = []
+        for oid in range(len(db)):
+            canonical, valid = canonical_kmers(db.codes(oid), k)
+            position = np.flatnonzero(valid)
+            codes.append(canonical[position])
+            refs.append(np.full(len(position), oid, dtype=np.int64))
+            positions.append(position)
+        codes = np.concatenate(codes) if codes else np.empty(0, dtype=np.uint64)
+        order = np.argsort(codes, kind='stable')
+        # One entry per reference k-mer, sorted by code
+        self.codes = codes[order]
+        self.refs = np.concatenate(refs)[order] if refs else np.empty(0, dtype=np.int64)
+        self.positions = np.concatenate(positions)[order] if positions else np.empty(0, dtype=np.int64)
+        # Start of each reference in one coordinate space, with k bases
+        # between references so covered parts never join across them
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths + k)])[:-1].astype(np.int64)
+        self.space = int(self.lengths.sum() + k * len(self.lengths))
+
+        # Voting k-mers: codes whose entries all belong to one genotype
+        genotype = self.genotype_of[self.refs]
+        starts = np.flatnonzero(np.r_[True, self.codes[1:] != self.codes[:-1]]) if len(self.codes) else \
+            np.empty(0, dtype=np.int64)
+        self.kmers = self.codes[starts]
+        if len(starts):
+            single = np.minimum.reduceat(genotype, starts) == np.maximum.reduceat(genotype, starts)
+            single &= genotype[starts] >= 0
+        else:
+            single = np.empty(0, dtype=bool)
+        self.vote_kmers = self.kmers[single]
+        self.vote_genotypes = genotype[starts][single]
+
+    def lookup(self, sorted_codes, query):
+        """Returns (indices into sorted_codes, found mask) of the query codes."""
+        if len(sorted_codes) == 0:
+            return np.zeros(len(query), dtype=np.int64), np.zeros(len(query), dtype=bool)
+        positions = np.searchsorted(sorted_codes, query)
+        np.minimum(positions, len(sorted_codes) - 1, out=positions)
+        return positions, sorted_codes[positions] == query
+
+    def classify(self, sequences):
+        """
+        Classifies a batch of reads. Returns (reads per genotype, sorted
+        distinct reference k-mers seen in the batch).
+        """
+        votes = np.zeros(len(self.genotypes), dtype=np.int64)
+        if not sequences:
+            return votes, np.empty(0, dtype=np.uint64)
+        # Reads are joined with an N so no k-mer spans two reads
+        joined = b'N'.join(sequences)
+        canonical, valid = canonical_kmers(ENCODING[np.frombuffer(joined, dtype=np.uint8)], self.k)
+        starts = np.cumsum([0] + [len(sequence) + 1 for sequence in sequences[:-1]])
+        position = np.flatnonzero(valid)
+        query = canonical[position]
+
+        _, seen = self.lookup(self.kmers, query)
+        observed = np.unique(query[seen])
+
+        index, found = self.lookup(self.vote_kmers, query)
+        if found.any():
+            read = np.searchsorted(starts, position[found], side='right') - 1
+            genotype = self.vote_genotypes[index[found]]
+            pairs, counts = np.unique(read * len(self.genotypes) + genotype, return_counts=True)
+            read, genotype = np.divmod(pairs, len(self.genotypes))
+            # Per read, the genotype with the most votes first
+            order = np.lexsort((-counts, read))
+            read, genotype, counts = read[order], genotype[order], counts[order]
+            first = np.r_[True, read[1:] != read[:-1]]
+            next_same = np.r_[read[1:] == read[:-1], False]
+            tie = next_same & (np.r_[counts[1:], 0] == counts)
+            winner = first & ~tie & (counts >= MIN_READ_KMERS)
+            votes += np.bincount(genotype[winner], minlength=len(self.genotypes))
+        return votes, observed
+
+    def covered_mask(self, seen):
+        """
+        Reference bases (in the space of self.offsets) within a seen k-mer,
+        with gaps shorter than 2k between them filled: a mismatch leaves a
+        gap of k - 1 bases, two nearby ones up to 2k - 2, a stretch without
+        reads usually a longer one.
+        """
+        starts = self.offsets[self.refs[seen]] + self.positions[seen]
+        delta = np.zeros(self.space + 1, dtype=np.int64)
+        np.add.at(delta, starts, 1)
+        np.add.at(delta, starts + self.k, -1)
+        covered = np.cumsum(delta[:-1]) > 0
+
+        # Uncovered runs between two covered ones, from a falling to the next
+        # rising edge
+        edges = np.flatnonzero(np.diff(covered.astype(np.int8))) + 1
+        if len(edges) and not covered[0]:
+            edges = edges[1:]
+        gap_starts, gap_ends = edges[0::2], edges[1::2]
+        gap_starts = gap_starts[:len(gap_ends)]
+        short = gap_ends - gap_starts < 2 * self.k
+        fill = np.zeros(self.space + 1, dtype=np.int64)
+        np.add.at(fill, gap_starts[short], 1)
+        np.add.at(fill, gap_ends[short], -1)
+        return covered | (np.cumsum(fill[:-1]) > 0)
+
+    def coverage(self, observed):
+        """
+        Returns (estimated identity in percent, covered length, seen k-mers)
+        of every reference from the distinct k-mers seen in the reads.
+        """
+        n_refs = len(self.names)
+        _, seen = self.lookup(observed, self.codes)
+        covered = self.covered_mask(seen)
+        covered_sum = np.concatenate([[0], np.cumsum(covered)])
+        covered_length = np.add.reduceat(covered.astype(np.int64), self.offsets) if n_refs else \
+            np.empty(0, dtype=np.int64)
+
+        # Reference k-mers inside the covered part, seen or not
+        starts = self.offsets[self.refs] + self.positions
+        inside = covered_sum[starts + self.k] - covered_sum[starts] == self.k
+        expected = np.bincount(self.refs[inside], minlength=n_refs)
+        found = np.bincount(self.refs[seen], minlength=n_refs)
+        containment = np.divide(found, expected, out=np.zeros(n_refs), where=expected > 0)
+        identity = 100 * np.minimum(containment, 1) ** (1 / self.k)
+        return identity, covered_length, found
+
+
+def read_files(folder):
+    """Returns the trimmed read files of a folder, or else the raw ones."""
+    trimmed = [os.path.join(folder, name) for name in TRIMMED_READS]
+    if all(os.path.exists(path) and os.path.getsize(path) > 0 for path in trimmed):
+        return trimmed
+    return [path for pattern in RAW_READS for path in sorted(glob.glob(os.path.join(folder, pattern)))]
+
+
+def read_batches(paths, max_reads=None, batch_bases=BATCH_BASES):
+    """Yields lists of read sequences (bytes) from FASTQ files."""
+    batch = []
+    bases = 0
+    for path in paths:
+        n_reads = 0
+        with gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb') as f:
+            for i, line in enumerate(f):
+                if i % 4 != 1:
+                    continue
+                sequence = line.rstrip()
+                batch.append(sequence)
+                bases += len(sequence)
+                n_reads += 1
+                if bases >= batch_bases:
+                    yield batch
+                    batch = []
+                    bases = 0
+                if max_reads and n_reads >= max_reads:
+                    break
+    if batch:
+        yield batch
+
+
+def evaluate_genotype(sseqid, identity, covered, slen):
+    """Evaluation of a genotype as evaluate3.py would give it for a hit with these values."""
+    row = [''] * len(BLAST_COLUMNS)
+    row[SSEQID] = sseqid
+    row[PIDENT] = str(round(identity, 3))
+    row[LENGTH] = str(covered)
+    row[SLEN] = str(slen)
+    return evaluate_hit(row)
+
+
+def genotype_results(index, votes, identity, covered, found, min_reads=MIN_READS):
+    """Returns one result dict per genotype with at least min_reads reads."""
+    results = []
+    for genotype_id, genotype in enumerate(index.genotypes):
+        # Outgroup references are only there to draw votes away
+        if votes[genotype_id] < min_reads or genotype[0] not in gene_order:
+            continue
+        refs = np.flatnonzero(index.genotype_of == genotype_id)
+        # The reference the reads share the most k-mers with
+        best = refs[np.argmax(found[refs])]
+        results.append({
+            'genotype': genotype,
+            'reads': int(votes[genotype_id]),
+            'reference': index.names[best],
+            'identity': round(float(identity[best]), 2),
+            'covered': int(covered[best]),
+            'slen': int(index.lengths[best]),
+            'evaluation': evaluate_genotype(index.names[best], identity[best], covered[best], index.lengths[best]),
+        })
+    return results
+
+
+def format_genotype(genotype):
+    gene, number = genotype[0], genotype[1:]
+    return f"{gene}[{number}]" if gene == 'P' else genotype
+
+
+def call_genotype(results, ambiguity=AMBIGUITY):
+    """
+    Calls the main genotype of every gene from the accepted genotypes.
+    Returns (genotype string, extra information string, support string).
+    """
+    accepted = {gene: [] for gene in gene_order}
+    for result in results:
+        if result['evaluation'] == result['genotype'] and result['genotype'][0] in accepted:
+            accepted[result['genotype'][0]].append(result)
+
+    final_genotype = []
+    extra_info = []
+    support = []
+    for gene in gene_order:
+        candidates = sorted(accepted[gene], key=lambda result: -result['reads'])
+        if not candidates:
+            final_genotype.append(f"{gene}X")
+            continue
+        top = [candidates[0]] + [result for result in candidates[1:]
+                                 if result['reads'] >= ambiguity * candidates[0]['reads']]
+        if len(top) == 1:
+            call = format_genotype(top[0]['genotype'])
+            support.append(f"{call} {top[0]['reads']} reads")
+        else:
+            call = f"{gene}?"
+            extra_info.extend(result['genotype'] for result in top)
+            support.append(f"{call} (" + ", ".join(f"{result['genotype']} {result['reads']} reads"
+                                                   for result in top) + ")")
+        final_genotype.append(call)
+        extra_info.extend(result['genotype'] for result in candidates if result not in top)
+
+    genotype_string = "-".join(final_genotype)
+    extra_info_string = "; ".join(sorted(set(extra_info), key=genotype_sort_key)) or "None"
+    if all(gt.endswith('X') for gt in final_genotype):
+        genotype_string = ""
+        extra_info_string = "None"
+    return genotype_string, extra_info_string, "; ".join(support)
+
+
+def is_conclusive(genotype_string):
+    """True when G and P are called and no gene is ambiguous."""
+    calls = genotype_string.split('-') if genotype_string else []
+    return len(calls) >= 2 and '?' not in genotype_string and \
+        not calls[0].endswith('X') and not calls[1].endswith('X')
+
+
+def write_results(results, path):
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(RESULTS_HEADER)
+        for result in sorted(results, key=lambda result: genotype_sort_key(result['genotype'])):
+            writer.writerow([result['genotype'], result['reads'], result['reference'], result['identity'],
+                             result['covered'], result['slen'], result['evaluation']])
+
+
+def write_genotyping(folder_name, genotype_string, extra_info_string, support, path):
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(GENOTYPING_HEADER)
+        writer.writerow([folder_name, genotype_string, extra_info_string, support])
+
+
+def run(folder='.', db_prefix=ROTADB, max_reads=None, min_reads=MIN_READS, ambiguity=AMBIGUITY, log_file=None):
+    """Genotypes a sample folder from its reads; returns the genotype string or None without reads."""
+    start = time.time()
+    folder_name = os.path.basename(os.path.abspath(folder))
+    paths = read_files(folder)
+    if not paths:
+        log_message(log_file, f"Fast genotyping: no reads found in {folder_name}")
+        return None
+
+    index = ReferenceIndex(db_prefix)
+    votes = np.zeros(len(index.genotypes), dtype=np.int64)
+    observed = []
+    n_reads = 0
+    for batch in read_batches(paths, max_reads):
+        batch_votes, batch_observed = index.classify(batch)
+        votes += batch_votes
+        observed.append(batch_observed)
+        n_reads += len(batch)
+    observed = np.unique(np.concatenate(observed)) if observed else np.empty(0, dtype=np.uint64)
+
+    identity, covered, found = index.coverage(observed)
+    results = genotype_results(index, votes, identity, covered, found, min_reads)
+    genotype_string, extra_info_string, support = call_genotype(results, ambiguity)
+
+    write_results(results, os.path.join(folder, RESULTS_FILE))
+    write_genotyping(folder_name, genotype_string, extra_info_string, support,
+                     os.path.join(folder, GENOTYPING_FILE))
+    log_message(log_file, f"Fast genotyping of {folder_name}: {genotype_string or 'no genotype'} "
+                          f"({n_reads} reads, {time.time() - start:.0f} seconds)")
+    return genotype_string
+
+
+def simulate_reads(rng, codes, depth, read_length=CHECK_READ_LENGTH, error_rate=CHECK_ERROR_RATE):
+    """Reads of random positions and strands of a sequence at the given depth, with substitution errors."""
+    n_reads = max(1, round(depth * len(codes) / read_length))
+    starts = rng.integers(0, len(codes) - read_length + 1, size=n_reads)
+    reads = codes[starts[:, None] + np.arange(read_length)]
+    errors = rng.random(reads.shape) < error_rate
+    reads[errors] = (reads[errors] + rng.integers(1, 4, size=int(errors.sum()))) % 4
+    reverse = rng.random(n_reads) < 0.5
+    reads[reverse] = 3 - reads[reverse, ::-1]
+    return reads
+
+
+def write_fastq(path, reads):
+    from benchmark import BASES
+    with gzip.open(path, 'wt') as f:
+        for i, read in enumerate(reads):
+            sequence = BASES[read].tobytes().decode('ascii')
+            f.write(f"@read{i}\n{sequence}\n+\n{'I' * len(sequence)}\n")
+
+
+def check_depth(db_prefix=ROTADB, depths=CHECK_DEPTHS, identity=CHECK_IDENTITY, seed=CHECK_SEED):
+    """
+    Genotypes simulated samples of a G and a P reference at decreasing
+    depths; returns True if every depth gives the G and P call and an
+    identity within 2 points of the simulated one.
+    """
+    from benchmark import load_references, mutate
+    rng = np.random.default_rng(seed)
+    references = load_references(db_prefix)
+    strain = {}
+    for gene in ('G', 'P'):
+        candidates = [(sseqid, codes) for sseqid, codes in references
+                      if sseqid[0] == gene and 'vaccine' not in sseqid.lower()]
+        sseqid, codes = candidates[rng.integers(len(candidates))]
+        strain[sseqid.split('|')[0]] = mutate(rng, codes, identity)[0]
+    expected = [format_genotype(genotype) for genotype in strain]
+
+    ok = True
+    print("Depth  Genotype  Reads  Identity  Covered  Length  Evaluation  Call")
+    for depth in depths:
+        folder = tempfile.mkdtemp(prefix='fastgenotype-check-')
+        try:
+            reads = np.concatenate([simulate_reads(rng, codes, depth) for codes in strain.values()])
+            half = len(reads) // 2
+            write_fastq(os.path.join(folder, 'check_R1_001.fastq.gz'), reads[:half])
+            write_fastq(os.path.join(folder, 'check_R2_001.fastq.gz'), reads[half:])
+            genotype_string = run(folder, db_prefix) or ''
+            with open(os.path.join(folder, RESULTS_FILE), newline='') as f:
+                results = {row['Genotype']: row for row in csv.DictReader(f)}
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        calls = genotype_string.split('-')[:2]
+        for genotype in strain:
+            row = results.get(genotype)
+            good = row is not None and row['Evaluation'] == genotype and \
+                abs(float(row['Identity']) - identity) <= 2
+            ok &= good
+            if row:
+                print(f"{depth:<6} {genotype:<9} {row['Reads']:<6} {row['Identity']:<9} {row['Covered Length']:<8} "
+                      f"{row['Reference Length']:<7} {row['Evaluation']:<11} {genotype_string}")
+            else:
+                print(f"{depth:<6} {genotype:<9} not found")
+        ok &= calls == expected
+    print("Calls hold at every depth" if ok else "Calls or identities change with depth")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genotype a sample from its reads without assembly.")
+    parser.add_argument('folder', nargs='?', default='.', help="Sample folder (default: current folder)")
+    parser.add_argument('--db', default=ROTADB, help="BLAST database (default 241130_rotadb)")
+    parser.add_argument('--max-reads', type=int, default=None, help="Reads used per file (default all)")
+    parser.add_argument('--min-reads', type=int, default=MIN_READS,
+                        help=f"Reads a genotype needs to be evaluated (default {MIN_READS})")
+    parser.add_argument('--ambiguity', type=float, default=AMBIGUITY,
+                        help=f"Runner-up share of the reads that makes a call '?' (default {AMBIGUITY})")
+    parser.add_argument('--log', default=None, help="Log file")
+    parser.add_argument('--check-depth', action='store_true',
+                        help="Check the calls on simulated reads at decreasing depths")
+    args = parser.parse_args()
+
+    if args.check_depth:
+        return 0 if check_depth(args.db) else 1
+    genotype_string = run(args.folder, args.db, args.max_reads, args.min_reads, args.ambiguity,
+                          os.path.abspath(args.log) if args.log else None)
+    return 0 if genotype_string and is_conclusive(genotype_string) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Host comparison of the selected ORFs of one or more sample folders.
+
+The selected_ORFs.fasta files of all given folders are compared with
+hostdb/hostdatabase250421 together: ORF sequences found in the BLAST cache
+(blastcache.py) are answered from it, and the unseen ones of all folders
+are sent to one multithreaded blastn call. hostcomparison.csv (blastn
+tabular output, as before) is then written in each folder.
+
+RotaFinder.sh runs this once for all samples after they are processed;
+rotablast2.sh runs it for its own folder when used alone.
+
+Usage:
+    python3 hostblast.py [--threads N] [--blast-cache FILE] [--log log.txt] folder [folder ...]
+"""
+import argparse
+import os
+import sys
+
+import blastcache
+from scheduler import log_message
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HOST_DB = os.path.join(SCRIPT_DIR, 'hostdb', 'hostdatabase250421')
+QUERY_FASTA = "selected_ORFs.fasta"
+OUTPUT = "hostcomparison.csv"
+BLAST_ARGS = [
+    '-outfmt', "6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore sstrand slen",
+    '-max_target_seqs', '1', '-strand', 'both',
+]
+
+# Set by RotaFinder.sh, which then runs the host comparison of all samples at once
+POOL_ENV = 'ROTAFINDER_POOL_HOST'
+
+
+def run(folders, threads=1, db=HOST_DB, cache_path=None, log_file=None):
+    """Writes hostcomparison.csv in every folder with selected ORFs; returns 0 on success."""
+    queries = []
+    ranges = []
+    for folder in folders:
+        path = os.path.join(folder, QUERY_FASTA)
+        if not os.path.exists(path):
+            continue
+        start = len(queries)
+        queries.extend(blastcache.read_queries(path))
+        ranges.append((folder, start, len(queries)))
+    if not ranges:
+        return 0
+
+    cache = blastcache.open_cache(cache_path or blastcache.default_cache_path())
+    try:
+        lines, stats = blastcache.blast_queries(queries, db, BLAST_ARGS, threads, cache)
+    finally:
+        if cache:
+            cache.close()
+    if lines is None:
+        log_message(log_file, f"Host comparison BLAST failed ({len(ranges)} folders)")
+        return 1
+
+    for folder, start, end in ranges:
+        blastcache.write_lines(os.path.join(folder, OUTPUT), lines[start:end])
+
+    log_message(log_file, f"Host comparison of {stats['queries']} ORFs in {len(ranges)} folders: "
+                          f"{stats['distinct'] - stats['searched']} of {stats['distinct']} distinct "
+                          f"sequences from cache, {stats['searched']} sent to BLAST")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the selected ORFs of sample folders with the host database.")
+    parser.add_argument('folders', nargs='+', help="Sample folders")
+    parser.add_argument('--threads', type=int, default=1, help="blastn threads (default 1)")
+    parser.add_argument('--db', default=HOST_DB, help="Host BLAST database")
+    parser.add_argument('--blast-cache', default=None, help="BLAST cache file (see blastcache.py)")
+    parser.add_argument('--log', default=None, help="Log file")
+    args = parser.parse_args()
+
+    log_file = os.path.abspath(args.log) if args.log else None
+    return run(args.folders, args.threads, os.path.abspath(args.db), args.blast_cache, log_file)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
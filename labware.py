@@ -1,24 +1,37 @@
 import csv, re
 
-with open('blast_rotavar4.csv', newline='') as infile, open('LabwareReportFromRotaFinder1.csv', 'w', newline='') as outfile:
+INPUT_FILE = 'blast_rotavar4.csv'
+OUTPUT_FILE = 'LabwareReportFromRotaFinder1.csv'
+
+
+def labware_fields(genotype):
+    """Returns the LabwareGenotype (G and P part) and Art of a genotype string."""
+    parts = genotype.split('-')
+    labware = '-'.join(parts[:2]) if len(parts) >= 2 else genotype
+
+    # Default to "Utilstrekkelig sekvens"
+    art = "UTILSTRSEKV"
+    if '-' in labware:
+        g_part, p_part = labware.split('-', 1)
+        # Check if g_part starts with 'G' followed by digits
+        if re.fullmatch(r'G\d+', g_part):
+            # p_part should be 'P' followed by digits or P[digit(s)] in square brackets
+            if re.fullmatch(r'P\d+', p_part) or re.fullmatch(r'P\[\d+\]', p_part):
+                art = "RVA"
+    return labware, art
+
+
+def write_report(infile, outfile):
+    """Writes the Labware report for the rows of a blast_rotavar4.csv file object."""
     reader = csv.DictReader(infile)
     fieldnames = reader.fieldnames + ['LabwareGenotype', 'Art']
     writer = csv.DictWriter(outfile, fieldnames=fieldnames)
     writer.writeheader()
     for row in reader:
-        genotype = row['Genotype']
-        parts = genotype.split('-')
-        labware = '-'.join(parts[:2]) if len(parts) >= 2 else genotype
-        row['LabwareGenotype'] = labware
-
-        # Default to "Utilstrekkelig sekvens"
-        art = "UTILSTRSEKV"
-        if '-' in labware:
-            g_part, p_part = labware.split('-', 1)
-            # Check if g_part starts with 'G' followed by digits
-            if re.fullmatch(r'G\d+', g_part):
-                # p_part should be 'P' followed by digits or P[digit(s)] in square brackets
-                if re.fullmatch(r'P\d+', p_part) or re.fullmatch(r'P\[\d+\]', p_part):
-                    art = "RVA"
-        row['Art'] = art
-        writer.writerow(row)
\ No newline at end of file
+        row['LabwareGenotype'], row['Art'] = labware_fields(row['Genotype'])
+        writer.writerow(row)
+
+
+if __name__ == "__main__":
+    with open(INPUT_FILE, newline='') as infile, open(OUTPUT_FILE, 'w', newline='') as outfile:
+        write_report(infile, outfile)
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+Post-BLAST stage in a single process.
+
+Does the work of evaluate3.py, summarize3.py, genotype4.py,
+update_blast_data.py, selected_contigs.py and selected_ORFs.py. The blastn
+tabular output is read once into a hit table, only the selected records of
+contigs500_COV.fasta are read through its index (fastaindex.py), and all
+output files are written from them:
+
+    blast_rota2.csv
+    blast_rota_results2.csv
+    blast_rota_genotyping4.csv
+    blast_rota_genotyping4_updated.csv
+    selected_contigs.fasta
+    selected_ORFs.fasta
+
+The files are byte-identical to the ones written by the separate scripts.
+Run from inside the sample folder.
+"""
+import csv
+import os
+import re
+import sys
+
+from fastaindex import open_fasta
+
+# Thresholds, as in evaluate3.py
+base_thresholds = {
+    'G': 80, 'P': 80, 'I': 85, 'R': 83, 'C': 84,
+    'M': 81, 'A': 79, 'N': 85, 'T': 85, 'E': 85, 'H': 91
+}
+min_lengths = {
+    'G': 500, 'P': 1163, 'I': 596, 'R': 1632, 'C': 1319,
+    'M': 1253, 'A': 740, 'N': 500, 'T': 500, 'E': 500, 'H': 500
+}
+
+# Gene letters in report order, as in genotype4.py
+gene_order = ['G', 'P', 'I', 'R', 'C', 'M', 'A', 'N', 'T', 'E', 'H']
+
+# Coverage separating high and low coverage contigs, as in summarize3.py
+HIGH_COVERAGE = 10
+
+BLAST_COLUMNS = [
+    'qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen',
+    'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore', 'sstrand',
+    'slen'
+]
+
+# Column positions in the hit table
+QSEQID, SSEQID, PIDENT, LENGTH = 0, 1, 2, 3
+QSTART, QEND, SSTRAND, SLEN = 6, 7, 12, 13
+EVALUATION = 14
+
+SUMMARY_HEADER = [
+    'Genotype',
+    'Total Count',
+    'Full Count',
+    'Partial Count',
+    'High COV Count Full',
+    'Low COV Count Full',
+    'High COV Count Partial',
+    'Low COV Count Partial'
+]
+
+
+def get_coverage(qseqid):
+    """
+    Extracts the coverage value from a qseqid.
+    Expected format: containing 'cov_<value>_'.
+    Returns 0 if extraction fails.
+    """
+    try:
+        parts = qseqid.split("cov_")
+        cov_value = float(parts[1].split("_")[0])
+        return cov_value
+    except (IndexError, ValueError):
+        return 0
+
+
+def reverse_complement(seq):
+    """Return the reverse complement of a DNA sequence."""
+    complement = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G',
+                  'a': 't', 't': 'a', 'g': 'c', 'c': 'g',
+                  'N': 'N', 'n': 'n'}
+    return "".join(complement.get(base, base) for base in reversed(seq))
+
+
+def read_hits(path):
+    """Reads blastn tabular output into a list of rows of strings."""
+    with open(path, 'r') as infile:
+        return [row for row in csv.reader(infile, delimiter='\t')]
+
+
+def evaluate_hit(row, thresholds=base_thresholds, lengths=min_lengths):
+    """Returns the Evaluation of one hit, as in evaluate3.py."""
+    pident = float(row[PIDENT])
+    length = int(row[LENGTH])
+
+    genotype = row[SSEQID].split('|')[0]
+    gene = genotype[0]
+
+    is_full = length >= int(row[SLEN])
+    threshold = thresholds[gene] if is_full else thresholds[gene] + 2
+
+    if is_full or length >= lengths[gene]:
+        if pident >= threshold:
+            return genotype
+        return f"{genotype}0000{pident}"
+    return "not accepted"
+
+
+def evaluate_hits(hits):
+    """Returns the hit table with the Evaluation column added."""
+    return [row + [evaluate_hit(row)] for row in hits]
+
+
+def write_evaluation(table, path="blast_rota2.csv"):
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(BLAST_COLUMNS + ['Evaluation'])
+        writer.writerows(table)
+
+
+def summarize(table, high_coverage=HIGH_COVERAGE):
+    """Counts full/partial and high/low coverage hits per genotype, as in summarize3.py."""
+    genotype_counts = {}
+    for row in table:
+        evaluation = row[EVALUATION]
+        if evaluation == "not accepted":
+            continue
+
+        cov = get_coverage(row[QSEQID])
+        is_full = int(row[LENGTH]) >= int(row[SLEN])
+
+        if evaluation not in genotype_counts:
+            genotype_counts[evaluation] = {
+                'count': 0, 'full': 0, 'partial': 0,
+                'high_cov_full': 0, 'low_cov_full': 0,
+                'high_cov_partial': 0, 'low_cov_partial': 0
+            }
+        counts = genotype_counts[evaluation]
+        counts['count'] += 1
+        if is_full:
+            counts['full'] += 1
+            if cov >= high_coverage:
+                counts['high_cov_full'] += 1
+            else:
+                counts['low_cov_full'] += 1
+        else:
+            counts['partial'] += 1
+            if cov >= high_coverage:
+                counts['high_cov_partial'] += 1
+            else:
+                counts['low_cov_partial'] += 1
+    return genotype_counts
+
+
+def write_summary(genotype_counts, path="blast_rota_results2.csv"):
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(SUMMARY_HEADER)
+        for genotype, counts in genotype_counts.items():
+            writer.writerow([
+                genotype,
+                counts['count'],
+                counts['full'],
+                counts['partial'],
+                counts['high_cov_full'],
+                counts['low_cov_full'],
+                counts['high_cov_partial'],
+                counts['low_cov_partial']
+            ])
+
+
+def genotype_sort_key(genotype_str):
+    gene = genotype_str[0]
+    number = ''.join(filter(str.isdigit, genotype_str))
+    try:
+        number = int(number)
+    except ValueError:
+        number = 0
+    return (gene_order.index(gene) if gene in gene_order else len(gene_order), number)
+
+
+def call_genotype(genotype_counts):
+    """
+    Selects the main genotype of every gene, as in genotype4.py.
+    Returns (genotype string, extra information string).
+    """
+    genotype_data = {gene: [] for gene in gene_order}
+    for genotype, counts in genotype_counts.items():
+        gene_letter = ''.join([char for char in genotype if char.isalpha()])[0]
+        gene_number = ''.join([char for char in genotype if char.isdigit()])
+        genotype_data[gene_letter].append({
+            'genotype': gene_number,
+            'full_count': counts['full'],
+            'partial_count': counts['partial'],
+            'high_cov_full': counts['high_cov_full']
+        })
+
+    final_genotype = []
+    extra_info = []
+
+    for gene in gene_order:
+        if not genotype_data[gene]:
+            final_genotype.append(f"{gene}X")
+            continue
+
+        top_genotypes = genotype_data[gene]
+        # genotype4.py only carries High COV Full into the tie-break; the
+        # later criteria read counts that are not stored and are always 0,
+        # so a tie in High COV Full stays a tie.
+        for criterion in ('high_cov_full', 'low_cov_full', 'high_cov_partial', 'low_cov_partial'):
+            best = max(item.get(criterion, 0) for item in top_genotypes)
+            top_genotypes = [item for item in top_genotypes if item.get(criterion, 0) == best]
+            if len(top_genotypes) == 1:
+                break
+
+        if len(top_genotypes) == 1:
+            main_genotype = top_genotypes[0]['genotype']
+            if gene == 'P':
+                final_genotype.append(f"{gene}[{main_genotype}]")
+            else:
+                final_genotype.append(f"{gene}{main_genotype}")
+        else:
+            final_genotype.append(f"{gene}?")
+            extra_info.extend(f"{gene}{item['genotype']}" for item in top_genotypes)
+
+        selected_genotypes = {item['genotype'] for item in top_genotypes}
+        extra_info.extend(
+            f"{gene}{item['genotype']}" for item in genotype_data[gene]
+            if item['genotype'] not in selected_genotypes
+        )
+
+    unique_extra_info = sorted(set(extra_info), key=genotype_sort_key)
+
+    genotype_string = "-".join(final_genotype)
+    extra_info_string = "; ".join(unique_extra_info) if unique_extra_info else "None"
+
+    if all(gt.endswith('X') for gt in final_genotype):
+        genotype_string = ""
+        extra_info_string = "None"
+    return genotype_string, extra_info_string
+
+
+def write_genotyping(folder_name, genotype_string, extra_info_string, path="blast_rota_genotyping4.csv"):
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(['Folder Name', 'Genotype', 'Extra Information'])
+        writer.writerow([folder_name, genotype_string, extra_info_string])
+
+
+def numpy_sum(values):
+    """
+    Sums floats in the order numpy does (pairwise summation in blocks of 8),
+    so averages come out bit for bit as pandas' Series.mean().
+    """
+    n = len(values)
+    if n < 8:
+        total = 0.0
+        for value in values:
+            total += value
+        return total
+    if n <= 128:
+        r = list(values[:8])
+        i = 8
+        while i < n - (n % 8):
+            for j in range(8):
+                r[j] += values[i + j]
+            i += 8
+        total = ((r[0] + r[1]) + (r[2] + r[3])) + ((r[4] + r[5]) + (r[6] + r[7]))
+        while i < n:
+            total += values[i]
+            i += 1
+        return total
+    n2 = n // 2
+    n2 -= n2 % 8
+    return numpy_sum(values[:n2]) + numpy_sum(values[n2:])
+
+
+def vaccine_similarity(table, evaluation_value):
+    """
+    Average pident of hits with the given Evaluation against a Vaccine
+    reference, as in update_blast_data.py. Returns '' if there are none.
+    """
+    values = [
+        float(row[PIDENT]) for row in table
+        if row[EVALUATION] == evaluation_value and 'vaccine' in row[SSEQID].lower()
+    ]
+    if not values:
+        return ''
+    return (0.0 + numpy_sum(values)) / len(values)
+
+
+# Values pandas.read_csv reads as missing
+PANDAS_NA_VALUES = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None',
+    'n/a', 'nan', 'null'
+}
+PANDAS_INT = re.compile(r'[+-]?\d+')
+PANDAS_FLOAT = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?|[+-]?(inf|infinity)', re.IGNORECASE)
+
+
+def pandas_field(value):
+    """
+    Returns a single CSV value as pandas writes it back after reading it
+    with read_csv: missing values become empty, numbers and booleans are
+    reformatted.
+    """
+    if value in PANDAS_NA_VALUES:
+        return ''
+    if PANDAS_INT.fullmatch(value):
+        number = int(value)
+        if -2 ** 63 <= number < 2 ** 64:
+            return str(number)
+        return repr(float(value))
+    if PANDAS_FLOAT.fullmatch(value):
+        return repr(float(value))
+    if value in ('True', 'TRUE', 'true'):
+        return 'True'
+    if value in ('False', 'FALSE', 'false'):
+        return 'False'
+    return value
+
+
+def format_similarity(value):
+    return '' if value == '' else repr(value)
+
+
+def write_genotyping_updated(folder_name, genotype_string, extra_info_string, vp7, vp4,
+                             path="blast_rota_genotyping4_updated.csv"):
+    """Writes the final results as update_blast_data.py does through pandas."""
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.writer(outfile, lineterminator='\n')
+        writer.writerow(['Folder Name', 'Genotype', 'Extra Information', 'Rotarix VP7', 'Rotarix VP4'])
+        writer.writerow([
+            pandas_field(folder_name),
+            pandas_field(genotype_string),
+            pandas_field(extra_info_string),
+            format_similarity(vp7),
+            format_similarity(vp4)
+        ])
+
+
+def select_candidates(table, high_coverage=HIGH_COVERAGE):
+    """
+    Selects one contig per genotype, as in selected_contigs.py and
+    selected_ORFs.py: the full-length contig with the best coverage, or else
+    the longest partial contig. Returns {genotype: candidate}.
+    """
+    full_candidates = {}
+    partial_candidates = {}
+    for row in table:
+        genotype = row[EVALUATION]
+        if genotype == "not accepted":
+            continue
+
+        try:
+            length = int(row[LENGTH])
+            slen = int(row[SLEN])
+            qstart = int(row[QSTART])
+            qend = int(row[QEND])
+        except ValueError:
+            continue
+
+        qseqid = row[QSEQID]
+        cov = get_coverage(qseqid)
+        sstrand = row[SSTRAND] if len(row) > SSTRAND else '+'
+
+        if length >= slen:
+            candidate = {'qseqid': qseqid, 'coverage': cov, 'qstart': qstart, 'qend': qend, 'sstrand': sstrand}
+            if genotype not in full_candidates:
+                full_candidates[genotype] = candidate
+            else:
+                current_cov = full_candidates[genotype]['coverage']
+                current_is_high = current_cov >= high_coverage
+                new_is_high = cov >= high_coverage
+                if current_is_high and not new_is_high:
+                    continue
+                elif not current_is_high and new_is_high:
+                    full_candidates[genotype] = candidate
+                elif cov > current_cov:
+                    full_candidates[genotype] = candidate
+        else:
+            candidate = {'qseqid': qseqid, 'length': length, 'qstart': qstart, 'qend': qend, 'sstrand': sstrand}
+            if genotype not in partial_candidates:
+                partial_candidates[genotype] = candidate
+            elif length > partial_candidates[genotype]['length']:
+                partial_candidates[genotype] = candidate
+
+    selected_candidates = {}
+    all_genotypes = set(full_candidates.keys()).union(set(partial_candidates.keys()))
+    for genotype in all_genotypes:
+        if genotype in full_candidates:
+            candidate = full_candidates[genotype]
+            candidate['type'] = 'full'
+            selected_candidates[genotype] = candidate
+        elif genotype in partial_candidates:
+            candidate = partial_candidates[genotype]
+            candidate['type'] = 'partial'
+            selected_candidates[genotype] = candidate
+    return selected_candidates
+
+
+def write_wrapped(outfile, header, sequence):
+    outfile.write(header + "\n")
+    for i in range(0, len(sequence), 70):
+        outfile.write(sequence[i:i+70] + "\n")
+
+
+def write_selected_contigs(selected_candidates, fasta, path="selected_contigs.fasta"):
+    with open(path, 'w') as outfile:
+        for genotype, candidate in selected_candidates.items():
+            qseqid = candidate['qseqid']
+            if qseqid not in fasta:
+                print(f"Warning: qseqid {qseqid} not found in FASTA file.")
+                continue
+            original_header, sequence = fasta.get(qseqid)
+            if candidate['type'] == 'partial':
+                new_header = f">{genotype}_PARTIAL_{original_header[1:]}"
+            else:
+                new_header = f">{genotype}_{original_header[1:]}"
+            write_wrapped(outfile, new_header, sequence)
+
+
+def write_selected_orfs(selected_candidates, fasta, path="selected_ORFs.fasta"):
+    with open(path, 'w') as outfile:
+        for genotype, candidate in selected_candidates.items():
+            qseqid = candidate['qseqid']
+            if qseqid not in fasta:
+                print(f"Warning: qseqid {qseqid} not found in FASTA file.")
+                continue
+            original_header = fasta.header(qseqid)
+            orf_seq = fasta.fetch(qseqid, candidate['qstart']-1, candidate['qend'])
+            if candidate['sstrand'].strip() == 'minus':
+                orf_seq = reverse_complement(orf_seq)
+
+            if candidate['type'] == 'partial':
+                new_header = f">{genotype}_PARTIAL_ORF_{original_header[1:]}"
+            else:
+                new_header = f">{genotype}_ORF_{original_header[1:]}"
+            write_wrapped(outfile, new_header, orf_seq)
+
+
+def run(blast_output="blast_rota2.txt", input_fasta="contigs500_COV.fasta", folder_name=None):
+    """Runs the whole post-BLAST stage in the current folder."""
+    if folder_name is None:
+        folder_name = os.path.basename(os.getcwd())
+
+    table = evaluate_hits(read_hits(blast_output))
+    write_evaluation(table)
+
+    genotype_counts = summarize(table)
+    write_summary(genotype_counts)
+
+    genotype_string, extra_info_string = call_genotype(genotype_counts)
+    write_genotyping(folder_name, genotype_string, extra_info_string)
+
+    vp7 = vaccine_similarity(table, 'G1')
+    vp4 = vaccine_similarity(table, 'P8')
+    write_genotyping_updated(folder_name, genotype_string, extra_info_string, vp7, vp4)
+
+    selected_candidates = select_candidates(table)
+    with open_fasta(input_fasta) as fasta:
+        write_selected_contigs(selected_candidates, fasta)
+        write_selected_orfs(selected_candidates, fasta)
+
+    print("Post-BLAST results have been generated for:", folder_name)
+
+
+if __name__ == "__main__":
+    run(*sys.argv[1:3])
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+K-mer prescreen of the rotadb BLAST query.
+
+blastn (task megablast, word size 28) only reports a contig if it shares
+an exact 28-base word with a reference on either strand. The prescreen
+indexes every 28-mer of 241130_rotadb (canonical codes of both strands in a
+sorted numpy array, about 6 MB) and keeps the contigs of
+contigs500_COV.fasta that share at least one of them; contigs without such a
+word cannot hit, so no contig that BLAST would report is dropped. Like
+BLAST, words containing a base other than A, C, G or T are not used.
+
+Kept records are written unchanged to contigs500_COV_prescreen.fasta, which
+rotablast2.sh then uses as the blastn query. If the database cannot be read,
+all contigs are kept.
+
+Usage:
+    python3 prescreen.py [input fasta] [output fasta] [--db 241130_rotadb] [--log log.txt]
+"""
+import argparse
+import os
+import shutil
+import struct
+import sys
+
+import numpy as np
+
+from rotadb import ROTADB, BlastDb
+from scheduler import log_message
+
+INPUT_FASTA = "contigs500_COV.fasta"
+PRESCREEN_FASTA = "contigs500_COV_prescreen.fasta"
+
+# Set by RotaFinder.sh --prescreen
+PRESCREEN_ENV = 'ROTAFINDER_PRESCREEN'
+
+# Word size of blastn's default task (megablast)
+WORD_SIZE = 28
+
+# Byte value -> 2-bit code, 4 for anything that is not A, C, G or T
+ENCODING = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    ENCODING[base] = code
+    ENCODING[base + 32] = code  # lower case
+
+
+def query_name():
+    """Name of the rotadb BLAST query file, depending on ROTAFINDER_PRESCREEN."""
+    return PRESCREEN_FASTA if os.environ.get(PRESCREEN_ENV) else INPUT_FASTA
+
+
+def canonical_kmers(codes, k=WORD_SIZE):
+    """
+    Returns (canonical, valid) for every k-mer start of a sequence of 2-bit
+    codes: the canonical code (smaller of both strands) and whether the
+    k-mer has no ambiguous base (code 4).
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=bool)
+    invalid = codes > 3
+    values = np.where(invalid, 0, codes).astype(np.uint64)
+    forward = np.zeros(n, dtype=np.uint64)
+    reverse = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        window = values[j:j + n]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * j)
+    canonical = np.minimum(forward, reverse)
+    counts = np.concatenate(([0], np.cumsum(invalid)))
+    return canonical, counts[k:] == counts[:-k]
+
+
+def kmer_codes(codes, k=WORD_SIZE):
+    """
+    Returns the canonical code (smaller of both strands) of every k-mer of a
+    sequence of 2-bit codes, leaving out k-mers with an ambiguous base (code 4).
+    """
+    canonical, valid = canonical_kmers(codes, k)
+    return canonical[valid]
+
+
+def build_index(db_prefix=ROTADB, k=WORD_SIZE):
+    """Sorted array of the canonical k-mer codes of all database sequences."""
+    db = BlastDb(db_prefix)
+    return np.unique(np.concatenate([kmer_codes(db.codes(oid), k) for oid in range(len(db))]))
+
+
+def shares_kmer(sequence, index, k=WORD_SIZE):
+    codes = ENCODING[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+    query = kmer_codes(codes, k)
+    if len(query) == 0 or len(index) == 0:
+        return False
+    positions = np.searchsorted(index, query)
+    np.minimum(positions, len(index) - 1, out=positions)
+    return bool(np.any(index[positions] == query))
+
+
+def read_records(path):
+    """Yields (lines, sequence) per record; lines are the record's lines as read."""
+    lines = []
+    seq_lines = []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                if lines:
+                    yield lines, ''.join(seq_lines)
+                lines = [line]
+                seq_lines = []
+            elif lines:
+                lines.append(line)
+                seq_lines.append(line.strip())
+    if lines:
+        yield lines, ''.join(seq_lines)
+
+
+def prescreen(input_fasta=INPUT_FASTA, output_fasta=PRESCREEN_FASTA, db_prefix=ROTADB):
+    """Writes the contigs sharing a word with the database; returns (kept, total)."""
+    try:
+        index = build_index(db_prefix)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Warning: prescreen cannot read {db_prefix} ({e}); keeping all contigs.")
+        shutil.copyfile(input_fasta, output_fasta)
+        total = sum(1 for _ in read_records(input_fasta))
+        return total, total
+
+    kept = total = 0
+    with open(output_fasta, 'w') as out:
+        for lines, sequence in read_records(input_fasta):
+            total += 1
+            if shares_kmer(sequence, index):
+                kept += 1
+                out.writelines(lines)
+    return kept, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drop contigs that share no BLAST seed word with rotadb.")
+    parser.add_argument('input', nargs='?', default=INPUT_FASTA, help=f"Input FASTA (default {INPUT_FASTA})")
+    parser.add_argument('output', nargs='?', default=PRESCREEN_FASTA, help=f"Output FASTA (default {PRESCREEN_FASTA})")
+    parser.add_argument('--db', default=ROTADB, help="BLAST database (default 241130_rotadb)")
+    parser.add_argument('--log', default=None, help="Log file for the number of dropped contigs")
+    args = parser.parse_args()
+
+    kept, total = prescreen(args.input, args.output, args.db)
+    folder_name = os.path.basename(os.getcwd())
+    log_message(args.log, f"Prescreen: {total - kept} of {total} contigs dropped, {kept} sent to BLAST in {folder_name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+"""
+Genotypes the samples of a whole archive again under new cutoffs.
+
+The blast_rota2.csv files kept in the sample folders (rotablast2.sh removes
+blast_rota2.txt, but not this file) are read into one columnar table: a
+numpy array per column holding the hits of all samples. The evaluation of
+evaluate3.py, the counts of summarize3.py and the genotype selection of
+genotype4.py are then done with array operations over all hits at once,
+with the cutoffs given on the command line instead of the ones in
+postblast.py:
+
+    --threshold G=82        base identity threshold of a gene (partial hits
+                            need 2 more, as in evaluate3.py)
+    --min-length G=600      minimum length of a partial hit of a gene
+    --high-coverage 10      coverage of high coverage contigs
+
+For every sample, blast_rota2.csv, blast_rota_results2.csv and
+blast_rota_genotyping4_updated.csv (with the Rotarix VP7/VP4 similarity of
+update_blast_data.py) are written with the writers of postblast.py, so they
+are the files a rerun with the same cutoffs would write. Files whose
+content does not change are left as they are. blast_rotavar4.csv and the
+Labware report are written again in every run folder that has them and
+in which a sample changed. selected_contigs.fasta, selected_ORFs.fasta and
+the host comparison are not redone (they need the contigs).
+
+The calls that changed are written to --changes (Run Folder, Folder Name
+and the old and new Genotype, Extra Information and Rotarix values).
+With --dry-run only that file is written.
+
+With --table the columnar table is kept in a .npz file: on the next run
+only the blast_rota2.csv files that changed since are read again.
+
+Usage:
+    python3 regenotype.py ARCHIVE [ARCHIVE ...] [--threshold G=82] [--min-length G=600]
+                          [--high-coverage 10] [--changes regenotype_changes.csv]
+                          [--table archive.npz] [--db results.sqlite] [--dry-run]
+"""
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+import labware
+import postblast
+import resultsdb
+
+EVALUATION_FILE = 'blast_rota2.csv'
+SUMMARY_FILE = 'blast_rota_results2.csv'
+GENOTYPING_FILE = 'blast_rota_genotyping4_updated.csv'
+CHANGES_FILE = 'regenotype_changes.csv'
+
+GENES = postblast.gene_order
+GENE_INDEX = {gene: i for i, gene in enumerate(GENES)}
+
+# Rotarix column -> genotype of the vaccine strain, as in update_blast_data.py
+VACCINE_GENOTYPES = {'Rotarix VP7': 'G1', 'Rotarix VP4': 'P8'}
+
+CHANGES_HEADER = ['Run Folder', 'Folder Name',
+                  'Old Genotype', 'New Genotype',
+                  'Old Extra Information', 'New Extra Information',
+                  'Old Rotarix VP7', 'New Rotarix VP7',
+                  'Old Rotarix VP4', 'New Rotarix VP4']
+
+# Columns of the hit table, one value per hit
+HIT_COLUMNS = {
+    'gene': np.int8,         # index in GENES
+    'pident': np.float64,
+    'length': np.int64,
+    'slen': np.int64,
+    'coverage': np.float64,  # from the contig name
+    'vaccine': np.bool_,     # hit against a Vaccine reference
+    'accepted': np.int32,    # label of the hit if accepted: its genotype
+    'rejected': np.int32,    # label if only the identity is too low
+    'old': np.int32,         # Evaluation in the file, -1 for "not accepted"
+}
+
+
+class Labels:
+    """Evaluation strings of all hits, each kept once and referred to by number."""
+
+    def __init__(self, strings=()):
+        self.strings = list(strings)
+        self.codes = {string: i for i, string in enumerate(self.strings)}
+
+    def code(self, string):
+        if string not in self.codes:
+            self.codes[string] = len(self.strings)
+            self.strings.append(string)
+        return self.codes[string]
+
+    def gene_numbers(self):
+        """Returns (gene index, genotype number) arrays of the labels, as genotype4.py reads them."""
+        genes = np.array([GENE_INDEX.get(string[0], -1) for string in self.strings], dtype=np.int64)
+        numbers = [''.join(char for char in string if char.isdigit()) for string in self.strings]
+        return genes, numbers
+
+
+def read_sample(path, labels):
+    """Reads blast_rota2.csv of a sample into {column: array} of HIT_COLUMNS."""
+    columns = {name: [] for name in HIT_COLUMNS}
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if not row:
+                continue
+            genotype = row[postblast.SSEQID].split('|')[0]
+            if not genotype or genotype[0] not in GENE_INDEX:
+                raise ValueError(f"unknown gene in {row[postblast.SSEQID]}")
+            pident = float(row[postblast.PIDENT])
+            columns['gene'].append(GENE_INDEX[genotype[0]])
+            columns['pident'].append(pident)
+            columns['length'].append(int(row[postblast.LENGTH]))
+            columns['slen'].append(int(row[postblast.SLEN]))
+            columns['coverage'].append(postblast.get_coverage(row[postblast.QSEQID]))
+            columns['vaccine'].append('vaccine' in row[postblast.SSEQID].lower())
+            columns['accepted'].append(labels.code(genotype))
+            columns['rejected'].append(labels.code(f"{genotype}0000{pident}"))
+            old = row[postblast.EVALUATION]
+            columns['old'].append(-1 if old == "not accepted" else labels.code(old))
+    return {name: np.array(values, dtype=HIT_COLUMNS[name]) for name, values in columns.items()}
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class HitTable:
+    """The hits of all samples: one array per column, the hits of each sample together."""
+
+    def __init__(self, folders, columns, offsets, labels, stats):
+        self.folders = folders
+        self.columns = columns
+        self.offsets = offsets
+        self.labels = labels
+        self.stats = stats
+        self.sample = np.repeat(np.arange(len(folders)), np.diff(offsets))
+
+    def __len__(self):
+        return len(self.sample)
+
+    def rows(self, i):
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    @classmethod
+    def load(cls, folders, table_path=None):
+        """
+        Reads the blast_rota2.csv files of the folders; with table_path, the
+        hits of files unchanged since the table was saved are taken from it.
+        Returns (table, number of files read, folders that could not be read).
+        """
+        saved = {}
+        labels = Labels()
+        if table_path and os.path.exists(table_path):
+            with np.load(table_path) as data:
+                labels = Labels(data['labels'].tolist())
+                offsets = data['offsets']
+                saved_columns = {name: data[name] for name in HIT_COLUMNS}
+                for i, (folder, size, mtime) in enumerate(zip(data['folders'].tolist(), data['sizes'], data['mtimes'])):
+                    rows = slice(offsets[i], offsets[i + 1])
+                    saved[folder] = ((int(size), int(mtime)), {name: saved_columns[name][rows] for name in HIT_COLUMNS})
+
+        chunks, kept, stats, failed = [], [], [], []
+        read = 0
+        for folder in folders:
+            path = os.path.join(folder, EVALUATION_FILE)
+            stat = file_stat(path)
+            if folder in saved and saved[folder][0] == stat:
+                chunk = saved[folder][1]
+            else:
+                try:
+                    chunk = read_sample(path, labels)
+                except (ValueError, IndexError) as e:
+                    print(f"Skipping {folder}: {e}")
+                    failed.append(folder)
+                    continue
+                read += 1
+            chunks.append(chunk)
+            kept.append(folder)
+            stats.append(stat)
+
+        columns = {name: np.concatenate([chunk[name] for chunk in chunks]) if chunks
+                   else np.array([], dtype=dtype) for name, dtype in HIT_COLUMNS.items()}
+        offsets = np.concatenate([[0], np.cumsum([len(chunk['gene']) for chunk in chunks], dtype=np.int64)])
+        return cls(kept, columns, offsets.astype(np.int64), labels, stats), read, failed
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path,
+                 folders=np.array(self.folders, dtype=str),
+                 sizes=np.array([size for size, _ in self.stats], dtype=np.int64),
+                 mtimes=np.array([mtime for _, mtime in self.stats], dtype=np.int64),
+                 offsets=self.offsets,
+                 labels=np.array(self.labels.strings, dtype=str),
+                 **self.columns)
+        os.replace(tmp_path, path)
+
+
+def evaluate(table, thresholds, min_lengths):
+    """
+    Evaluation label of every hit, as evaluate3.py decides it; -1 for "not
+    accepted". Returns (labels, full-length mask).
+    """
+    c = table.columns
+    base = np.array([thresholds[gene] for gene in GENES], dtype=np.float64)[c['gene']]
+    lengths = np.array([min_lengths[gene] for gene in GENES], dtype=np.int64)[c['gene']]
+    is_full = c['length'] >= c['slen']
+    threshold = np.where(is_full, base, base + 2)
+    long_enough = is_full | (c['length'] >= lengths)
+    evaluation = np.where(c['pident'] >= threshold, c['accepted'], c['rejected'])
+    return np.where(long_enough, evaluation, -1), is_full
+
+
+def count_genotypes(table, evaluation, is_full, high_coverage):
+    """
+    Counts of summarize3.py for every (sample, label) at once. Returns
+    (sample, label, counts) arrays, counts with the columns of
+    postblast.SUMMARY_HEADER after Genotype; groups in the order the
+    labels first appear in each sample, as summarize3.py writes them.
+    """
+    accepted = evaluation >= 0
+    n_labels = max(len(table.labels.strings), 1)
+    key = table.sample[accepted].astype(np.int64) * n_labels + evaluation[accepted]
+    keys, first, group = np.unique(key, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    # Group numbers in output order
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    group = rank[group]
+
+    full = is_full[accepted]
+    high = table.columns['coverage'][accepted] >= high_coverage
+    n_groups = len(keys)
+    counts = np.stack([
+        np.bincount(group, minlength=n_groups),
+        np.bincount(group, weights=full, minlength=n_groups),
+        np.bincount(group, weights=~full, minlength=n_groups),
+        np.bincount(group, weights=full & high, minlength=n_groups),
+        np.bincount(group, weights=full & ~high, minlength=n_groups),
+        np.bincount(group, weights=~full & high, minlength=n_groups),
+        np.bincount(group, weights=~full & ~high, minlength=n_groups),
+    ], axis=1).astype(np.int64)
+    keys = keys[order]
+    return keys // n_labels, keys % n_labels, counts
+
+
+def select_main(sample, genes, high_cov_full):
+    """
+    The genotype4.py choice for every (sample, gene) at once: the genotypes
+    with the most high coverage full-length hits. Returns a mask of the
+    chosen rows and the number chosen in their (sample, gene).
+    """
+    key = sample * len(GENES) + genes
+    best = np.full(key.max() + 1 if len(key) else 0, -1, dtype=np.int64)
+    np.maximum.at(best, key, high_cov_full)
+    chosen = high_cov_full == best[key]
+    n_chosen = np.bincount(key[chosen], minlength=len(best))
+    return chosen, n_chosen[key]
+
+
+def call_strings(items):
+    """
+    Genotype and Extra Information strings of a sample from its
+    [(gene index, number, chosen, number chosen)] in summary order, as
+    genotype4.py writes them.
+    """
+    final_genotype = []
+    extra_info = []
+    by_gene = [[] for _ in GENES]
+    for gene, number, chosen, n_chosen in items:
+        by_gene[gene].append((number, chosen, n_chosen))
+
+    for gene, gene_items in zip(GENES, by_gene):
+        if not gene_items:
+            final_genotype.append(f"{gene}X")
+            continue
+        top = [number for number, chosen, _ in gene_items if chosen]
+        if gene_items[0][2] == 1:
+            final_genotype.append(f"{gene}[{top[0]}]" if gene == 'P' else f"{gene}{top[0]}")
+        else:
+            final_genotype.append(f"{gene}?")
+            extra_info.extend(f"{gene}{number}" for number in top)
+        selected = set(top)
+        extra_info.extend(f"{gene}{number}" for number, _, _ in gene_items if number not in selected)
+
+    if all(genotype.endswith('X') for genotype in final_genotype):
+        return "", "None"
+    unique_extra_info = sorted(set(extra_info), key=postblast.genotype_sort_key)
+    return "-".join(final_genotype), "; ".join(unique_extra_info) if unique_extra_info else "None"
+
+
+def vaccine_averages(table, evaluation):
+    """
+    {sample: {Rotarix column: average pident}} of the samples with accepted
+    G1/P8 hits against Vaccine references; each average is summed with
+    numpy in row order, as pandas' mean in update_blast_data.py.
+    """
+    averages = {}
+    vaccine = table.columns['vaccine']
+    for column, genotype in VACCINE_GENOTYPES.items():
+        code = table.labels.codes.get(genotype)
+        if code is None:
+            continue
+        hits = np.flatnonzero(vaccine & (evaluation == code))
+        if not len(hits):
+            continue
+        samples = table.sample[hits]
+        starts = np.flatnonzero(np.r_[True, samples[1:] != samples[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(hits)]):
+            pident = table.columns['pident'][hits[start:end]]
+            averages.setdefault(int(samples[start]), {})[column] = float(pident.sum() / len(pident))
+    return averages
+
+
+def regenotype(table, thresholds, min_lengths, high_coverage):
+    """
+    Returns the evaluation of every hit and, per sample, (summary counts
+    {label: counts}, genotype string, extra information string, {Rotarix
+    column: average}).
+    """
+    evaluation, is_full = evaluate(table, thresholds, min_lengths)
+    sample, label, counts = count_genotypes(table, evaluation, is_full, high_coverage)
+    label_genes, label_numbers = table.labels.gene_numbers()
+    genes = label_genes[label]
+    chosen, n_chosen = select_main(sample, genes, counts[:, 3])
+    averages = vaccine_averages(table, evaluation)
+
+    results = []
+    bounds = np.searchsorted(sample, np.arange(len(table.folders) + 1))
+    for i in range(len(table.folders)):
+        rows = range(bounds[i], bounds[i + 1])
+        summary = {}
+        for j in rows:
+            total, full, partial, high_full, low_full, high_partial, low_partial = counts[j].tolist()
+            summary[table.labels.strings[label[j]]] = {
+                'count': total, 'full': full, 'partial': partial,
+                'high_cov_full': high_full, 'low_cov_full': low_full,
+                'high_cov_partial': high_partial, 'low_cov_partial': low_partial
+            }
+        genotype_string, extra_info_string = call_strings(
+            [(genes[j], label_numbers[label[j]], chosen[j], n_chosen[j]) for j in rows])
+        results.append((summary, genotype_string, extra_info_string, averages.get(i, {})))
+    return evaluation, results
+
+
+def replace_if_changed(path, write):
+    """Writes a file through write(tmp_path) and keeps it only if it differs; returns True if replaced."""
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    if os.path.exists(path):
+        with open(path, 'rb') as old, open(tmp_path, 'rb') as new:
+            if old.read() == new.read():
+                os.remove(tmp_path)
+                return False
+    os.replace(tmp_path, path)
+    return True
+
+
+def rewrite_evaluation(folder, evaluation, labels, path):
+    """blast_rota2.csv of a folder with the new Evaluation column."""
+    with open(os.path.join(folder, EVALUATION_FILE), 'r', newline='') as f:
+        rows = [row for row in list(csv.reader(f))[1:] if row]
+    table = [row[:postblast.EVALUATION] + ["not accepted" if code < 0 else labels.strings[code]]
+             for row, code in zip(rows, evaluation.tolist())]
+    postblast.write_evaluation(table, path)
+
+
+def read_call(folder):
+    """Genotype, Extra Information, Rotarix VP7 and VP4 of blast_rota_genotyping4_updated.csv, or None."""
+    path = os.path.join(folder, GENOTYPING_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', newline='') as f:
+        rows = list(csv.reader(f))
+    if len(rows) < 2:
+        return None
+    values = dict(zip(rows[0], rows[1]))
+    return [values.get(column, '') for column in ('Genotype', 'Extra Information', 'Rotarix VP7', 'Rotarix VP4')]
+
+
+def new_call(genotype_string, extra_info_string, averages):
+    """The same values as blast_rota_genotyping4_updated.csv holds them."""
+    return [postblast.pandas_field(genotype_string), postblast.pandas_field(extra_info_string)] + \
+        [postblast.format_similarity(averages.get(column, '')) for column in VACCINE_GENOTYPES]
+
+
+def write_run_tables(run_dir):
+    """blast_rotavar4.csv and the Labware report of a run folder from its sample files."""
+    tables = []
+    for name in sorted(os.listdir(run_dir)):
+        path = os.path.join(run_dir, name, GENOTYPING_FILE)
+        if os.path.isfile(path):
+            with open(path, 'r', newline='') as f:
+                tables.append((name, f.read()))
+    merged = resultsdb.merge_genotyping(tables)
+    with open(os.path.join(run_dir, labware.INPUT_FILE), 'w', newline='') as f:
+        f.write(merged)
+    with open(os.path.join(run_dir, labware.OUTPUT_FILE), 'w', newline='') as f:
+        labware.write_report(io.StringIO(merged, newline=''), f)
+
+
+def find_samples(archives):
+    """Sample folders (with blast_rota2.csv) below the archive folders, sorted."""
+    folders = []
+    for archive in archives:
+        for dirpath, dirnames, filenames in os.walk(archive):
+            dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+            if EVALUATION_FILE in filenames:
+                folders.append(os.path.abspath(dirpath))
+    return sorted(set(folders))
+
+
+def parse_cutoffs(values, defaults, kind):
+    cutoffs = dict(defaults)
+    for value in values or []:
+        gene, _, number = value.partition('=')
+        if gene not in cutoffs or not number:
+            raise SystemExit(f"{kind} must be GENE=VALUE with GENE one of {''.join(GENES)}: {value}")
+        cutoffs[gene] = float(number) if kind == 'threshold' else int(number)
+    return cutoffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genotype the samples of an archive again under new cutoffs.")
+    parser.add_argument('archives', nargs='+', help="Archive, run or sample folders")
+    parser.add_argument('--threshold', action='append', metavar='GENE=PIDENT',
+                        help="Base identity threshold of a gene (default: as in evaluate3.py)")
+    parser.add_argument('--min-length', action='append', metavar='GENE=LENGTH',
+                        help="Minimum partial hit length of a gene (default: as in evaluate3.py)")
+    parser.add_argument('--high-coverage', type=float, default=postblast.HIGH_COVERAGE,
+                        help=f"Coverage of high coverage contigs (default {postblast.HIGH_COVERAGE})")
+    parser.add_argument('--changes', default=CHANGES_FILE, help=f"Changed calls (default {CHANGES_FILE})")
+    parser.add_argument('--table', default=None, help="Keep the hit table in this .npz file between runs")
+    parser.add_argument('--db', default=None, help="Also update the changed samples in this results file")
+    parser.add_argument('--dry-run', action='store_true', help="Only write the changed calls")
+    args = parser.parse_args()
+
+    thresholds = parse_cutoffs(args.threshold, postblast.base_thresholds, 'threshold')
+    min_lengths = parse_cutoffs(args.min_length, postblast.min_lengths, 'min-length')
+
+    start = time.time()
+    folders = find_samples(args.archives)
+    table, read, failed = HitTable.load(folders, args.table)
+    print(f"{len(table)} hits of {len(table.folders)} samples loaded in {time.time() - start:.1f} seconds "
+          f"({read} files read)")
+
+    start = time.time()
+    evaluation, results = regenotype(table, thresholds, min_lengths, args.high_coverage)
+    print(f"Genotyped again in {time.time() - start:.1f} seconds")
+
+    start = time.time()
+    changes = []
+    changed_runs = set()
+    rewritten = 0
+    db = resultsdb.ResultsDb(args.db) if args.db and not args.dry_run else None
+    for i, (folder, (summary, genotype_string, extra_info_string, averages)) in enumerate(zip(table.folders, results)):
+        old = read_call(folder)
+        new = new_call(genotype_string, extra_info_string, averages)
+        run_dir, name = os.path.split(folder)
+        if old != new:
+            old = old or [''] * len(new)
+            changes.append([run_dir, name] + [value for pair in zip(old, new) for value in pair])
+        if args.dry_run:
+            continue
+
+        sample_evaluation = evaluation[table.rows(i)]
+        # blast_rota2.csv is only read again if an evaluation changed
+        files = [
+            not np.array_equal(sample_evaluation, table.columns['old'][table.rows(i)]) and
+            replace_if_changed(os.path.join(folder, EVALUATION_FILE), lambda path: rewrite_evaluation(
+                folder, sample_evaluation, table.labels, path)),
+            replace_if_changed(os.path.join(folder, SUMMARY_FILE), lambda path: postblast.write_summary(
+                summary, path)),
+            replace_if_changed(os.path.join(folder, GENOTYPING_FILE), lambda path: postblast.write_genotyping_updated(
+                name, genotype_string, extra_info_string, averages.get('Rotarix VP7', ''),
+                averages.get('Rotarix VP4', ''), path)),
+        ]
+        if any(files):
+            rewritten += 1
+            table.stats[i] = file_stat(os.path.join(folder, EVALUATION_FILE))
+            table.columns['old'][table.rows(i)] = sample_evaluation
+            if files[2]:
+                changed_runs.add(run_dir)
+                if db is not None:
+                    resultsdb.add_folder(db, folder, run_dir)
+    if db is not None:
+        db.close()
+
+    for run_dir in sorted(changed_runs):
+        if os.path.exists(os.path.join(run_dir, labware.INPUT_FILE)):
+            write_run_tables(run_dir)
+
+    with open(args.changes, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CHANGES_HEADER)
+        writer.writerows(changes)
+    if args.table and not args.dry_run:
+        table.save(args.table)
+
+    print(f"{len(changes)} of {len(table.folders)} calls changed (written to {args.changes})"
+          + ("" if args.dry_run else f", files of {rewritten} samples and {len(changed_runs)} runs updated "
+                                     f"in {time.time() - start:.1f} seconds"))
+    if failed:
+        print(f"{len(failed)} samples could not be read")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
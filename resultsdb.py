@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Results of all runs in one SQLite file, updated per sample.
+
+Each sample is added as soon as its post-BLAST step is done (rotablast2.sh
+runs `resultsdb.py add` when $ROTAFINDER_RESULTS_DB is set, which
+RotaFinder.sh --results-db FILE and watch.py do): its genotype, extra information and Rotarix VP7/VP4
+similarity from blast_rota_genotyping4_updated.csv, and the hit counts per
+genotype from blast_rota_results2.csv. A sample is keyed by the run folder
+and its folder name, so a rerun replaces it.
+
+The run tables are made from the file at any time, also while a run is
+still going or after some samples failed: `export` writes
+blast_rotavar4.csv (the same file as merging the sample files in the shell)
+and LabwareReportFromRotaFinder1.csv (labware.py). `find` looks up samples
+and genotypes across runs.
+
+Usage:
+    python3 resultsdb.py add [folder ...]
+    python3 resultsdb.py export [--run-dir DIR] [--output blast_rotavar4.csv]
+                                [--labware LabwareReportFromRotaFinder1.csv] [folder ...]
+        with folders, these in this order, after adding the ones whose
+        results are newer than in the file; folders without
+        blast_rota_genotyping4_updated.csv are left out
+    python3 resultsdb.py find [--folder NAME] [--genotype G9] [--run-dir DIR]
+
+Results file: --db, $ROTAFINDER_RESULTS_DB or results.sqlite in the current
+folder.
+"""
+import argparse
+import csv
+import io
+import os
+import sqlite3
+import sys
+import time
+
+import labware
+import shard
+from postblast import SUMMARY_HEADER
+
+# Set by RotaFinder.sh
+RESULTS_DB_ENV = 'ROTAFINDER_RESULTS_DB'
+RUN_DIR_ENV = 'ROTAFINDER_RUN_DIR'
+RUN_ENV = 'ROTAFINDER_RUN_ID'
+
+RESULTS_DB_NAME = 'results.sqlite'
+GENOTYPING_FILE = 'blast_rota_genotyping4_updated.csv'
+SUMMARY_FILE = 'blast_rota_results2.csv'
+
+COUNT_COLUMNS = ['total', 'full', 'partial', 'high_cov_full', 'low_cov_full',
+                 'high_cov_partial', 'low_cov_partial']
+
+
+def default_db_path():
+    return os.environ.get(RESULTS_DB_ENV) or os.path.abspath(RESULTS_DB_NAME)
+
+
+def default_run_dir(folder):
+    """The run folder: $ROTAFINDER_RUN_DIR, or else the parent of the sample folder."""
+    return os.environ.get(RUN_DIR_ENV) or os.path.dirname(os.path.abspath(folder))
+
+
+class ResultsDb:
+    """SQLite file with one row per sample and run, and its counts per genotype."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Samples finish at the same time in parallel mode
+        self.conn = sqlite3.connect(path, timeout=600)
+        self.conn.execute(f'PRAGMA journal_mode={shard.sqlite_journal_mode()}')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS samples ('
+            ' run_dir TEXT NOT NULL, folder TEXT NOT NULL, run_id TEXT,'
+            ' genotype TEXT, extra_information TEXT, rotarix_vp7 TEXT, rotarix_vp4 TEXT,'
+            ' genotyping_csv TEXT NOT NULL, updated REAL NOT NULL,'
+            ' PRIMARY KEY (run_dir, folder))'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS counts ('
+            ' run_dir TEXT NOT NULL, folder TEXT NOT NULL, genotype TEXT NOT NULL, '
+            + ', '.join(f'{column} INTEGER' for column in COUNT_COLUMNS) +
+            ', PRIMARY KEY (run_dir, folder, genotype))'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS samples_folder ON samples (folder)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS counts_genotype ON counts (genotype)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, run_dir, folder, genotyping_csv, counts, run_id=None):
+        """Adds or replaces a sample; counts is a list of SUMMARY_HEADER rows."""
+        rows = list(csv.reader(io.StringIO(genotyping_csv)))
+        values = dict(zip(rows[0], rows[1])) if len(rows) > 1 else {}
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO samples (run_dir, folder, run_id, genotype, extra_information,'
+                ' rotarix_vp7, rotarix_vp4, genotyping_csv, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_dir, folder, run_id, values.get('Genotype'), values.get('Extra Information'),
+                 values.get('Rotarix VP7'), values.get('Rotarix VP4'), genotyping_csv, time.time()))
+            self.conn.execute('DELETE FROM counts WHERE run_dir = ? AND folder = ?', (run_dir, folder))
+            self.conn.executemany(
+                f"INSERT INTO counts (run_dir, folder, genotype, {', '.join(COUNT_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * (len(COUNT_COLUMNS) + 3))})",
+                [(run_dir, folder, row[0], *(int(value) for value in row[1:])) for row in counts])
+
+    def updated(self, run_dir, folder):
+        """Time a sample was last added, or None."""
+        row = self.conn.execute('SELECT updated FROM samples WHERE run_dir = ? AND folder = ?',
+                                (run_dir, folder)).fetchone()
+        return row[0] if row else None
+
+    def genotyping(self, run_dir, folders=None):
+        """Returns [(folder, genotyping_csv)] of a run, of the given folders in their order or all by name."""
+        if folders is None:
+            return self.conn.execute('SELECT folder, genotyping_csv FROM samples WHERE run_dir = ? '
+                                     'ORDER BY folder', (run_dir,)).fetchall()
+        found = dict(self.conn.execute('SELECT folder, genotyping_csv FROM samples WHERE run_dir = ?',
+                                       (run_dir,)))
+        return [(folder, found[folder]) for folder in folders if folder in found]
+
+    def find(self, folder=None, genotype=None, run_dir=None):
+        """Samples by folder name, run folder and/or a genotype among their counts, newest first."""
+        query = ('SELECT run_dir, folder, run_id, genotype, extra_information, rotarix_vp7, rotarix_vp4, '
+                 'updated FROM samples s WHERE 1 = 1')
+        params = []
+        if folder:
+            query += ' AND folder = ?'
+            params.append(folder)
+        if run_dir:
+            query += ' AND run_dir = ?'
+            params.append(run_dir)
+        if genotype:
+            query += (' AND EXISTS (SELECT 1 FROM counts c WHERE c.run_dir = s.run_dir AND c.folder = s.folder'
+                      ' AND c.genotype = ?)')
+            params.append(genotype)
+        return self.conn.execute(query + ' ORDER BY updated DESC', params).fetchall()
+
+
+def read_counts(path):
+    """The rows of blast_rota_results2.csv without its header, or [] if it is missing."""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', newline='') as f:
+        rows = list(csv.reader(f))
+    if not rows or rows[0] != SUMMARY_HEADER:
+        return []
+    return rows[1:]
+
+
+def add_folder(results, folder, run_dir=None, run_id=None):
+    """Adds a sample folder; returns False if it has no results yet."""
+    path = os.path.join(folder, GENOTYPING_FILE)
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r', newline='') as f:
+        genotyping_csv = f.read()
+    name = os.path.basename(os.path.abspath(folder))
+    results.add(run_dir or default_run_dir(folder), name, genotyping_csv,
+                read_counts(os.path.join(folder, SUMMARY_FILE)), run_id or os.environ.get(RUN_ENV))
+    return True
+
+
+def merge_genotyping(tables):
+    """blast_rotavar4.csv from the sample files: the first with its header, the others without."""
+    merged = []
+    for i, (_, genotyping_csv) in enumerate(tables):
+        if i > 0:
+            genotyping_csv = genotyping_csv.split('\n', 1)[1] if '\n' in genotyping_csv else ''
+        merged.append(genotyping_csv)
+    return ''.join(merged)
+
+
+def add_command(args):
+    with ResultsDb(args.db) as results:
+        for folder in args.folders or ['.']:
+            if not add_folder(results, folder):
+                print(f"No {GENOTYPING_FILE} in {folder}")
+    return 0
+
+
+def export_command(args):
+    run_dir = os.path.abspath(args.run_dir)
+    with ResultsDb(args.db) as results:
+        folders = None
+        if args.folders:
+            folders = []
+            for folder in args.folders:
+                name = os.path.basename(os.path.abspath(folder))
+                path = os.path.join(folder, GENOTYPING_FILE)
+                # Like the shell merge, a sample without results this time is
+                # left out, also if an earlier run of the folder added it
+                if not os.path.exists(path):
+                    continue
+                # Samples whose results were not added (e.g. taken from the step cache)
+                if (results.updated(run_dir, name) or 0) < os.path.getmtime(path):
+                    add_folder(results, folder, run_dir)
+                folders.append(name)
+        tables = results.genotyping(run_dir, folders)
+
+    if not tables:
+        print(f"No results for {run_dir} in {args.db}")
+        return 1
+    merged = merge_genotyping(tables)
+    with open(args.output, 'w', newline='') as f:
+        f.write(merged)
+    if args.labware:
+        with open(args.labware, 'w', newline='') as outfile:
+            labware.write_report(io.StringIO(merged, newline=''), outfile)
+    print(f"{len(tables)} samples of {run_dir} written to {args.output}")
+    return 0
+
+
+def find_command(args):
+    with ResultsDb(args.db) as results:
+        rows = results.find(args.folder, args.genotype, os.path.abspath(args.run_dir) if args.run_dir else None)
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['Run Folder', 'Folder Name', 'Run', 'Genotype', 'Extra Information',
+                     'Rotarix VP7', 'Rotarix VP4', 'Updated'])
+    for row in rows:
+        writer.writerow(list(row[:7]) + [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row[7]))])
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Results of all runs in one SQLite file.")
+    parser.add_argument('--db', default=default_db_path(), help="Results file (default: see resultsdb.py)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = subparsers.add_parser('add', help="Add or replace the results of sample folders")
+    add_parser.add_argument('folders', nargs='*', help="Sample folders (default: current)")
+
+    export_parser = subparsers.add_parser('export', help="Write the run tables of a run")
+    export_parser.add_argument('--run-dir', default='.', help="Run folder (default: current)")
+    export_parser.add_argument('--output', default=labware.INPUT_FILE, help="Merged table (default blast_rotavar4.csv)")
+    export_parser.add_argument('--labware', default=None, help="Also write the Labware report to this file")
+    export_parser.add_argument('folders', nargs='*', help="Sample folders, in output order (default: all of the run)")
+
+    find_parser = subparsers.add_parser('find', help="Look up samples across runs")
+    find_parser.add_argument('--folder', default=None, help="Sample folder name")
+    find_parser.add_argument('--genotype', default=None, help="Genotype among the hits, e.g. G9 or P8")
+    find_parser.add_argument('--run-dir', default=None, help="Run folder")
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        return add_command(args)
+    if args.command == 'export':
+        return export_command(args)
+    return find_command(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
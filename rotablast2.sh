@@ -1,5 +1,12 @@
 #!/bin/bash
 
+# Usage: bash rotablast2.sh [all|prepare|post]
+#   all      (default) query preparation, rotadb BLAST and post-BLAST steps
+#   prepare  only prepare contigs500_COV.fasta (batch mode, see batchblast.py)
+#   post     the steps after the rotadb BLAST, when blast_rota2.txt was
+#            written by batchblast.py
+STAGE="${1:-all}"
+
 # Activate the initial conda environment
 source ~/miniconda3/etc/profile.d/conda.sh
 #source ~/miniconda3/etc/profile.d/conda.sh
@@ -7,9 +14,25 @@ conda activate rotafinder
 # Get the directory of the script
 SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
 
+# step NAME [--in FILE] [--out FILE] -- command: runs a step and, when
+# ROTAFINDER_TELEMETRY is set, records its time and resources (telemetry.py)
+step() {
+  if [[ -z "$ROTAFINDER_TELEMETRY" ]]; then
+    while [[ "$1" != "--" ]]; do shift; done
+    shift
+    "$@"
+  else
+    python3 "$SCRIPT_DIR/telemetry.py" run --step "$@"
+  fi
+}
+
 #cat output_VP1.fasta output_VP2.fasta output_VP3.fasta output_VP4.fasta output_VP6.fasta output_VP7.fasta output_NSP1.fasta output_NSP2.fasta output_NSP3.fasta output_NSP4.fasta output_NSP5.fasta > contigs_rota.fasta
 
-python3 "$SCRIPT_DIR/covfilter.py"
+# CollectFasta.py already writes contigs500_COV.fasta; only filter again when
+# it is missing or older than contigs500.fasta
+if [[ ! -f contigs500_COV.fasta || contigs500.fasta -nt contigs500_COV.fasta ]]; then
+  step covfilter --in contigs500.fasta --out contigs500_COV.fasta -- python3 "$SCRIPT_DIR/covfilter.py"
+fi
 
 # Set the minimum sequence length to be considered (adjust if necessary)
 MIN_SEQ_LENGTH=500
@@ -30,38 +53,90 @@ fi
 # Count the total number of sequences in contigs.fasta
 TOTAL_SEQUENCES=$(grep -c "^>" "$INPUT_FASTA")
 
-# Run BLAST 
-blastn -query "$INPUT_FASTA" -db "$BLAST_DB" -out "$BLAST_OUTPUT" \
-  -outfmt "6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore sstrand slen" \
-  -max_target_seqs 1 -strand both
+# Optional k-mer prescreen (ROTAFINDER_PRESCREEN, RotaFinder.sh --prescreen):
+# only contigs sharing a BLAST seed word with rotadb are sent to blastn
+BLAST_QUERY="$INPUT_FASTA"
+if [[ -n "$ROTAFINDER_PRESCREEN" ]]; then
+  BLAST_QUERY="contigs500_COV_prescreen.fasta"
+  if [[ "$STAGE" != "post" ]]; then
+    step prescreen --in "$INPUT_FASTA" --out "$BLAST_QUERY" -- python3 "$SCRIPT_DIR/prescreen.py" "$INPUT_FASTA" "$BLAST_QUERY" --db "$BLAST_DB" ${LOG_FILE:+--log "$LOG_FILE"}
+  fi
+fi
+
+# Optional deduplication (ROTAFINDER_DEDUP, RotaFinder.sh --dedup): contigs
+# with the same sequence on either strand are BLASTed once and their hits are
+# expanded back to every contig before the post-BLAST steps
+BLAST_RESULT="$BLAST_OUTPUT"
+if [[ -n "$ROTAFINDER_DEDUP" ]]; then
+  BLAST_RESULT="blast_rota2_unique.txt"
+  if [[ "$STAGE" != "post" ]]; then
+    step dedup_collapse --in "$BLAST_QUERY" --out contigs500_COV_unique.fasta -- python3 "$SCRIPT_DIR/dedup.py" collapse "$BLAST_QUERY" contigs500_COV_unique.fasta contigs500_COV_dedup.tsv ${LOG_FILE:+--log "$LOG_FILE"}
+  fi
+  BLAST_QUERY="contigs500_COV_unique.fasta"
+fi
+
+if [[ "$STAGE" == "prepare" ]]; then
+    exit 0
+fi
+
+# Run BLAST (in batch mode batchblast.py has already written $BLAST_RESULT).
+# Contigs whose sequence was searched against this rotadb build before are
+# taken from the BLAST cache (blastcache.py), only the others go to blastn.
+if [[ "$STAGE" != "post" ]]; then
+  step blastn_rotadb --in "$BLAST_QUERY" --out "$BLAST_RESULT" -- python3 "$SCRIPT_DIR/blastcache.py" run --db "$BLAST_DB" --query "$BLAST_QUERY" --out "$BLAST_RESULT" \
+    ${LOG_FILE:+--log "$LOG_FILE"} -- \
+    -outfmt "6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore sstrand slen" \
+    -max_target_seqs 1 -strand both
+fi
+if [[ -n "$ROTAFINDER_DEDUP" && -f "$BLAST_RESULT" ]]; then
+  step dedup_expand --in "$BLAST_RESULT" --out "$BLAST_OUTPUT" -- python3 "$SCRIPT_DIR/dedup.py" expand "$BLAST_RESULT" contigs500_COV_dedup.tsv "$BLAST_OUTPUT" --unique "$BLAST_QUERY"
+fi
 if [ ! -f "$BLAST_OUTPUT" ]; then
     echo "Error: BLAST did not create $BLAST_OUTPUT. Exiting."
     exit 1
 fi
 
-python3 "$SCRIPT_DIR/evaluate3.py"
-python3 "$SCRIPT_DIR/summarize3.py"
-python3 "$SCRIPT_DIR/genotype4.py"
-python3 "$SCRIPT_DIR/update_blast_data.py"
-python3 "$SCRIPT_DIR/selected_contigs.py"
-python3 "$SCRIPT_DIR/selected_ORFs.py"
-
-blastn -query selected_ORFs.fasta -db "$SCRIPT_DIR/hostdb/hostdatabase250421" -out hostcomparison.csv -outfmt "6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore sstrand slen" -max_target_seqs 1 -strand both
-
-rm -r work1
-rm -r work2
-rm -r work3
-rm -r work6
-rm -r work7
-rm R1bbnorm.fastq.gz
-rm R1bbnorm2.fastq.gz
-rm R2bbnorm.fastq.gz
-rm R2bbnorm2.fastq.gz
-rm R1_paired.fastq.gz
-rm R1_unpaired.fastq.gz
-rm R2_paired.fastq.gz
-rm R2_unpaired.fastq.gz
-rm deduped_R1.fastq.gz
-rm deduped_R2.fastq.gz
-rm blast_rota_genotyping4.csv
-rm blast_rota2.txt
+# Evaluation, summary, genotyping, vaccine similarity and contig/ORF selection
+# in one process (same results as evaluate3.py, summarize3.py, genotype4.py,
+# update_blast_data.py, selected_contigs.py and selected_ORFs.py)
+step postblast --in "$BLAST_OUTPUT" --in "$INPUT_FASTA" --out blast_rota2.csv --out selected_ORFs.fasta -- \
+  python3 "$SCRIPT_DIR/postblast.py"
+
+# Results of the sample into the results file right away, so the run tables can
+# be made before the run is done (resultsdb.py, set by RotaFinder.sh)
+if [[ -n "$ROTAFINDER_RESULTS_DB" ]]; then
+  step resultsdb --in blast_rota_genotyping4_updated.csv -- python3 "$SCRIPT_DIR/resultsdb.py" add .
+fi
+
+# Host comparison of the selected ORFs against hostdb, with results cached per
+# ORF sequence (hostblast.py). RotaFinder.sh sets ROTAFINDER_POOL_HOST and
+# runs it once for all samples instead.
+if [[ -z "$ROTAFINDER_POOL_HOST" ]]; then
+  step hostblast --in selected_ORFs.fasta --out hostcomparison.csv -- python3 "$SCRIPT_DIR/hostblast.py" ${LOG_FILE:+--log "$LOG_FILE"} .
+fi
+
+rm -rf work1
+rm -rf work2
+rm -rf work3
+rm -rf work6
+rm -rf work7
+rm -f R1bbnorm.fastq.gz
+rm -f R1bbnorm2.fastq.gz
+rm -f R2bbnorm.fastq.gz
+rm -f R2bbnorm2.fastq.gz
+rm -f R1_paired.fastq.gz
+rm -f R1_unpaired.fastq.gz
+rm -f R2_paired.fastq.gz
+rm -f R2_unpaired.fastq.gz
+rm -f R1_sub.fastq.gz
+rm -f R2_sub.fastq.gz
+rm -f deduped_R1.fastq.gz
+rm -f deduped_R2.fastq.gz
+# Uncompressed intermediates (sampledag.py --intermediate-compression none)
+rm -f R1_paired.fastq R2_paired.fastq R1_sub.fastq R2_sub.fastq deduped_R1.fastq deduped_R2.fastq
+rm -f R1bbnorm.fastq R2bbnorm.fastq R1bbnorm2.fastq R2bbnorm2.fastq
+rm -f blast_rota_genotyping4.csv
+rm -f blast_rota2.txt
+rm -f contigs500_COV_prescreen.fasta
+rm -f contigs500_COV_unique.fasta
+rm -f blast_rota2_unique.txt
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Reader for BLAST nucleotide databases such as 241130_rotadb.
+
+Reads the .nin index, .nsq sequence and .nhr header files of a single
+volume (format version 4 or 5) directly, so the reference sequences can be
+used without blastdbcmd. Sequences come from the 2-bit packed .nsq data,
+which is also what BLAST scans for seed words: ambiguous bases appear as the
+base makeblastdb put in their place.
+
+Usage:
+    python3 rotadb.py [db prefix]   # print the number of sequences and bases
+"""
+import os
+import struct
+import sys
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ROTADB = os.path.join(SCRIPT_DIR, '241130_rotadb')
+
+BASES = 'ACGT'
+
+
+def _read_string(data, pos):
+    length = struct.unpack('>I', data[pos:pos + 4])[0]
+    pos += 4
+    return data[pos:pos + length].decode('latin-1'), pos + length
+
+
+def _asn1_length(data, pos):
+    length = data[pos]
+    pos += 1
+    if length & 0x80:
+        n = length & 0x7f
+        length = int.from_bytes(data[pos:pos + n], 'big')
+        pos += n
+    return length, pos
+
+
+class BlastDb:
+    """Sequences and titles of a nucleotide BLAST database volume."""
+
+    def __init__(self, prefix=ROTADB):
+        self.prefix = prefix
+        with open(prefix + '.nin', 'rb') as f:
+            data = f.read()
+        version, db_type = struct.unpack('>II', data[0:8])
+        if version not in (4, 5) or db_type != 0:
+            raise ValueError(f"{prefix}: not a nucleotide BLAST database of version 4 or 5")
+        pos = 8
+        if version == 5:
+            pos += 4  # volume number
+        self.title, pos = _read_string(data, pos)
+        if version == 5:
+            _, pos = _read_string(data, pos)  # LMDB file name
+        self.date, pos = _read_string(data, pos)
+        self.num_oids = struct.unpack('>I', data[pos:pos + 4])[0]
+        self.total_length = struct.unpack('<Q', data[pos + 4:pos + 12])[0]
+        self.max_length = struct.unpack('>I', data[pos + 12:pos + 16])[0]
+        pos += 16
+        n = self.num_oids + 1
+        offsets = struct.unpack(f'>{3 * n}I', data[pos:pos + 12 * n])
+        self.header_offsets = offsets[:n]
+        self.sequence_offsets = offsets[n:2 * n]
+        self.ambiguity_offsets = offsets[2 * n:]
+
+        with open(prefix + '.nsq', 'rb') as f:
+            self.nsq = f.read()
+        with open(prefix + '.nhr', 'rb') as f:
+            self.nhr = f.read()
+
+    def __len__(self):
+        return self.num_oids
+
+    def length(self, oid):
+        start = self.sequence_offsets[oid]
+        end = self.ambiguity_offsets[oid]
+        if end <= start:
+            return 0
+        # The last byte holds the number of bases used in it in its low 2 bits
+        return (end - start - 1) * 4 + (self.nsq[end - 1] & 3)
+
+    def codes(self, oid):
+        """Returns the bases of a sequence as 2-bit codes (A=0, C=1, G=2, T=3) in a numpy array."""
+        start = self.sequence_offsets[oid]
+        packed = np.frombuffer(self.nsq, dtype=np.uint8, count=self.ambiguity_offsets[oid] - start, offset=start)
+        codes = np.empty((len(packed), 4), dtype=np.uint8)
+        for i in range(4):
+            codes[:, i] = (packed >> (6 - 2 * i)) & 3
+        return codes.reshape(-1)[:self.length(oid)]
+
+    def sequence(self, oid):
+        return ''.join(BASES[code] for code in self.codes(oid))
+
+    def defline(self, oid):
+        """Returns the title of a sequence from its ASN.1 header (e.g. 'G1|RVA/...')."""
+        data = self.nhr[self.header_offsets[oid]:self.header_offsets[oid + 1]]
+        pos = data.find(b'\x1a')  # VisibleString tag of the title
+        if pos < 0:
+            return ''
+        length, pos = _asn1_length(data, pos + 1)
+        return data[pos:pos + length].decode('latin-1')
+
+    def deflines(self):
+        return [self.defline(oid) for oid in range(self.num_oids)]
+
+
+if __name__ == "__main__":
+    db = BlastDb(sys.argv[1] if len(sys.argv) > 1 else ROTADB)
+    bases = sum(db.length(oid) for oid in range(len(db)))
+    print(f"{db.prefix}: {len(db)} sequences, {bases} bases")
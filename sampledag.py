@@ -0,0 +1,615 @@
+#!/usr/bin/env python3
+"""
+Runs the steps of one sample folder as a dependency graph.
+
+Every step lists the steps it needs. Steps whose needs are done are started
+together as long as the sum of their threads fits the thread budget, so the
+two BBnorm runs, Clumpify and the assemblies overlap instead of running one
+after another.
+
+The rules of the serial pipeline carry over:
+  - a step with empty input files is skipped and the reason is logged,
+  - failure of a fatal step (Trimmomatic, Clumpify, BBnorm, CollectFasta)
+    skips the rest of the folder,
+  - failure of an assembly or rotablast2.sh is logged and the pipeline goes on.
+
+The workN folders are removed as soon as CollectFasta has read them. With
+--scratch the sample runs in a node-local folder and only the results are
+copied back (scratch.py). The peak disk use of the sample is logged, and
+the time and resources of every step that runs are recorded (telemetry.py).
+
+Run from inside the sample folder (RotaFinderSample.sh does this).
+"""
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import adaptive
+import scratch
+import stepcache
+import subsample
+import telemetry
+from scheduler import log_message
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TRIM_OPTS = [
+    f"ILLUMINACLIP:{os.path.join(SCRIPT_DIR, 'adapters.fa')}:2:30:10:1",
+    "SLIDINGWINDOW:3:15", "LEADING:3", "TRAILING:3", "MINLEN:36"
+]
+
+ASSEMBLIES = ['work1', 'work2', 'work3', 'work6', 'work7']
+
+# Set by RotaFinder.sh --batch-blast
+BATCH_BLAST_ENV = 'ROTAFINDER_BATCH_BLAST'
+
+# Set by RotaFinder.sh --intermediate-dir and --intermediate-compression
+INTERMEDIATE_DIR_ENV = 'ROTAFINDER_INTERMEDIATE_DIR'
+INTERMEDIATE_COMPRESSION_ENV = 'ROTAFINDER_INTERMEDIATE_COMPRESSION'
+
+# gzip: default gzip level, as before; fast: gzip level 1 from BBTools;
+# none: uncompressed FASTQ
+COMPRESSIONS = ['gzip', 'fast', 'none']
+
+# Intermediate read files, all removed by rotablast2.sh
+INTERMEDIATE_READS = [
+    'R1_paired', 'R2_paired', 'R1_unpaired', 'R2_unpaired', 'R1_sub', 'R2_sub',
+    'deduped_R1', 'deduped_R2', 'R1bbnorm', 'R2bbnorm', 'R1bbnorm2', 'R2bbnorm2',
+]
+
+
+def spades_args(threads, memory):
+    args = ['-t', str(threads)]
+    if memory:
+        args += ['-m', str(memory)]
+    return args
+
+
+def intermediate_files(directory=None, compression='gzip'):
+    """
+    Returns {name: path} of the intermediate read files. By default they
+    are the .fastq.gz files in the sample folder. With a directory (local
+    scratch or tmpfs) or another compression the unpaired reads, which no
+    step reads, go to /dev/null.
+    """
+    suffix = '.fastq' if compression == 'none' else '.fastq.gz'
+    files = {name: os.path.join(directory, name + suffix) if directory else name + suffix
+             for name in INTERMEDIATE_READS}
+    if directory or compression != 'gzip':
+        files['R1_unpaired'] = files['R2_unpaired'] = os.devnull
+    return files
+
+
+def sample_dir(base, folder):
+    """
+    Directory of a sample folder under base (intermediate reads or scratch).
+    It has the name of the sample folder, as the scripts take the sample
+    name from the folder they run in, inside a folder unique to the path.
+    """
+    folder = os.path.abspath(folder)
+    name = os.path.basename(folder)
+    digest = hashlib.sha256(folder.encode()).hexdigest()[:8]
+    return os.path.join(os.path.abspath(base), f"{name}-{digest}", name)
+
+
+def build_steps(threads=12, spades_threads=12, memory=None, batch_blast=False, read_budget=None, log_file=None,
+                files=None, compression='gzip'):
+    """
+    Returns the step graph of one sample as a list of step dictionaries.
+
+    threads is the thread budget of the sample, spades_threads the threads
+    of each assembly and memory the memory budget (GB) of the sample, shared
+    by the assemblies that run at the same time. With batch_blast only the
+    query of the rotadb BLAST is prepared; batchblast.py and
+    `rotablast2.sh post` do the rest for all samples. With read_budget the
+    trimmed read pairs are capped at it (subsample.py) for the assemblies
+    on all trimmed reads (work3 and work6). files are the paths of the
+    intermediate reads (intermediate_files()); with compression 'fast'
+    BBTools write them at gzip level 1.
+    """
+    spades_threads = max(1, min(spades_threads, threads))
+    spades_memory = max(1, memory * spades_threads // threads) if memory else None
+    reads_threads = max(1, threads // 3)
+    spades = spades_args(spades_threads, spades_memory)
+    if files is None:
+        files = intermediate_files(compression=compression)
+    bbtools = ['ziplevel=1'] if compression == 'fast' else []
+
+    # Reads of work3 and work6
+    trimmed_reads = [files['R1_paired'], files['R2_paired']]
+    if read_budget:
+        full_reads, full_step = [files['R1_sub'], files['R2_sub']], 'subsample'
+    else:
+        full_reads, full_step = trimmed_reads, 'trimmomatic'
+
+    r1 = sorted(glob.glob('*_R1_001.fastq.gz'))
+    r2 = sorted(glob.glob('*_R2_001.fastq.gz'))
+
+    steps = [
+        {
+            'name': 'trimmomatic',
+            'needs': [],
+            'threads': threads,
+            'cmd': ['trimmomatic', 'PE', '-threads', str(threads)] + r1 + r2 + [
+                files['R1_paired'], files['R1_unpaired'],
+                files['R2_paired'], files['R2_unpaired']
+            ] + TRIM_OPTS,
+            'inputs': r1 + r2,
+            'outputs': [files['R1_paired'], files['R1_unpaired'],
+                        files['R2_paired'], files['R2_unpaired']],
+            'version': ['trimmomatic', '-version'],
+            'key_files': [os.path.join(SCRIPT_DIR, 'adapters.fa')],
+            'fatal': True,
+            'fail_msg': "Trimmomatic failed in {folder}, skipping folder.",
+            'nonempty_outputs': [files['R1_paired'], files['R2_paired']],
+            'empty_outputs_msg': "Trimmomatic output files are empty in {folder}, skipping folder.",
+        },
+        {
+            'name': 'clumpify',
+            'needs': ['trimmomatic'],
+            'threads': reads_threads,
+            'cmd': ['clumpify.sh', 'in1=' + files['R1_paired'], 'in2=' + files['R2_paired'],
+                    'out1=' + files['deduped_R1'], 'out2=' + files['deduped_R2'], 'dedupe',
+                    f'threads={reads_threads}'] + bbtools,
+            'inputs': [files['R1_paired'], files['R2_paired']],
+            'outputs': [files['deduped_R1'], files['deduped_R2']],
+            'version': ['clumpify.sh', '--version'],
+            'fatal': True,
+            'fail_msg': "Clumpify failed in {folder}, skipping folder.",
+        },
+        {
+            'name': 'bbnorm100',
+            'needs': ['trimmomatic'],
+            'threads': reads_threads,
+            'cmd': ['bbnorm.sh', 'in1=' + files['R1_paired'], 'in2=' + files['R2_paired'],
+                    'out1=' + files['R1bbnorm'], 'out2=' + files['R2bbnorm'], 'target=100', 'min=5',
+                    f'threads={reads_threads}'] + bbtools,
+            'inputs': [files['R1_paired'], files['R2_paired']],
+            'outputs': [files['R1bbnorm'], files['R2bbnorm']],
+            'version': ['bbnorm.sh', '--version'],
+            'fatal': True,
+            'fail_msg': "BBnorm (target=100) failed in {folder}, skipping folder.",
+        },
+        {
+            'name': 'work1',
+            'needs': ['bbnorm100'],
+            'threads': spades_threads,
+            'cmd': ['rnaviralspades.py'] + spades + ['-1', files['R1bbnorm'], '-2', files['R2bbnorm'], '-o', 'work1'],
+            'inputs': [files['R1bbnorm'], files['R2bbnorm']],
+            'outputs': ['work1/contigs.fasta'],
+            'version': ['rnaviralspades.py', '--version'],
+            'cache_keep': ['work1/contigs.fasta'],
+            'requires': [files['R1bbnorm'], files['R2bbnorm']],
+            'empty_msg': "BBnorm (target=100) output files are empty in {folder}, skipping running rnaviralspades.py work1.",
+            'fail_msg': "rnaviralspades.py (work1) failed in {folder}",
+        },
+        {
+            'name': 'bbnorm500',
+            'needs': ['trimmomatic'],
+            'threads': reads_threads,
+            'cmd': ['bbnorm.sh', 'in1=' + files['R1_paired'], 'in2=' + files['R2_paired'],
+                    'out1=' + files['R1bbnorm2'], 'out2=' + files['R2bbnorm2'], 'target=500', 'min=5',
+                    f'threads={reads_threads}'] + bbtools,
+            'inputs': [files['R1_paired'], files['R2_paired']],
+            'outputs': [files['R1bbnorm2'], files['R2bbnorm2']],
+            'version': ['bbnorm.sh', '--version'],
+            'fatal': True,
+            'fail_msg': "BBnorm (target=500) failed in {folder}, skipping folder.",
+        },
+        {
+            'name': 'work2',
+            'needs': ['bbnorm500'],
+            'threads': spades_threads,
+            'cmd': ['rnaviralspades.py'] + spades + ['-1', files['R1bbnorm2'], '-2', files['R2bbnorm2'], '-o', 'work2'],
+            'inputs': [files['R1bbnorm2'], files['R2bbnorm2']],
+            'outputs': ['work2/contigs.fasta'],
+            'version': ['rnaviralspades.py', '--version'],
+            'cache_keep': ['work2/contigs.fasta'],
+            'requires': [files['R1bbnorm2'], files['R2bbnorm2']],
+            'empty_msg': "BBnorm (target=500) output files are empty in {folder}, skipping running rnaviralspades.py work2.",
+            'fail_msg': "rnaviralspades.py (work2) failed in {folder}",
+        },
+        {
+            'name': 'work3',
+            'needs': [full_step],
+            'threads': spades_threads,
+            'cmd': ['rnaviralspades.py'] + spades + ['-1', full_reads[0], '-2', full_reads[1], '-o', 'work3'],
+            'inputs': full_reads,
+            'outputs': ['work3/contigs.fasta'],
+            'version': ['rnaviralspades.py', '--version'],
+            'cache_keep': ['work3/contigs.fasta'],
+            'requires': full_reads,
+            'empty_msg': "Paired files are empty in {folder}, skipping rnaviralspades.py work3 and SPAdes work6.",
+            'fail_msg': "rnaviralspades.py (work3) failed in {folder}",
+        },
+        {
+            'name': 'work6',
+            'needs': [full_step],
+            'threads': spades_threads,
+            'cmd': ['spades.py'] + spades + ['--isolate', '--cov-cutoff', 'auto',
+                                             '-1', full_reads[0], '-2', full_reads[1], '-o', 'work6'],
+            'inputs': full_reads,
+            'outputs': ['work6/contigs.fasta'],
+            'version': ['spades.py', '--version'],
+            'cache_keep': ['work6/contigs.fasta'],
+            'requires': full_reads,
+            'fail_msg': "SPAdes (work6) failed in {folder}",
+        },
+        {
+            'name': 'work7',
+            'needs': ['clumpify'],
+            'threads': spades_threads,
+            'cmd': ['rnaviralspades.py'] + spades + ['-1', files['deduped_R1'], '-2', files['deduped_R2'], '-o', 'work7'],
+            'inputs': [files['deduped_R1'], files['deduped_R2']],
+            'outputs': ['work7/contigs.fasta'],
+            'version': ['rnaviralspades.py', '--version'],
+            'cache_keep': ['work7/contigs.fasta'],
+            'requires': [files['deduped_R1'], files['deduped_R2']],
+            'empty_msg': "Clumpify output files are empty in {folder}, skipping running rnaviralspades.py work7.",
+            'fail_msg': "rnaviralspades.py (work7) failed in {folder}",
+        },
+        {
+            'name': 'collect',
+            'needs': list(ASSEMBLIES),
+            'threads': 1,
+            'cmd': ['python3', os.path.join(SCRIPT_DIR, 'CollectFasta.py')],
+            'inputs': [f'{work}/contigs.fasta' for work in ASSEMBLIES],
+            'outputs': ['contigs.fasta', 'contigs500.fasta', 'contigs500_COV.fasta'],
+            'version': ['python3', '--version'],
+            'key_files': [os.path.join(SCRIPT_DIR, 'CollectFasta.py')],
+            'cache_keep': ['contigs.fasta', 'contigs500.fasta', 'contigs500_COV.fasta'],
+            # Only contigs.fasta of each assembly is read, free the rest right away
+            'cleanup': list(ASSEMBLIES),
+            'fatal': True,
+            'fail_msg': "CollectFasta.py failed in {folder}",
+        },
+        {
+            'name': 'rotablast',
+            'needs': ['collect'],
+            'threads': 1,
+            'cmd': ['bash', os.path.join(SCRIPT_DIR, 'rotablast2.sh')] + (['prepare'] if batch_blast else []),
+            'inputs': ['contigs500.fasta', 'contigs500_COV.fasta'],
+            'outputs': ['contigs500_COV.fasta'] if batch_blast else
+                       ['blast_rota2.csv', 'blast_rota_results2.csv', 'blast_rota_genotyping4_updated.csv',
+                        'selected_contigs.fasta', 'selected_ORFs.fasta', 'hostcomparison.csv'],
+            # The blastn calls inside rotablast2.sh go through the step cache themselves
+            'cache': False,
+            'fail_msg': "rotablast.sh failed in {folder}",
+        },
+    ]
+    if read_budget:
+        steps.insert(1, {
+            'name': 'subsample',
+            'needs': ['trimmomatic'],
+            'threads': 1,
+            'cmd': ['python3', os.path.join(SCRIPT_DIR, 'subsample.py'), '--budget', str(read_budget),
+                    '--inputs'] + trimmed_reads + ['--outputs'] + full_reads +
+                   (['--log', log_file] if log_file else []),
+            'inputs': trimmed_reads,
+            'outputs': full_reads,
+            'version': ['python3', '--version'],
+            'key_files': [os.path.join(SCRIPT_DIR, 'subsample.py')],
+            'fatal': True,
+            'fail_msg': "Subsampling failed in {folder}, skipping folder.",
+        })
+    return steps
+
+
+def nonempty(path, virtual_sizes=None):
+    """
+    True if the file has content. Outputs of cached steps that were not
+    restored are looked up in virtual_sizes.
+    """
+    if os.path.exists(path):
+        return os.path.getsize(path) > 0
+    return bool(virtual_sizes and virtual_sizes.get(path, 0) > 0)
+
+
+def key_inputs(step):
+    return step['inputs'] + step.get('key_files', [])
+
+
+def cache_key(step, cache_dir, known_hashes=None, producers=()):
+    """
+    Returns the cache key of a step. Hashes of inputs made by cached steps
+    are taken from known_hashes; returns None if an input made by another
+    step is not known yet.
+    """
+    input_hashes = []
+    for path in key_inputs(step):
+        if known_hashes is not None and path in known_hashes:
+            digest = known_hashes[path]
+        elif path in producers:
+            return None
+        else:
+            digest = stepcache.file_hash(path, cache_dir)
+        input_hashes.append((path, digest))
+    return stepcache.step_key(step['name'], step['cmd'], stepcache.tool_version(step.get('version')), input_hashes)
+
+
+def plan_cache(steps, cache_dir):
+    """
+    Looks up every step in the cache before anything runs and returns the
+    manifests of the steps that can be skipped.
+
+    Keys are chained through the output hashes recorded in the manifests, so
+    a cached assembly is found without its (not stored) input reads on disk.
+    If a step has to run, the cached steps that made its inputs are run
+    again as well, unless their outputs were stored.
+    """
+    producers = {}
+    for step in steps:
+        for path in step['outputs']:
+            producers[path] = step['name']
+
+    known_hashes = {}
+    hits = {}
+    for step in steps:
+        if not step.get('cache', True):
+            continue
+        key = cache_key(step, cache_dir, known_hashes, producers)
+        if key is None:
+            continue
+        manifest = stepcache.lookup(cache_dir, key)
+        if manifest is None:
+            continue
+        hits[step['name']] = manifest
+        for path, info in manifest['outputs'].items():
+            known_hashes[path] = info['sha256']
+
+    changed = True
+    while changed:
+        changed = False
+        for step in steps:
+            if step['name'] in hits:
+                continue
+            for path in step['inputs']:
+                producer = producers.get(path)
+                if producer in hits and not hits[producer]['outputs'][path]['stored']:
+                    del hits[producer]
+                    changed = True
+    return hits
+
+
+def run_graph(steps, threads, folder_name, log_file, cache_dir=None, timings=None):
+    """
+    Runs the steps, starting every step whose needs are done while the
+    threads of the running steps stay within the budget. A step that needs
+    more than the whole budget runs alone. Returns False if a fatal step
+    failed and the rest of the folder was skipped.
+
+    With a cache folder, steps found in the step cache are restored instead
+    of run, and the results of steps that ran are stored. With a timings
+    dict, (seconds, threads) of every step that ran is recorded in it.
+    """
+    pending = list(steps)
+    done = set()
+    running = {}
+    used_threads = 0
+    aborted = False
+    hits = plan_cache(steps, cache_dir) if cache_dir else {}
+    virtual_sizes = {}
+
+    def finish(step, returncode):
+        """Handles a finished step; returns False if the folder must be skipped."""
+        done.add(step['name'])
+        if returncode != 0:
+            log_message(log_file, step['fail_msg'].format(folder=folder_name))
+            return not step.get('fatal')
+
+        outputs = step.get('nonempty_outputs', [])
+        if not all(nonempty(path, virtual_sizes) for path in outputs):
+            log_message(log_file, step['empty_outputs_msg'].format(folder=folder_name))
+            return False
+        for path in step.get('cleanup', []):
+            shutil.rmtree(path, ignore_errors=True)
+        return True
+
+    def take_from_cache(step, manifest):
+        stepcache.restore(cache_dir, manifest)
+        for path, info in manifest['outputs'].items():
+            if not info['stored']:
+                virtual_sizes[path] = info['size']
+        print(f"{step['name']}: restored from cache")
+        return finish(step, 0)
+
+    while pending or running:
+        if not aborted:
+            started = True
+            while started and not aborted:
+                started = False
+                for step in list(pending):
+                    if not all(need in done for need in step['needs']):
+                        continue
+
+                    required = step.get('requires', [])
+                    if not all(nonempty(path, virtual_sizes) for path in required):
+                        if step.get('empty_msg'):
+                            log_message(log_file, step['empty_msg'].format(folder=folder_name))
+                        pending.remove(step)
+                        done.add(step['name'])
+                        started = True
+                        continue
+
+                    key = None
+                    if cache_dir and step.get('cache', True):
+                        manifest = hits.get(step['name'])
+                        if manifest is None:
+                            key = cache_key(step, cache_dir)
+                            manifest = stepcache.lookup(cache_dir, key)
+                            # Outputs that were not stored can only be left out when
+                            # plan_cache found that no step that runs needs them
+                            if manifest is not None and not all(
+                                    info['stored'] or info['sha256'] is None
+                                    for info in manifest['outputs'].values()):
+                                manifest = None
+                        if manifest is not None:
+                            pending.remove(step)
+                            started = True
+                            if not take_from_cache(step, manifest):
+                                aborted = True
+                                break
+                            continue
+
+                    need = min(step['threads'], threads)
+                    if running and used_threads + need > threads:
+                        continue
+
+                    proc = subprocess.Popen(step['cmd'])
+                    running[proc.pid] = (proc, step, need, key, time.time())
+                    used_threads += need
+                    pending.remove(step)
+                    started = True
+
+        if not running:
+            break
+
+        pid, status, rusage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+        proc, step, need, key, started_at = running.pop(pid)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        used_threads -= need
+        ended_at = time.time()
+        if timings is not None:
+            timings[step['name']] = (ended_at - started_at, need)
+        telemetry.write_record(telemetry.make_record(folder_name, step['name'], started_at, ended_at, rusage,
+                                                     proc.returncode, step['inputs'], step['outputs']))
+
+        if proc.returncode == 0 and key is not None:
+            stepcache.store(cache_dir, key, step['name'], step['outputs'], step.get('cache_keep', []))
+        if not finish(step, proc.returncode):
+            aborted = True
+
+    return not aborted
+
+
+def select_steps(steps, targets, exclude=()):
+    """
+    Returns the steps needed for the target steps, leaving out the steps in
+    exclude (already run, or assemblies that are skipped) and their names
+    from the needs of the others.
+    """
+    by_name = {step['name']: step for step in steps}
+    selected = set()
+    stack = [name for name in targets if name not in exclude]
+    while stack:
+        name = stack.pop()
+        if name in selected:
+            continue
+        selected.add(name)
+        stack.extend(need for need in by_name[name]['needs'] if need not in exclude)
+    return [dict(step, needs=[need for need in step['needs'] if need in selected])
+            for step in steps if step['name'] in selected]
+
+
+def run_adaptive(steps, threads, folder_name, log_file, cache_dir=None):
+    """
+    Runs the assemblies tier by tier (adaptive.ASSEMBLY_TIERS) and stops
+    escalating once every gene is typed from the contigs so far, then runs
+    the contig collection and rotadb BLAST on the assemblies that ran.
+    Returns False if a fatal step failed.
+    """
+    done = set()
+    run = []
+    timings = {}
+    untyped = []
+    for i, tier in enumerate(adaptive.ASSEMBLY_TIERS):
+        if cache_dir:
+            # Steps restored from the cache without their outputs on disk
+            # are restored or run again when a later tier needs them
+            done = {step['name'] for step in steps
+                    if step['name'] in done and all(os.path.exists(path) for path in step['outputs'])}
+        tier_steps = select_steps(steps, tier, done)
+        if not run_graph(tier_steps, threads, folder_name, log_file, cache_dir, timings):
+            return False
+        done.update(step['name'] for step in tier_steps)
+        run.extend(tier)
+        untyped = adaptive.open_genes(run, threads)
+        if not untyped:
+            break
+        if i + 1 < len(adaptive.ASSEMBLY_TIERS):
+            log_message(log_file, f"Adaptive assembly in {folder_name}: {', '.join(untyped)} not typed "
+                                  f"after {', '.join(run)}, running {', '.join(adaptive.ASSEMBLY_TIERS[i + 1])}")
+
+    skipped = [work for work in ASSEMBLIES if work not in run]
+    hours = adaptive.cpu_hours(timings, run)
+    adaptive.write_record(folder_name, run, skipped, hours, untyped)
+    log_message(log_file, f"Adaptive assembly in {folder_name}: ran {', '.join(run)} ({hours:.2f} CPU hours), "
+                          f"skipped {', '.join(skipped) if skipped else 'none'}")
+
+    final_steps = select_steps(steps, ['rotablast'], done | set(skipped))
+    return run_graph(final_steps, threads, folder_name, log_file, cache_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the RotaFinder steps of one sample folder as a dependency graph.")
+    parser.add_argument('folder', nargs='?', default='.', help="Sample folder (default: current folder)")
+    parser.add_argument('--threads', type=int, default=12, help="Thread budget of the sample (default 12)")
+    parser.add_argument('--spades-threads', type=int, default=12, help="Threads of each SPAdes run (default 12)")
+    parser.add_argument('--memory', type=int, default=None, help="Memory budget of the sample in GB")
+    parser.add_argument('--log', default=os.path.join(SCRIPT_DIR, 'log.txt'), help="Log file")
+    parser.add_argument('--cache', default=stepcache.default_cache_dir(),
+                        help=f"Step cache folder (default ${stepcache.CACHE_ENV}, no caching if unset)")
+    parser.add_argument('--batch-blast', action='store_true', default=bool(os.environ.get(BATCH_BLAST_ENV)),
+                        help=f"Only prepare the rotadb BLAST query, for batchblast.py (default ${BATCH_BLAST_ENV})")
+    parser.add_argument('--read-budget', type=int, default=subsample.default_budget(),
+                        help=f"Cap the read pairs of work3 and work6 (default ${subsample.READ_BUDGET_ENV})")
+    parser.add_argument('--adaptive', action='store_true', default=adaptive.enabled(),
+                        help=f"Run the assemblies cheapest first and stop once all genes are typed "
+                             f"(default ${adaptive.ADAPTIVE_ENV})")
+    parser.add_argument('--scratch', default=os.environ.get(scratch.SCRATCH_ENV),
+                        help=f"Node-local folder to run the sample in (default ${scratch.SCRATCH_ENV})")
+    parser.add_argument('--intermediate-dir', default=os.environ.get(INTERMEDIATE_DIR_ENV),
+                        help=f"Local scratch or tmpfs folder for the intermediate reads (default ${INTERMEDIATE_DIR_ENV})")
+    parser.add_argument('--intermediate-compression', choices=COMPRESSIONS,
+                        default=os.environ.get(INTERMEDIATE_COMPRESSION_ENV),
+                        help=f"Compression of the intermediate reads (default ${INTERMEDIATE_COMPRESSION_ENV}, "
+                             f"else none with --intermediate-dir and gzip without)")
+    args = parser.parse_args()
+
+    log_file = os.path.abspath(args.log)
+    cache_dir = os.path.abspath(args.cache) if args.cache else None
+    os.chdir(args.folder)
+    folder_name = os.path.basename(os.getcwd())
+
+    compression = args.intermediate_compression or ('none' if args.intermediate_dir else 'gzip')
+    directory = sample_dir(args.intermediate_dir, os.getcwd()) if args.intermediate_dir else None
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    folder = os.getcwd()
+    work_dir = sample_dir(args.scratch, folder) if args.scratch else None
+    if work_dir:
+        scratch.prepare(work_dir, folder)
+        os.chdir(work_dir)
+
+    steps = build_steps(args.threads, args.spades_threads, args.memory, args.batch_blast,
+                        args.read_budget, log_file, intermediate_files(directory, compression), compression)
+    monitor = scratch.DiskMonitor([os.getcwd(), directory])
+    try:
+        with monitor:
+            if args.adaptive:
+                ok = run_adaptive(steps, args.threads, folder_name, log_file, cache_dir)
+            else:
+                ok = run_graph(steps, args.threads, folder_name, log_file, cache_dir)
+    finally:
+        # rotablast2.sh only removes intermediates in the sample folder
+        if directory:
+            shutil.rmtree(os.path.dirname(directory), ignore_errors=True)
+        if work_dir:
+            os.chdir(folder)
+            scratch.copy_back(work_dir, folder)
+            shutil.rmtree(os.path.dirname(work_dir), ignore_errors=True)
+    log_message(log_file, f"Peak disk use of {folder_name}: {monitor.peak / 1e9:.2f} GB"
+                          f"{' in scratch' if work_dir else ''}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Runs several sample folders at once under a CPU-thread and memory budget.
+
+Each sample is processed by RotaFinderSample.sh. The number of samples run
+side by side is chosen so that every sample gets at least --min-threads
+threads and --sample-memory GB, and the SPAdes -t/-m values of each sample
+are sized to its share of the budget.
+
+Status messages of a sample go to <folder>/rotafinder_log.txt and tool
+output to <folder>/rotafinder_output.txt. When a sample finishes its
+messages are appended to the shared log in one piece, so samples never
+interleave in log.txt.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_SCRIPT = os.path.join(SCRIPT_DIR, "RotaFinderSample.sh")
+
+SAMPLE_LOG = "rotafinder_log.txt"
+SAMPLE_OUTPUT = "rotafinder_output.txt"
+
+log_lock = threading.Lock()
+
+
+def log_message(log_file, msg):
+    """Prints msg and appends it with a timestamp to log_file, if given."""
+    print(msg)
+    if log_file:
+        with log_lock:
+            with open(log_file, 'a') as f:
+                f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {msg}\n")
+
+
+def plan_slots(n_samples, threads, memory=None, min_threads=4, sample_memory=16):
+    """
+    Returns (slots, threads_per_sample, memory_per_sample).
+    memory and sample_memory are in GB; memory_per_sample is None when no
+    memory budget is given.
+    """
+    slots = max(1, threads // min_threads)
+    if memory:
+        slots = min(slots, max(1, memory // sample_memory))
+    slots = max(1, min(slots, n_samples))
+    threads_per_sample = max(1, threads // slots)
+    memory_per_sample = memory // slots if memory else None
+    return slots, threads_per_sample, memory_per_sample
+
+
+def sample_env(threads, memory, log_file):
+    env = dict(os.environ)
+    env['THREADS'] = str(threads)
+    if memory:
+        env['MEMORY_GB'] = str(memory)
+    else:
+        env.pop('MEMORY_GB', None)
+    env['LOG_FILE'] = log_file
+    return env
+
+
+def append_log(shared_log, sample_log):
+    if not os.path.exists(sample_log):
+        return
+    with open(sample_log, 'r') as f:
+        text = f.read()
+    with log_lock:
+        with open(shared_log, 'a') as out:
+            out.write(text)
+
+
+def run_sample(folder, threads, memory, shared_log):
+    folder = os.path.abspath(folder)
+    sample_log = os.path.join(folder, SAMPLE_LOG)
+    # Start each run with an empty sample log so only this run is appended
+    open(sample_log, 'w').close()
+
+    env = sample_env(threads, memory, sample_log)
+    with open(os.path.join(folder, SAMPLE_OUTPUT), 'w') as output:
+        returncode = subprocess.call(
+            ['bash', SAMPLE_SCRIPT, folder],
+            stdout=output, stderr=subprocess.STDOUT, env=env
+        )
+
+    append_log(shared_log, sample_log)
+    return returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run RotaFinder on several sample folders in parallel.")
+    parser.add_argument('folders', nargs='+', help="Sample folders to process")
+    parser.add_argument('--threads', type=int, required=True, help="Total CPU threads available")
+    parser.add_argument('--memory', type=int, default=None, help="Total memory available in GB")
+    parser.add_argument('--min-threads', type=int, default=4, help="Minimum threads per sample (default 4)")
+    parser.add_argument('--sample-memory', type=int, default=16, help="Memory needed per sample in GB (default 16)")
+    parser.add_argument('--log', default=os.path.join(SCRIPT_DIR, 'log.txt'), help="Shared log file")
+    args = parser.parse_args()
+
+    folders = [f for f in args.folders if os.path.isdir(f)]
+    if not folders:
+        print("No sample folders found.")
+        return 0
+
+    slots, threads, memory = plan_slots(
+        len(folders), args.threads, args.memory, args.min_threads, args.sample_memory
+    )
+    print(f"Running {len(folders)} samples, {slots} at a time with {threads} threads"
+          + (f" and {memory} GB" if memory else "") + " each.")
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=slots) as pool:
+        futures = {
+            pool.submit(run_sample, folder, threads, memory, args.log): folder
+            for folder in folders
+        }
+        for future, folder in futures.items():
+            if future.result() != 0:
+                failed.append(os.path.basename(os.path.normpath(folder)))
+
+    if failed:
+        print(f"Samples with errors: {', '.join(failed)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Node-local scratch execution and disk use of a sample, for sampledag.py.
+
+With a scratch folder (RotaFinder.sh --scratch) a sample runs in its own
+folder under it: the raw reads are linked in, all steps write there and
+only the files that are kept (PERSISTENT_FILES) are copied back to the
+sample folder at the end. The scratch folder is removed afterwards, also
+when a step fails, so SPAdes work folders and intermediate reads never
+stay behind on the shared storage.
+
+DiskMonitor polls the size of the folders a sample writes to, so the peak
+disk footprint of each sample (above what was there at the start, e.g.
+the raw reads) can be logged.
+"""
+import glob
+import os
+import shutil
+import threading
+
+# Set by RotaFinder.sh --scratch
+SCRATCH_ENV = 'ROTAFINDER_SCRATCH'
+
+READS = ['*_R1_001.fastq.gz', '*_R2_001.fastq.gz']
+
+# Results copied back to the sample folder; the query files and dedup map
+# are needed by `rotablast2.sh post` in batch BLAST mode
+PERSISTENT_FILES = [
+    'contigs.fasta', 'contigs500.fasta', 'contigs500_COV.fasta',
+    'blast_rota2.csv', 'blast_rota_results2.csv', 'blast_rota_genotyping4.csv',
+    'blast_rota_genotyping4_updated.csv', 'selected_contigs.fasta', 'selected_ORFs.fasta',
+    'hostcomparison.csv', 'adaptive_assemblies.csv',
+    'contigs500_COV_prescreen.fasta', 'contigs500_COV_unique.fasta', 'contigs500_COV_dedup.tsv',
+]
+
+POLL_SECONDS = 10
+
+
+def prepare(directory, folder):
+    """Creates an empty scratch folder for a sample folder and links its reads in."""
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    for pattern in READS:
+        for path in glob.glob(os.path.join(folder, pattern)):
+            os.symlink(os.path.abspath(path), os.path.join(directory, os.path.basename(path)))
+
+
+def copy_back(directory, folder):
+    """Copies the persistent files of a scratch folder to the sample folder; returns their names."""
+    copied = []
+    for name in PERSISTENT_FILES:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            shutil.copyfile(path, os.path.join(folder, name))
+            copied.append(name)
+    return copied
+
+
+def disk_usage(path):
+    """Bytes allocated by the files below a folder (symlinks are not followed)."""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_blocks * 512
+            except OSError:
+                continue
+    return total
+
+
+class DiskMonitor:
+    """Polls the disk use of some folders in a thread and keeps the peak above the start."""
+
+    def __init__(self, paths, interval=POLL_SECONDS):
+        self.paths = [path for path in paths if path]
+        self.interval = interval
+        self.start = None
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _poll(self):
+        usage = sum(disk_usage(path) for path in self.paths)
+        if self.start is None:
+            self.start = usage
+        self.peak = max(self.peak, usage - self.start)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._poll()
+
+    def __enter__(self):
+        self._poll()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._poll()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import csv
 
+from fastaindex import open_fasta
+
 # File names
 blast_csv = "blast_rota2.csv"
 input_fasta = "contigs500_COV.fasta"
@@ -103,41 +105,26 @@ for genotype in all_genotypes:
         candidate['type'] = 'partial'
         selected_candidates[genotype] = candidate
 
-# Parse the FASTA file into a dictionary.
-# Keys are the qseqids (extracted from the header’s first token, removing the '>' character).
-fasta_records = {}
-with open(input_fasta, 'r') as f:
-    header = None
-    seq_lines = []
-    for line in f:
-        line = line.strip()
-        if line.startswith(">"):
-            if header:
-                key = header.split()[0][1:]
-                fasta_records[key] = (header, "".join(seq_lines))
-            header = line
-            seq_lines = []
-        else:
-            seq_lines.append(line)
-    if header:
-        key = header.split()[0][1:]
-        fasta_records[key] = (header, "".join(seq_lines))
+# Open the FASTA file through its index (contigs500_COV.fasta.fai). Keys are the
+# qseqids (the header's first token, without the '>' character), and only the
+# ORF range of each selected contig is read.
+fasta = open_fasta(input_fasta)
 
 # Write the selected ORFs to the output FASTA file.
 with open(output_fasta, 'w') as outfile:
     for genotype, candidate in selected_candidates.items():
         qseqid = candidate['qseqid']
         candidate_type = candidate['type']  # 'full' or 'partial'
-        if qseqid not in fasta_records:
+        if qseqid not in fasta:
             print(f"Warning: qseqid {qseqid} not found in FASTA file.")
             continue
         
-        original_header, full_seq = fasta_records[qseqid]
+        original_header = fasta.header(qseqid)
         # Extract the ORF from the full sequence:
         # Convert qstart, qend from 1-indexed (inclusive) to Python’s 0-indexed slicing.
         qstart = candidate['qstart']
         qend = candidate['qend']
-        orf_seq = full_seq[qstart-1:qend]
+        orf_seq = fasta.fetch(qseqid, qstart-1, qend)
         
         # Reverse-complement if sstrand is '-' (ignoring extra spaces)
         if candidate['sstrand'].strip() == 'minus':
@@ -156,4 +143,5 @@ with open(output_fasta, 'w') as outfile:
         for i in range(0, len(orf_seq), 70):
             outfile.write(orf_seq[i:i+70] + "\n")
 
+fasta.close()
 print("Selected ORF sequences have been written to:", output_fasta)
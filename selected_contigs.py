@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import csv
 
+from fastaindex import open_fasta
+
 # File names
 blast_csv = "blast_rota2.csv"
 input_fasta = "contigs500_COV.fasta"
@@ -78,33 +80,17 @@ for genotype in all_genotypes:
     elif genotype in partial_candidates:
         selected_candidates[genotype] = {'qseqid': partial_candidates[genotype]['qseqid'], 'type': 'partial'}
 
-# Load sequences from the input FASTA file into a dictionary.
-# The key is derived from the FASTA header (first token after '>').
-fasta_records = {}
-with open(input_fasta, 'r') as f:
-    header = None
-    seq_lines = []
-    for line in f:
-        line = line.strip()
-        if line.startswith(">"):
-            if header:
-                key = header.split()[0][1:]
-                fasta_records[key] = (header, "".join(seq_lines))
-            header = line
-            seq_lines = []
-        else:
-            seq_lines.append(line)
-    if header:
-        key = header.split()[0][1:]
-        fasta_records[key] = (header, "".join(seq_lines))
+# Open the input FASTA file through its index (contigs500_COV.fasta.fai), so only
+# the selected records are read instead of the whole file.
+fasta = open_fasta(input_fasta)
 
 # Write selected contigs to a new FASTA file.
 with open(output_fasta, 'w') as outfile:
     for genotype, candidate in selected_candidates.items():
         qseqid = candidate['qseqid']
         candidate_type = candidate['type']  # 'full' or 'partial'
-        if qseqid in fasta_records:
-            original_header, sequence = fasta_records[qseqid]
+        if qseqid in fasta:
+            original_header, sequence = fasta.get(qseqid)
             # Modify header based on candidate type.
             if candidate_type == 'partial':
                 new_header = f">{genotype}_PARTIAL_{original_header[1:]}"
@@ -117,4 +103,5 @@ with open(output_fasta, 'w') as outfile:
         else:
             print(f"Warning: qseqid {qseqid} not found in FASTA file.")
 
+fasta.close()
 print("Selected contigs have been written to:", output_fasta)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Shares the sample folders of a run between workers on several nodes.
+
+Any number of workers (RotaFinder.sh --distributed, on nodes that mount the
+same run folder) claim sample folders through lease files in
+.rotafinder_claims/ of the run folder, so no service is needed:
+
+    <sample>.lease   created with O_CREAT|O_EXCL by the worker that runs the
+                     sample (atomic, also on NFS), holding its host and pid;
+                     its modification time is the heartbeat, renewed every
+                     HEARTBEAT_SECONDS while the sample runs
+    <sample>.done    written when the sample is finished (status done or
+                     failed); the lease is then removed
+
+A lease whose heartbeat is older than --stale seconds belongs to a worker
+that died: it is renamed away (only one worker can rename it) and the
+sample is claimed again. A worker that finds its lease taken over (e.g. after
+heartbeats failed on the file system) leaves the sample to the new owner
+and does not mark it done. Each worker runs as many samples at once as its
+--threads/--memory budget allows (scheduler.py) and keeps claiming until
+every sample is done, waiting for samples still running elsewhere.
+
+Then one worker claims the aggregation (aggregate.lease) and exits with 0;
+the others exit with NOT_AGGREGATOR. RotaFinder.sh goes on with the steps
+after the samples (batch BLAST, host comparison, blast_rotavar4.csv and
+labware.py) in the worker that got it, and marks the aggregation done
+with `shard.py finish`. An aggregation lease without aggregate.done is
+taken over after AGGREGATE_STALE_SECONDS.
+
+SQLite files are not shared between nodes: the BLAST cache defaults to one
+file per node (node_path) and uses the rollback journal, and the samples
+do not add their results to results.sqlite; the aggregating worker adds
+them all when it exports blast_rotavar4.csv.
+
+Several local worker processes behave like workers on several nodes, e.g.
+    for i in 1 2 3; do python3 shard.py worker --threads 4 & done
+
+Usage:
+    python3 shard.py worker [--threads N] [--memory GB] [--stale 300] [--log log.txt] [folder ...]
+    python3 shard.py finish | status | reset
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+import scheduler
+from scheduler import log_message
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CLAIMS_DIR = '.rotafinder_claims'
+# Hidden like the claims folder, so it is never the name of a sample folder
+AGGREGATE = '.aggregate'
+
+HEARTBEAT_SECONDS = 30
+STALE_SECONDS = 300
+POLL_SECONDS = 30
+AGGREGATE_STALE_SECONDS = 6 * 3600
+
+# Exit status of a worker that leaves the aggregation to another worker
+NOT_AGGREGATOR = 3
+
+# Set by RotaFinder.sh --distributed and by the workers, for the SQLite files
+# (blastcache.py, resultsdb.py)
+DISTRIBUTED_ENV = 'ROTAFINDER_DISTRIBUTED'
+
+
+def sqlite_journal_mode():
+    """
+    WAL needs every process using an SQLite file to share memory on one
+    host, which workers on several nodes over NFS do not; they use the
+    rollback journal.
+    """
+    return 'DELETE' if os.environ.get(DISTRIBUTED_ENV) else 'WAL'
+
+
+def node_path(path):
+    """path with the node name added in distributed mode (blastcache.sqlite -> blastcache-node1.sqlite)."""
+    if not os.environ.get(DISTRIBUTED_ENV):
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}-{socket.gethostname()}{extension}"
+
+
+def sample_folders(run_dir):
+    """Sample folders of a run, in the order of the shell glob */ (hidden folders left out)."""
+    return sorted(entry.name for entry in os.scandir(run_dir) if entry.is_dir() and not entry.name.startswith('.'))
+
+
+class Claims:
+    """Lease and done files of the samples of a run."""
+
+    def __init__(self, run_dir, worker_id):
+        self.dir = os.path.join(run_dir, CLAIMS_DIR)
+        self.worker_id = worker_id
+        os.makedirs(self.dir, exist_ok=True)
+
+    def lease_path(self, name):
+        return os.path.join(self.dir, f'{name}.lease')
+
+    def done_path(self, name):
+        return os.path.join(self.dir, f'{name}.done')
+
+    def read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_done(self, name):
+        return os.path.exists(self.done_path(name))
+
+    def _create(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': self.worker_id, 'claimed': datetime.now().isoformat(timespec='seconds')}, f)
+        return True
+
+    def _age(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _take_over(self, path, stale):
+        """Removes a lease whose heartbeat is older than stale seconds; returns its old content."""
+        age = self._age(path)
+        if age is None or age < stale:
+            return None
+        old = self.read(path)
+        moved = f'{path}.stale-{self.worker_id}'
+        try:
+            os.rename(path, moved)
+        except FileNotFoundError:
+            # Another worker took it over first
+            return None
+        # A worker that took it over just before us may have made a new
+        # lease, which we then moved; it is put back if so
+        if self.read(moved) != old or (self._age(moved) or 0) < stale:
+            try:
+                os.link(moved, path)
+            except OSError:
+                pass
+            os.remove(moved)
+            return None
+        os.remove(moved)
+        return old or {}
+
+    def claim(self, name, stale=STALE_SECONDS):
+        """Claims a sample; returns (claimed, old lease if a stale one was taken over)."""
+        path = self.lease_path(name)
+        if self._create(path):
+            return True, None
+        old = self._take_over(path, stale)
+        if old is not None and self._create(path):
+            return True, old
+        return False, None
+
+    def owner(self, name):
+        """Worker holding the lease of a sample, or None; other OS errors (e.g. NFS) are raised."""
+        try:
+            with open(self.lease_path(name), 'r') as f:
+                return json.load(f).get('worker')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def heartbeat(self, name):
+        """Renews the lease of a sample; returns False if it is no longer this worker's."""
+        if self.owner(name) != self.worker_id:
+            return False
+        os.utime(self.lease_path(name))
+        return True
+
+    def finish(self, name, status, check_owner=True):
+        """
+        Marks a sample done (status 'done' or 'failed') and removes its lease.
+        Returns False, without marking it, if the lease was taken over.
+        """
+        if check_owner and self.owner(name) != self.worker_id:
+            return False
+        path = self.done_path(name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'worker': self.worker_id, 'status': status,
+                       'finished': datetime.now().isoformat(timespec='seconds')}, f)
+        os.replace(path + '.tmp', path)
+        try:
+            os.remove(self.lease_path(name))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def status(self, names):
+        """Returns [(sample, state, worker)] with state done, failed, running, stale or waiting."""
+        rows = []
+        for name in names:
+            done = self.read(self.done_path(name))
+            lease = self.read(self.lease_path(name))
+            if done:
+                rows.append((name, done.get('status', 'done'), done.get('worker', '')))
+            elif lease is not None:
+                age = self._age(self.lease_path(name))
+                rows.append((name, 'stale' if age is not None and age >= STALE_SECONDS else 'running',
+                             lease.get('worker', '')))
+            else:
+                rows.append((name, 'waiting', ''))
+        return rows
+
+
+class Heartbeat:
+    """Renews the leases of the samples a worker runs, in a thread."""
+
+    def __init__(self, claims, interval=HEARTBEAT_SECONDS, log_file=None):
+        self.claims = claims
+        self.interval = interval
+        self.log_file = log_file
+        self.names = set()
+        # Samples whose lease another worker took over
+        self.lost = set()
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def add(self, name):
+        with self.lock:
+            self.names.add(name)
+            self.lost.discard(name)
+
+    def remove(self, name):
+        """Stops renewing the lease of a sample; returns False if it was lost meanwhile."""
+        with self.lock:
+            self.names.discard(name)
+            if name in self.lost:
+                self.lost.discard(name)
+                return False
+            return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self.lock:
+                names = list(self.names)
+            for name in names:
+                try:
+                    if self.claims.heartbeat(name):
+                        continue
+                    with self.lock:
+                        self.lost.add(name)
+                        self.names.discard(name)
+                    log_message(self.log_file, f"Worker {self.claims.worker_id}: lease of {name} "
+                                               f"taken over by another worker")
+                except OSError as e:
+                    # Retried at the next heartbeat, before the lease goes stale
+                    log_message(self.log_file, f"Worker {self.claims.worker_id}: heartbeat of {name} failed ({e})")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_sample(claims, heartbeat, folder, threads, memory, log_file):
+    name = os.path.basename(os.path.normpath(folder))
+    try:
+        returncode = scheduler.run_sample(folder, threads, memory, log_file)
+    except Exception as e:
+        log_message(log_file, f"Worker {claims.worker_id}: {name} failed ({e})")
+        returncode = 1
+    status = 'done' if returncode == 0 else 'failed'
+    # A sample whose lease was taken over is left to the new owner, which
+    # may still be running it in the same folder
+    try:
+        finished = heartbeat.remove(name) and claims.finish(name, status)
+    except OSError as e:
+        log_message(log_file, f"Worker {claims.worker_id}: {name} could not be marked {status} ({e})")
+        finished = False
+    if not finished:
+        log_message(log_file, f"Worker {claims.worker_id}: {name} failed, lease lost to another worker")
+        return
+    log_message(log_file, f"Worker {claims.worker_id}: {name} {status}")
+
+
+def work(args):
+    os.environ[DISTRIBUTED_ENV] = '1'
+    run_dir = os.path.abspath('.')
+    claims = Claims(run_dir, args.worker_id)
+    folders = [os.path.normpath(folder) for folder in args.folders] or sample_folders(run_dir)
+    names = {folder: os.path.basename(os.path.abspath(folder)) for folder in folders}
+    slots, threads, memory = scheduler.plan_slots(
+        len(folders), args.threads, args.memory, args.min_threads, args.sample_memory)
+    log_message(args.log, f"Worker {args.worker_id}: {len(folders)} samples in {run_dir}, "
+                          f"up to {slots} at a time with {threads} threads each")
+
+    running = {}
+    with Heartbeat(claims, args.heartbeat, args.log) as heartbeat, ThreadPoolExecutor(max_workers=slots) as pool:
+        while True:
+            pending = [folder for folder in folders if not claims.is_done(names[folder])]
+            if not pending:
+                break
+            for folder in pending:
+                if len(running) >= slots:
+                    break
+                if folder in running.values():
+                    continue
+                claimed, old = claims.claim(names[folder], args.stale)
+                if not claimed:
+                    continue
+                if old is not None:
+                    log_message(args.log, f"Worker {args.worker_id}: {names[folder]} taken over from "
+                                          f"{old.get('worker', 'an unknown worker')}, lease stale")
+                heartbeat.add(names[folder])
+                running[pool.submit(run_sample, claims, heartbeat, folder, threads, memory, args.log)] = folder
+            # Waits for one of our samples or until the others may have moved on
+            if running:
+                finished, _ = wait(running, timeout=args.poll, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+                    del running[future]
+            else:
+                time.sleep(args.poll)
+
+    claimed, _ = (False, None) if claims.is_done(AGGREGATE) else claims.claim(AGGREGATE, AGGREGATE_STALE_SECONDS)
+    if claimed:
+        log_message(args.log, f"Worker {args.worker_id}: all samples done, running the aggregation")
+        return 0
+    log_message(args.log, f"Worker {args.worker_id}: all samples done, aggregation left to another worker")
+    return NOT_AGGREGATOR
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share the sample folders of a run between workers.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    worker_parser = subparsers.add_parser('worker', help="Claim and run samples until all are done")
+    worker_parser.add_argument('folders', nargs='*', help="Sample folders (default: all subfolders)")
+    worker_parser.add_argument('--threads', type=int, default=os.cpu_count(), help="CPU threads of this worker")
+    worker_parser.add_argument('--memory', type=int, default=None, help="Memory of this worker in GB")
+    worker_parser.add_argument('--min-threads', type=int, default=4, help="Minimum threads per sample (default 4)")
+    worker_parser.add_argument('--sample-memory', type=int, default=16, help="Memory needed per sample in GB (default 16)")
+    worker_parser.add_argument('--stale', type=float, default=STALE_SECONDS,
+                               help=f"Seconds without heartbeat before a lease is taken over (default {STALE_SECONDS})")
+    worker_parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_SECONDS,
+                               help=f"Seconds between heartbeats (default {HEARTBEAT_SECONDS})")
+    worker_parser.add_argument('--poll', type=float, default=POLL_SECONDS,
+                               help=f"Seconds between looks at the other workers (default {POLL_SECONDS})")
+    worker_parser.add_argument('--worker-id', default=f"{socket.gethostname()}-{os.getpid()}",
+                               help="Worker name in the lease files (default host-pid)")
+    worker_parser.add_argument('--log', default=os.path.join(SCRIPT_DIR, 'log.txt'), help="Log file")
+
+    subparsers.add_parser('finish', help="Mark the aggregation of the run done")
+    subparsers.add_parser('status', help="Show the state of every sample")
+    subparsers.add_parser('reset', help="Remove all claims, so the samples are run again")
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        return work(args)
+    if args.command == 'finish':
+        Claims('.', f"{socket.gethostname()}-{os.getpid()}").finish(AGGREGATE, 'done', check_owner=False)
+        return 0
+    if args.command == 'reset':
+        shutil.rmtree(CLAIMS_DIR, ignore_errors=True)
+        return 0
+    claims = Claims('.', '')
+    for name, state, worker in claims.status(sample_folders('.')) + claims.status([AGGREGATE]):
+        print(f"{name}\t{state}\t{worker}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
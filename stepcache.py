@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of pipeline step results.
+
+A step is keyed by a hash of its name, its command line (without thread and
+memory options), the version of the tool and the content of its input
+files. When a step finishes, the hash and size of each output are recorded
+in a manifest and the outputs later steps need (e.g. workN/contigs.fasta or
+blast_rota2.txt) are stored. A rerun with the same key restores the stored
+outputs instead of running the step again.
+
+Cache layout (the cache folder is given by --cache or ROTAFINDER_CACHE):
+    objects/<sha256>   stored output files
+    steps/<key>.json   manifest of a step result
+    memo/<id>          content hash of a file, by path, size and mtime
+
+The steps are run by sampledag.py, which uses lookup(), store() and
+restore().
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+CACHE_ENV = 'ROTAFINDER_CACHE'
+
+# Options that only change resources or logging, not results; left out of the key
+RESOURCE_OPTIONS = {'-t', '-m', '-threads', '-num_threads', '--log'}
+RESOURCE_PREFIXES = ('threads=', '-Xmx')
+
+tool_versions = {}
+
+
+def default_cache_dir():
+    return os.environ.get(CACHE_ENV) or None
+
+
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def file_hash(path, cache_dir=None):
+    """
+    Returns the sha256 of a file, or None if the file does not exist.
+    With a cache folder the hash is remembered by path, size and mtime so
+    large read files are only hashed once.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    memo_path = None
+    if cache_dir:
+        memo_id = hashlib.sha256(
+            f"{os.path.abspath(path)}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}".encode()
+        ).hexdigest()
+        memo_path = os.path.join(cache_dir, 'memo', memo_id)
+        if os.path.exists(memo_path):
+            with open(memo_path, 'r') as f:
+                return f.read().strip()
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    if memo_path:
+        write_atomic(memo_path, digest)
+    return digest
+
+
+def tool_version(version_cmd):
+    """Returns the first line printed by a version command, e.g. ['spades.py', '--version']."""
+    if not version_cmd:
+        return ''
+    version_key = tuple(version_cmd)
+    if version_key not in tool_versions:
+        try:
+            result = subprocess.run(version_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+            lines = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+            tool_versions[version_key] = lines[0] if lines else ''
+        except OSError:
+            tool_versions[version_key] = ''
+    return tool_versions[version_key]
+
+
+def key_params(cmd):
+    """Returns the command line without thread and memory options."""
+    params = []
+    skip_next = False
+    for arg in cmd:
+        if skip_next:
+            skip_next = False
+            continue
+        if arg in RESOURCE_OPTIONS:
+            skip_next = True
+            continue
+        if arg.startswith(RESOURCE_PREFIXES):
+            continue
+        params.append(arg)
+    return params
+
+
+def step_key(name, cmd, version, input_hashes):
+    """input_hashes is a list of (path, sha256) pairs."""
+    data = json.dumps({
+        'name': name,
+        'params': key_params(cmd),
+        'version': version,
+        'inputs': input_hashes,
+    }, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def lookup(cache_dir, key):
+    """Returns the manifest of a stored step result, or None."""
+    path = os.path.join(cache_dir, 'steps', key + '.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    # A manifest is only usable if all its stored outputs are still there
+    for info in manifest['outputs'].values():
+        if info['stored'] and not os.path.exists(os.path.join(cache_dir, 'objects', info['sha256'])):
+            return None
+    return manifest
+
+
+def store(cache_dir, key, name, outputs, keep):
+    """
+    Records the outputs of a finished step. Outputs listed in keep are copied
+    into the cache; for the others only hash and size are recorded.
+    """
+    manifest = {'name': name, 'outputs': {}}
+    for path in outputs:
+        digest = file_hash(path, cache_dir)
+        info = {'sha256': digest, 'size': 0, 'stored': False}
+        if digest is not None:
+            info['size'] = os.path.getsize(path)
+            if path in keep:
+                object_path = os.path.join(cache_dir, 'objects', digest)
+                if not os.path.exists(object_path):
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(object_path), prefix='.tmp')
+                    os.close(fd)
+                    shutil.copyfile(path, tmp_path)
+                    os.replace(tmp_path, object_path)
+                info['stored'] = True
+        manifest['outputs'][path] = info
+    write_atomic(os.path.join(cache_dir, 'steps', key + '.json'), json.dumps(manifest, indent=1))
+    return manifest
+
+
+def restore(cache_dir, manifest):
+    """Copies the stored outputs of a manifest back to their paths."""
+    for path, info in manifest['outputs'].items():
+        if not info['stored']:
+            continue
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        shutil.copyfile(os.path.join(cache_dir, 'objects', info['sha256']), path)
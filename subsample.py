@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Caps the trimmed read pairs of a sample at a read budget.
+
+Reads R1_paired.fastq.gz/R2_paired.fastq.gz in two streaming passes: the
+first counts the pairs, the second keeps exactly --budget of them, chosen
+uniformly with a fixed seed (selection sampling, Knuth's algorithm S), so
+mates stay together and a rerun picks the same reads. The kept pairs are
+written to R1_sub.fastq.gz/R2_sub.fastq.gz in their original order. A
+sample within the budget is not copied: R1_sub/R2_sub are symlinks to the
+trimmed reads. Plain and gzipped FASTQ files are both read and written,
+depending on their names (see sampledag.py --intermediate-compression).
+
+sampledag.py runs this after Trimmomatic when a read budget is given
+(RotaFinder.sh --read-budget) and only the assemblies on all trimmed reads
+(work3 and work6) use the capped reads.
+
+Usage:
+    python3 subsample.py --budget 2000000 [--seed 100] [--inputs R1 R2] [--outputs R1 R2] [--log log.txt]
+"""
+import argparse
+import gzip
+import os
+import random
+import sys
+
+from scheduler import log_message
+
+# Set by RotaFinder.sh --read-budget
+READ_BUDGET_ENV = 'ROTAFINDER_READ_BUDGET'
+
+INPUTS = ['R1_paired.fastq.gz', 'R2_paired.fastq.gz']
+OUTPUTS = ['R1_sub.fastq.gz', 'R2_sub.fastq.gz']
+
+SEED = 100
+
+# Fast compression, the files are only read by SPAdes and removed afterwards
+COMPRESS_LEVEL = 1
+
+
+def default_budget():
+    value = os.environ.get(READ_BUDGET_ENV)
+    return int(value) if value else None
+
+
+def open_reads(path, mode='rb'):
+    if not path.endswith('.gz'):
+        return open(path, mode)
+    if 'w' in mode:
+        return gzip.open(path, mode, compresslevel=COMPRESS_LEVEL)
+    return gzip.open(path, mode)
+
+
+def count_reads(path):
+    """Number of FASTQ records of a file."""
+    lines = 0
+    with open_reads(path) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            lines += chunk.count(b'\n')
+    return lines // 4
+
+
+def read_records(f):
+    """Yields the 4-line records of a FASTQ file as bytes."""
+    while True:
+        record = b''.join(f.readline() for _ in range(4))
+        if not record:
+            return
+        yield record
+
+
+def link(source, target):
+    if os.path.lexists(target):
+        os.remove(target)
+    os.symlink(os.path.relpath(source, os.path.dirname(os.path.abspath(target))), target)
+
+
+def subsample(budget, inputs=INPUTS, outputs=OUTPUTS, seed=SEED):
+    """Writes the capped read files; returns (read pairs, kept read pairs)."""
+    total = count_reads(inputs[0])
+    if total <= budget:
+        for source, target in zip(inputs, outputs):
+            link(source, target)
+        return total, total
+
+    rng = random.Random(seed)
+    kept = 0
+    with open_reads(inputs[0]) as in1, open_reads(inputs[1]) as in2, \
+            open_reads(outputs[0], 'wb') as out1, open_reads(outputs[1], 'wb') as out2:
+        for i, (record1, record2) in enumerate(zip(read_records(in1), read_records(in2))):
+            if kept >= budget:
+                break
+            # Keeps each pair with probability (still needed) / (still left)
+            if rng.random() * (total - i) < budget - kept:
+                out1.write(record1)
+                out2.write(record2)
+                kept += 1
+    return total, kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cap the trimmed read pairs of a sample at a read budget.")
+    parser.add_argument('--budget', type=int, default=default_budget(),
+                        help=f"Read pairs to keep (default ${READ_BUDGET_ENV})")
+    parser.add_argument('--seed', type=int, default=SEED, help=f"Random seed (default {SEED})")
+    parser.add_argument('--inputs', nargs=2, default=INPUTS, help="Trimmed R1 and R2 reads")
+    parser.add_argument('--outputs', nargs=2, default=OUTPUTS, help="Capped R1 and R2 reads")
+    parser.add_argument('--log', default=None, help="Log file")
+    args = parser.parse_args()
+    if not args.budget:
+        parser.error("no read budget given")
+
+    total, kept = subsample(args.budget, args.inputs, args.outputs, args.seed)
+    folder_name = os.path.basename(os.getcwd())
+    if kept == total:
+        msg = f"Subsample in {folder_name}: {total} read pairs within the budget of {args.budget}, all used"
+    else:
+        msg = (f"Subsample in {folder_name}: {total} read pairs capped at the budget of {args.budget}, "
+               f"{kept} kept for work3/work6 ({100 * (total - kept) / total:.1f}% fewer)")
+    log_message(args.log, msg)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
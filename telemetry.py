@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Per-step timing and resource telemetry.
+
+Every step of a run appends one JSON Lines record to the telemetry file
+($ROTAFINDER_TELEMETRY, set by RotaFinder.sh --telemetry FILE):
+
+    {"run": "20250101120000-1234", "sample": "S1", "step": "work1",
+     "start": "2025-01-01T12:00:00", "end": "2025-01-01T12:09:30",
+     "wall_seconds": 570.1, "cpu_seconds": 4410.3, "peak_rss_mb": 5120.4,
+     "input_bytes": 81234567, "output_bytes": 1234567, "exit_status": 0}
+
+CPU time and peak RSS come from wait4() of the step's process and include
+the child processes it waited for (e.g. the SPAdes stages). sampledag.py
+records its steps directly; the steps of rotablast2.sh and RotaFinder.sh
+run through `telemetry.py run`. Nothing is recorded when
+$ROTAFINDER_TELEMETRY is not set.
+
+Usage:
+    python3 telemetry.py run --step NAME [--in FILE ...] [--out FILE ...] -- command [args ...]
+    python3 telemetry.py summary [telemetry.jsonl] [--run ID | --all] [--csv]
+        per-step count and 50th/90th/99th percentile and maximum of wall
+        time, CPU time and peak RSS, for the last run by default
+"""
+import argparse
+import csv
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+# Set by RotaFinder.sh
+TELEMETRY_ENV = 'ROTAFINDER_TELEMETRY'
+RUN_ENV = 'ROTAFINDER_RUN_ID'
+
+PERCENTILES = [50, 90, 99]
+METRICS = ['wall_seconds', 'cpu_seconds', 'peak_rss_mb']
+
+
+def telemetry_path():
+    return os.environ.get(TELEMETRY_ENV) or None
+
+
+def file_bytes(paths):
+    """Total size of the files that exist."""
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+
+def make_record(sample, step, start, end, rusage, exit_status, inputs=(), outputs=()):
+    """Builds a record from start/end times (time.time()) and the rusage of wait4()."""
+    return {
+        'run': os.environ.get(RUN_ENV, ''),
+        'sample': sample,
+        'step': step,
+        'start': datetime.fromtimestamp(start).isoformat(timespec='seconds'),
+        'end': datetime.fromtimestamp(end).isoformat(timespec='seconds'),
+        'wall_seconds': round(end - start, 3),
+        'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 3) if rusage else None,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(rusage.ru_maxrss / 1024, 1) if rusage else None,
+        'input_bytes': file_bytes(inputs),
+        'output_bytes': file_bytes(outputs),
+        'exit_status': exit_status,
+    }
+
+
+def write_record(record, path=None):
+    """Appends a record to the telemetry file; several processes may write at once."""
+    path = path or telemetry_path()
+    if not path:
+        return
+    try:
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record) + '\n')
+    except OSError as e:
+        print(f"Warning: cannot write telemetry to {path} ({e})")
+
+
+def run_command(step, cmd, inputs=(), outputs=(), sample=None):
+    """Runs a command, records it and returns its exit status."""
+    sample = sample if sample is not None else os.path.basename(os.getcwd())
+    start = time.time()
+    try:
+        proc = subprocess.Popen(cmd)
+    except OSError as e:
+        print(f"{cmd[0]}: {e}")
+        write_record(make_record(sample, step, start, time.time(), None, 127, inputs, outputs))
+        return 127
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    write_record(make_record(sample, step, start, time.time(), rusage, proc.returncode, inputs, outputs))
+    return proc.returncode
+
+
+def read_records(path):
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def summarize(records):
+    """Returns one row per step: step, count, failures and the percentiles of each metric."""
+    by_step = {}
+    for record in records:
+        by_step.setdefault(record['step'], []).append(record)
+
+    rows = []
+    for step, step_records in by_step.items():
+        row = {'step': step, 'count': len(step_records),
+               'failed': sum(1 for record in step_records if record.get('exit_status') != 0)}
+        for metric in METRICS:
+            values = np.array([record[metric] for record in step_records if record.get(metric) is not None],
+                              dtype=np.float64)
+            for p in PERCENTILES:
+                row[f'{metric}_p{p}'] = round(float(np.percentile(values, p)), 1) if len(values) else ''
+            row[f'{metric}_max'] = round(float(values.max()), 1) if len(values) else ''
+        rows.append(row)
+    # Most wall time first
+    rows.sort(key=lambda row: -(row['wall_seconds_p50'] or 0) * row['count'])
+    return rows
+
+
+def summary_command(args):
+    path = args.file or telemetry_path()
+    if not path or not os.path.exists(path):
+        print(f"No telemetry file found ({path or '$' + TELEMETRY_ENV + ' not set'})")
+        return 1
+    records = read_records(path)
+    if not args.all:
+        run_id = args.run or (records[-1].get('run', '') if records else '')
+        records = [record for record in records if record.get('run', '') == run_id]
+        if not args.csv:
+            print(f"Run {run_id or '(no run id)'}: {len(records)} records")
+    rows = summarize(records)
+    if not rows:
+        return 0
+
+    columns = list(rows[0])
+    if args.csv:
+        writer = csv.DictWriter(sys.stdout, fieldnames=columns, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+        return 0
+
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in columns}
+    print('  '.join(column.ljust(widths[column]) for column in columns))
+    for row in rows:
+        print('  '.join(str(row[column]).ljust(widths[column]) for column in columns))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and summarize per-step telemetry.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Run a command and record it")
+    run_parser.add_argument('--step', required=True, help="Step name")
+    run_parser.add_argument('--sample', default=None, help="Sample name (default: current folder)")
+    run_parser.add_argument('--in', dest='inputs', action='append', default=[], help="Input file")
+    run_parser.add_argument('--out', dest='outputs', action='append', default=[], help="Output file")
+    run_parser.add_argument('cmd', nargs=argparse.REMAINDER, help="Command after --")
+
+    summary_parser = subparsers.add_parser('summary', help="Per-step percentiles of a run")
+    summary_parser.add_argument('file', nargs='?', default=None, help=f"Telemetry file (default ${TELEMETRY_ENV})")
+    summary_parser.add_argument('--run', default=None, help="Run id (default: the last run)")
+    summary_parser.add_argument('--all', action='store_true', help="All runs in the file")
+    summary_parser.add_argument('--csv', action='store_true', help="Write CSV")
+    args = parser.parse_args()
+
+    if args.command == 'summary':
+        return summary_command(args)
+    cmd = args.cmd[1:] if args.cmd and args.cmd[0] == '--' else args.cmd
+    if not cmd:
+        parser.error("no command given")
+    return run_command(args.step, cmd, args.inputs, args.outputs, args.sample)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,37 @@
+"""
+Adds the Rotarix VP7/VP4 similarity (average pident of the accepted G1/P8
+hits against Vaccine references) to blast_rota_genotyping4.csv.
+
+    python3 update_blast_data.py
+        in a sample folder: writes blast_rota_genotyping4_updated.csv
+
+    python3 update_blast_data.py --batch [folders...] [--output blast_rotavar4.csv]
+        for a whole run (default: all subfolders with blast_rota2.csv): the
+        hit tables of all samples are read into one DataFrame and the
+        averages of every sample are computed in one grouped pass. The
+        one-row genotyping tables are written without a DataFrame per
+        sample (values formatted as pandas does, see postblast.py). Writes
+        blast_rota_genotyping4_updated.csv in each folder and the merged
+        blast_rotavar4.csv. Folders without blast_rota_genotyping4.csv (it is
+        removed by rotablast2.sh) are updated from their
+        blast_rota_genotyping4_updated.csv.
+"""
+import argparse
+import csv
+import glob
+import io
+import os
+
+import numpy as np
 import pandas as pd
 
-# Read the input CSV files
-genotyping_df = pd.read_csv('blast_rota_genotyping4.csv')
-blast_df = pd.read_csv('blast_rota2.csv')
+from postblast import pandas_field
+
+# New column -> genotype of the Rotarix vaccine strain
+VACCINE_COLUMNS = {'Rotarix VP7': 'G1', 'Rotarix VP4': 'P8'}
+
+GENOTYPING_HEADER = ['Folder Name', 'Genotype', 'Extra Information']
 
-# Initialize the new columns with empty strings
-genotyping_df['Rotarix VP7'] = ''
-genotyping_df['Rotarix VP4'] = ''
 
 # Function to compute average pident for given criteria
 def compute_average_pident(df, evaluation_value):
@@ -21,14 +46,190 @@ def compute_average_pident(df, evaluation_value):
     else:
         return ''
 
-# Process each row in the genotyping DataFrame
-for index, row in genotyping_df.iterrows():
-    # Since there's no direct mapping, we'll use the entire blast_df
-    vp7_avg_pident = compute_average_pident(blast_df, 'G1')
-    vp4_avg_pident = compute_average_pident(blast_df, 'P8')
-    # Assign the computed averages to the new columns
-    genotyping_df.at[index, 'Rotarix VP7'] = vp7_avg_pident
-    genotyping_df.at[index, 'Rotarix VP4'] = vp4_avg_pident
-
-# Save the updated DataFrame to a new CSV file
-genotyping_df.to_csv('blast_rota_genotyping4_updated.csv', index=False)
+
+def add_vaccine_columns(genotyping_df, averages):
+    """Sets the Rotarix columns of every row (the averages do not depend on the row)."""
+    for column in VACCINE_COLUMNS:
+        genotyping_df[column] = pd.Series(averages[column], index=genotyping_df.index, dtype=object)
+    return genotyping_df
+
+
+def update_folder():
+    """Single sample mode, run inside the sample folder."""
+    # Read the input CSV files
+    genotyping_df = pd.read_csv('blast_rota_genotyping4.csv')
+    blast_df = pd.read_csv('blast_rota2.csv')
+
+    # The averages are the same for every row, so compute them once
+    averages = {column: compute_average_pident(blast_df, genotype)
+                for column, genotype in VACCINE_COLUMNS.items()}
+    add_vaccine_columns(genotyping_df, averages)
+
+    # Save the updated DataFrame to a new CSV file
+    genotyping_df.to_csv('blast_rota_genotyping4_updated.csv', index=False)
+
+
+def read_hit_tables(paths):
+    """
+    Reads the blast_rota2.csv files of a run with one read_csv call per
+    distinct header. Returns the Evaluation, sseqid and pident columns with
+    a 'sample' column holding the index of the file in paths.
+    """
+    chunks = {}
+    for sample, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            header = f.readline().rstrip(b'\r\n')
+            lines = chunks.setdefault(header, [])
+            for line in f:
+                if not line.strip():
+                    continue
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                lines.append(b'%d,' % sample + line)
+
+    frames = []
+    for header, lines in chunks.items():
+        if not lines:
+            continue
+        data = b'sample,' + header + b'\n' + b''.join(lines)
+        df = pd.read_csv(io.BytesIO(data), usecols=['sample', 'Evaluation', 'sseqid', 'pident'],
+                         dtype={'Evaluation': object, 'sseqid': object})
+        df['pident'] = df['pident'].astype(np.float64)
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame({'sample': [], 'Evaluation': [], 'sseqid': [], 'pident': []})
+    return pd.concat(frames, ignore_index=True)
+
+
+def batch_averages(hits, n_samples):
+    """
+    Returns one {column: average pident or ''} dict per sample.
+
+    The Vaccine hits of all samples are filtered at once and grouped by
+    (sample, genotype). Each group is summed with numpy in its original row
+    order, as Series.mean() does, so the values are identical to the
+    single sample mode.
+    """
+    genotypes = list(VACCINE_COLUMNS.values())
+    columns = list(VACCINE_COLUMNS)
+    averages = [{column: '' for column in columns} for _ in range(n_samples)]
+
+    hits = hits[hits['Evaluation'].isin(genotypes) &
+                hits['sseqid'].str.contains('Vaccine', case=False, na=False)]
+    if hits.empty:
+        return averages
+
+    group = hits['sample'].to_numpy(dtype=np.int64) * len(genotypes) + \
+        hits['Evaluation'].map({genotype: i for i, genotype in enumerate(genotypes)}).to_numpy(dtype=np.int64)
+    order = np.argsort(group, kind='stable')
+    group = group[order]
+    pident = hits['pident'].to_numpy(dtype=np.float64)[order]
+    valid = ~np.isnan(pident)
+    pident = np.where(valid, pident, 0.0)
+
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    ends = np.r_[starts[1:], len(group)]
+    counts = np.add.reduceat(valid.astype(np.int64), starts)
+    for start, end, count in zip(starts, ends, counts):
+        sample, genotype_index = divmod(int(group[start]), len(genotypes))
+        total = pident[start:end].sum()
+        averages[sample][columns[genotype_index]] = float(total / count) if count else np.nan
+    return averages
+
+
+def similarity_field(value):
+    """A Rotarix value as to_csv writes it."""
+    if value == '' or np.isnan(value):
+        return ''
+    return repr(value)
+
+
+def read_genotyping(folder):
+    """
+    Returns the rows of the genotyping table of a folder (header first),
+    from blast_rota_genotyping4.csv or else from the Folder Name, Genotype
+    and Extra Information columns of blast_rota_genotyping4_updated.csv.
+    """
+    path = os.path.join(folder, 'blast_rota_genotyping4.csv')
+    if not os.path.exists(path):
+        path = os.path.join(folder, 'blast_rota_genotyping4_updated.csv')
+    with open(path, 'r', newline='') as f:
+        rows = list(csv.reader(f))
+    return [row[:len(GENOTYPING_HEADER)] for row in rows], path
+
+
+def write_updated(folder, rows, source, averages):
+    """
+    Writes blast_rota_genotyping4_updated.csv of a folder. The usual table
+    (header and one row) is written directly, with the values formatted as
+    the read_csv/to_csv round trip of the single sample mode does; anything
+    else goes through pandas.
+    """
+    path = os.path.join(folder, 'blast_rota_genotyping4_updated.csv')
+    if len(rows) == 2 and rows[0] == GENOTYPING_HEADER and len(rows[1]) == len(GENOTYPING_HEADER):
+        with open(path, 'w', newline='') as outfile:
+            writer = csv.writer(outfile, lineterminator='\n')
+            writer.writerow(GENOTYPING_HEADER + list(VACCINE_COLUMNS))
+            writer.writerow([pandas_field(value) for value in rows[1]] +
+                            [similarity_field(averages[column]) for column in VACCINE_COLUMNS])
+        return path
+
+    genotyping_df = pd.read_csv(source)
+    genotyping_df = genotyping_df.drop(columns=[column for column in VACCINE_COLUMNS if column in genotyping_df.columns])
+    add_vaccine_columns(genotyping_df, averages).to_csv(path, index=False)
+    return path
+
+
+def run_batch(folders, output_file='blast_rotavar4.csv'):
+    """Updates every folder of a run and writes the merged table."""
+    blast_paths = []
+    genotyping_tables = []
+    updated = []
+    for folder in folders:
+        blast_path = os.path.join(folder, 'blast_rota2.csv')
+        if not os.path.exists(blast_path):
+            print(f"File not found: {blast_path}")
+            continue
+        try:
+            genotyping_tables.append(read_genotyping(folder))
+        except FileNotFoundError:
+            print(f"File not found: {os.path.join(folder, 'blast_rota_genotyping4.csv')}")
+            continue
+        blast_paths.append(blast_path)
+        updated.append(folder)
+
+    if not updated:
+        print("No sample folders to update")
+        return
+    averages = batch_averages(read_hit_tables(blast_paths), len(updated))
+
+    # Same merge as RotaFinder.sh: the first file with its header, the
+    # others without
+    with open(output_file, 'wb') as merged:
+        for i, (folder, (rows, source)) in enumerate(zip(updated, genotyping_tables)):
+            path = write_updated(folder, rows, source, averages[i])
+            with open(path, 'rb') as f:
+                if i > 0:
+                    f.readline()
+                merged.write(f.read())
+
+    print(f"Updated {len(updated)} folders, merged table written to {output_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add the Rotarix VP7/VP4 similarity to the genotyping table.")
+    parser.add_argument('--batch', action='store_true', help="Update all sample folders of a run")
+    parser.add_argument('--output', default='blast_rotavar4.csv', help="Merged table in batch mode")
+    parser.add_argument('folders', nargs='*', help="Sample folders in batch mode (default: all subfolders)")
+    args = parser.parse_args()
+
+    if not args.batch:
+        update_folder()
+        return
+
+    folders = args.folders or sorted(path for path in glob.glob('*/') if os.path.exists(os.path.join(path, 'blast_rota2.csv')))
+    run_batch(folders, args.output)
+
+
+if __name__ == "__main__":
+    main()
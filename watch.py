@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Watch-folder mode: processes sample folders as the sequencer delivers them.
+
+The incoming folder is polled every --interval seconds. A subfolder is a
+sample once it holds *_R1_001.fastq.gz/*_R2_001.fastq.gz pairs (every R1
+file with its R2 file), and it is queued once the names, sizes and
+modification times of its read files have not changed for --stable
+seconds. Queued samples are run by RotaFinderSample.sh as in parallel mode
+(scheduler.py: as many at once as the --threads/--memory budget allows),
+with the host comparison done per sample.
+
+After each sample the run tables in the incoming folder, blast_rotavar4.csv
+and LabwareReportFromRotaFinder1.csv, are written again from the results
+file (resultsdb.py), so they always hold every sample finished so far.
+
+Finished and failed samples are recorded in rotafinder_watch.json in the
+incoming folder with the fingerprint of their reads, so a restarted
+watcher does not run them again; samples that were running when it stopped
+are run again. Sample folders whose results are newer than their reads
+(e.g. from an earlier RotaFinder.sh run) are taken as finished. A finished
+sample whose reads change (e.g. delivered again) is queued again. SIGTERM or Ctrl-C stops the polling, drops the queue and
+waits for the running samples.
+
+RotaFinder.sh --watch runs this in the current folder with the options and
+environment of the run.
+
+Usage:
+    python3 watch.py [incoming] [--threads N] [--memory GB] [--min-threads 4] [--sample-memory 16]
+                     [--interval 60] [--stable 300] [--once] [--retry-failed] [--log log.txt]
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import labware
+import resultsdb
+import scheduler
+from scheduler import log_message
+from scratch import READS
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STATE_FILE = 'rotafinder_watch.json'
+INTERVAL = 60
+STABLE_SECONDS = 300
+
+# write_run_tables() is called from the sample threads
+tables_lock = threading.Lock()
+
+
+def read_fingerprint(folder):
+    """
+    Returns [(name, size, mtime)] of the read files of a folder, or None if it
+    has no complete R1/R2 pairs.
+    """
+    r1_pattern, r2_pattern = READS
+    r1 = sorted(glob.glob(os.path.join(folder, r1_pattern)))
+    r2 = sorted(glob.glob(os.path.join(folder, r2_pattern)))
+    if not r1 or [path.replace('_R1_001', '_R2_001') for path in r1] != r2:
+        return None
+    fingerprint = []
+    for path in r1 + r2:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        fingerprint.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+class State:
+    """Finished and failed samples of the incoming folder, kept in STATE_FILE."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.samples = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.samples = json.load(f)
+
+    def get(self, name):
+        with self.lock:
+            return self.samples.get(name)
+
+    def set(self, name, fingerprint, status):
+        with self.lock:
+            self.samples[name] = {
+                'fingerprint': fingerprint,
+                'status': status,
+                'finished': datetime.now().isoformat(timespec='seconds'),
+            }
+            # Written to a new file first so a crash never leaves half a file
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.samples, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+def write_run_tables(incoming, db_path):
+    """Writes blast_rotavar4.csv and the Labware report of all samples finished so far."""
+    # Samples finishing at the same time would share the .tmp files
+    with tables_lock:
+        with resultsdb.ResultsDb(db_path) as results:
+            tables = results.genotyping(os.path.abspath(incoming))
+        if not tables:
+            return 0
+        merged = resultsdb.merge_genotyping(tables)
+        # Written to new files first, so the tables can be read at any time
+        merged_path = os.path.join(incoming, labware.INPUT_FILE)
+        with open(merged_path + '.tmp', 'w', newline='') as f:
+            f.write(merged)
+        report_path = os.path.join(incoming, labware.OUTPUT_FILE)
+        with open(report_path + '.tmp', 'w', newline='') as f:
+            labware.write_report(io.StringIO(merged, newline=''), f)
+        os.replace(merged_path + '.tmp', merged_path)
+        os.replace(report_path + '.tmp', report_path)
+        return len(tables)
+
+
+class Watcher:
+    def __init__(self, incoming, args):
+        self.incoming = os.path.abspath(incoming)
+        self.args = args
+        self.state = State(os.path.join(self.incoming, STATE_FILE))
+        self.db_path = resultsdb.default_db_path()
+        # Sample name -> (fingerprint, time it was first seen unchanged)
+        self.seen = {}
+        self.active = set()
+        self.waiting = 0
+        self.adopted = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.slots, self.threads, self.memory = scheduler.plan_slots(
+            sys.maxsize, args.threads, args.memory, args.min_threads, args.sample_memory)
+
+    def finished_before(self, folder, fingerprint):
+        """True if the results of a folder are newer than its reads (e.g. from RotaFinder.sh)."""
+        path = os.path.join(folder, resultsdb.GENOTYPING_FILE)
+        return os.path.exists(path) and os.stat(path).st_mtime_ns > max(mtime for _, _, mtime in fingerprint)
+
+    def ready(self, now):
+        """Sample folders that are complete, stable and not done yet."""
+        ready = []
+        self.waiting = 0
+        self.adopted = 0
+        for entry in sorted(os.scandir(self.incoming), key=lambda entry: entry.name):
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            name = entry.name
+            with self.lock:
+                if name in self.active:
+                    continue
+            fingerprint = read_fingerprint(entry.path)
+            if fingerprint is None:
+                continue
+            done = self.state.get(name)
+            if done and done['fingerprint'] == fingerprint:
+                if done['status'] == 'done' or not self.args.retry_failed:
+                    continue
+            if not done and self.finished_before(entry.path, fingerprint):
+                with resultsdb.ResultsDb(self.db_path) as results:
+                    resultsdb.add_folder(results, entry.path, self.incoming)
+                self.state.set(name, fingerprint, 'done')
+                self.adopted += 1
+                log_message(self.args.log, f"Watch: {name} already processed, results taken as they are")
+                continue
+
+            if self.seen.get(name, (None,))[0] != fingerprint:
+                self.seen[name] = (fingerprint, now)
+            if now - self.seen[name][1] < self.args.stable:
+                self.waiting += 1
+                continue
+            if done:
+                reason = "reads changed" if done['fingerprint'] != fingerprint else "retrying"
+                log_message(self.args.log, f"Watch: {name} was {done['status']} before, {reason}")
+            ready.append((name, fingerprint))
+        return ready
+
+    def process(self, name, fingerprint):
+        folder = os.path.join(self.incoming, name)
+        start = time.time()
+        try:
+            returncode = scheduler.run_sample(folder, self.threads, self.memory, self.args.log)
+            if self.stop.is_set():
+                # Ctrl-C reaches the sample too; it is left unrecorded so a
+                # restarted watcher runs it again
+                log_message(self.args.log, f"Watch: {name} stopped, it is run again after a restart")
+                return
+            with resultsdb.ResultsDb(self.db_path) as results:
+                # rotablast2.sh adds the sample itself; this also covers a
+                # post-BLAST step taken from the step cache
+                finished = resultsdb.add_folder(results, folder, self.incoming)
+            status = 'done' if returncode == 0 and finished else 'failed'
+            self.state.set(name, fingerprint, status)
+            samples = write_run_tables(self.incoming, self.db_path)
+            log_message(self.args.log, f"Watch: {name} {status} in {time.time() - start:.0f} seconds, "
+                                       f"{samples} samples in {labware.INPUT_FILE}")
+        except Exception as e:
+            log_message(self.args.log, f"Watch: {name} failed ({e})")
+        finally:
+            with self.lock:
+                self.active.discard(name)
+
+    def run(self, stop):
+        self.stop = stop
+        log_message(self.args.log, f"Watch: polling {self.incoming} every {self.args.interval} seconds, "
+                                   f"{self.slots} samples at a time with {self.threads} threads"
+                                   + (f" and {self.memory} GB" if self.memory else "") + " each")
+        write_run_tables(self.incoming, self.db_path)
+        with ThreadPoolExecutor(max_workers=self.slots) as pool:
+            while not stop.is_set():
+                ready = self.ready(time.time())
+                if self.adopted:
+                    write_run_tables(self.incoming, self.db_path)
+                for name, fingerprint in ready:
+                    with self.lock:
+                        self.active.add(name)
+                    log_message(self.args.log, f"Watch: {name} queued")
+                    pool.submit(self.process, name, fingerprint)
+                if self.args.once:
+                    with self.lock:
+                        idle = not self.active
+                    if idle and not self.waiting:
+                        break
+                stop.wait(self.args.interval)
+            pool.shutdown(wait=True, cancel_futures=True)
+        log_message(self.args.log, "Watch: stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process sample folders as they arrive in an incoming folder.")
+    parser.add_argument('incoming', nargs='?', default='.', help="Incoming folder (default: current)")
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help="Total CPU threads (default all)")
+    parser.add_argument('--memory', type=int, default=None, help="Total memory available in GB")
+    parser.add_argument('--min-threads', type=int, default=4, help="Minimum threads per sample (default 4)")
+    parser.add_argument('--sample-memory', type=int, default=16, help="Memory needed per sample in GB (default 16)")
+    parser.add_argument('--interval', type=float, default=INTERVAL,
+                        help=f"Seconds between polls (default {INTERVAL})")
+    parser.add_argument('--stable', type=float, default=STABLE_SECONDS,
+                        help=f"Seconds the reads must be unchanged before a sample is queued (default {STABLE_SECONDS})")
+    parser.add_argument('--once', action='store_true', help="Stop when no sample is running or arriving")
+    parser.add_argument('--retry-failed', action='store_true', help="Run samples that failed before again")
+    parser.add_argument('--log', default=os.path.join(SCRIPT_DIR, 'log.txt'), help="Log file")
+    args = parser.parse_args()
+
+    # Samples are run and reported one by one: the host comparison is done in
+    # each sample and the rotadb BLAST is not pooled over the run
+    os.environ.pop('ROTAFINDER_POOL_HOST', None)
+    os.environ.pop('ROTAFINDER_BATCH_BLAST', None)
+    # The run tables are made from the results file, results.sqlite in the
+    # incoming folder unless one is given
+    os.environ[resultsdb.RESULTS_DB_ENV] = os.environ.get(resultsdb.RESULTS_DB_ENV) or \
+        os.path.join(os.path.abspath(args.incoming), resultsdb.RESULTS_DB_NAME)
+    os.environ[resultsdb.RUN_DIR_ENV] = os.path.abspath(args.incoming)
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    Watcher(args.incoming, args).run(stop)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())